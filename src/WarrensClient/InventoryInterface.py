@@ -130,8 +130,7 @@ class InventoryInterface(Interface):
 
         # Draw left inventory
         y = self.border
-        for i in range(0, len(self.left_owner.inventory.items)):
-            item = self.left_owner.inventory.items[i]
+        for i, item in enumerate(self.left_owner.inventory.items):
             if self.select_on_left and i == self.selected_index:
                 banner = self.surface_item_banner(item, selected=True)
             else:
@@ -141,8 +140,7 @@ class InventoryInterface(Interface):
 
         # Draw right inventory
         y = self.border
-        for j in range(0, len(self.right_owner.inventory.items)):
-            item = self.right_owner.inventory.items[j]
+        for j, item in enumerate(self.right_owner.inventory.items):
             if (not self.select_on_left) and j == self.selected_index:
                 banner = self.surface_item_banner(item, selected=True)
             else:
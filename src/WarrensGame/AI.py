@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
-import random
 import WarrensGame.Actors
+from WarrensGame.CONSTANTS import RNG, LOD
 from WarrensGame.Utilities import GameError, message, distance_between_actors
 
 # Possible directions for movement
@@ -15,6 +15,56 @@ DIRECTIONS = [(-1, +0),
               (+1, -1)]
 
 
+class ThinkingPolicy(object):
+    """
+    Level of detail policy for the AI, it decides how many ticks pass between two decisions of a character.
+    Characters adjacent to a player think every tick, the ones within sight of a player every few ticks and
+    the ones further away rarely. The policy counts the decisions that were taken and the ones that were skipped.
+    Every Game or World has its own policy, see Level.thinking_policy.
+    """
+
+    def __init__(self, near_distance=LOD.NEAR_DISTANCE, sight_distance=LOD.SIGHT_DISTANCE,
+                 sight_interval=LOD.SIGHT_INTERVAL, far_interval=LOD.FAR_INTERVAL):
+        """
+        Constructor, the defaults come from CONSTANTS.LOD.
+        :param near_distance: characters this close to a player think every tick
+        :param sight_distance: characters this close to a player think every sight_interval ticks
+        :param sight_interval: ticks between decisions within sight of a player
+        :param far_interval: ticks between decisions further away
+        """
+        self.near_distance = near_distance
+        self.sight_distance = sight_distance
+        self.sight_interval = sight_interval
+        self.far_interval = far_interval
+        self.decisions = 0
+        self.skipped = 0
+
+    def interval(self, character):
+        """
+        Returns the number of ticks until the next decision of the character.
+        """
+        player = None
+        if character.level is not None and character.tile is not None:
+            player = character.level.nearest_actor(character.tile.x, character.tile.y,
+                                                   WarrensGame.Actors.Player, self.sight_distance)
+        if player is None:
+            return self.far_interval
+        if distance_between_actors(character, player) > self.near_distance:
+            return self.sight_interval
+        return 1
+
+    def count(self, interval):
+        """
+        Counts a decision that was taken after waiting the given number of ticks, the other ticks were skipped.
+        """
+        self.decisions += 1
+        self.skipped += interval - 1
+
+    def reset_counters(self):
+        self.decisions = 0
+        self.skipped = 0
+
+
 class AI(object):
     """
     Base class for AI logic
@@ -44,10 +94,46 @@ class AI(object):
         """
         raise GameError("Class AI does not have implementation for takeTurn(), please use one of the subclasses")
 
+    def think_interval(self):
+        """
+        Number of ticks until the next decision of this AI, by default it thinks every tick.
+        """
+        return 1
+
+    def scheduled(self, interval):
+        """
+        Called when the character is scheduled to take its next turn after the given number of ticks.
+        """
+        pass
+
+    def fast_forward(self, turns):
+        """
+        Skips a number of turns at once, used when a level catches up with the time it slept.
+        """
+        pass
+
+    def pack(self, packer):
+        """
+        Returns the state of this AI in plain values, see SaveGame.Packer.
+        """
+        return {"class": type(self).__name__}
+
+    @classmethod
+    def unpack(cls, record, character, unpacker):
+        """
+        Recreates an AI from the result of pack().
+        :param record: Dictionary created by pack()
+        :param character: Character to which the AI is linked
+        :param unpacker: SaveGame.Unpacker that provides the other objects
+        :return: AI object
+        """
+        return cls(character)
+
 
 class BasicMonsterAI(AI):
     """
     AI sub class that provides AI implementation for basic monsters.
+    Basic monsters think less often when they are far from a player, see ThinkingPolicy.
     """
 
     def __init__(self, monster):
@@ -59,45 +145,79 @@ class BasicMonsterAI(AI):
         super(BasicMonsterAI, self).__init__(monster)
         # Init class variables
         self._player = None
-        
+        self._interval = 1
+        self._thinking_policy = None
+
+    @property
+    def thinking_policy(self):
+        """
+        Level of detail policy of this AI. By default this is the policy of the level of the character,
+        it can be replaced for a single AI. None if the character is not on a level.
+        """
+        if self._thinking_policy is not None:
+            return self._thinking_policy
+        if self.character.level is None:
+            return None
+        return self.character.level.thinking_policy
+
+    @thinking_policy.setter
+    def thinking_policy(self, policy):
+        self._thinking_policy = policy
+
+    def think_interval(self):
+        """
+        Number of ticks until the next decision, it depends on the distance to the nearest player.
+        """
+        policy = self.thinking_policy
+        if policy is None:
+            return 1
+        return policy.interval(self.character)
+
+    def scheduled(self, interval):
+        """
+        Remembers the number of ticks until the next decision, the policy counts them when the turn is taken.
+        """
+        self._interval = interval
+
     def take_turn(self):
         """
         Take one turn
         """
+        policy = self.thinking_policy
+        if policy is not None:
+            policy.count(self._interval)
         message(self.character.name + ' at ' + str(self.character.tile) +
                 ' takes turn.', "AI")
         # Only take action if we are in a level
         if self.character.level is None:
             message("   Not in a level, can't take action.", "AI")
             return
-        # Only take action if we find a player on our level
-        if not self.character.level.player_present:
-            message("   No player found on level, staying put", "AI")
+        # TODO medium: read this from the config file via monsterlibrary
+        range_of_sight = 8
+        range_of_attack = 2
+        # Only take action if there is a player within range of sight
+        player = self.character.level.nearest_actor(self.character.tile.x, self.character.tile.y,
+                                                     WarrensGame.Actors.Player, range_of_sight)
+        if player is None:
+            message("   No player in sight, staying put", "AI")
             return
-
-        for player in self.character.level.players:
-            # Only take action if player is not dead.
-            if not player.state_alive:
-                message("   Player is dead, no action needed", "AI")
-                return
+        # Only take action if player is not dead.
+        if not player.state_alive:
+            message("   Player is dead, no action needed", "AI")
+            return
+        distance = distance_between_actors(self.character, player)
+        # Attack if player is within range of attack
+        if distance < range_of_attack:
+            message("   Attacking player", "AI")
+            self.character.attack(player)
+        else:
+            message("   Moving towards player", "AI")
+            # Follow the flow field of the level, it leads around walls and corners
+            step_tile = self.character.level.flow_step(self.character.tile)
+            if step_tile is not None:
+                self.character.moveToTile(step_tile)
             else:
-                # TODO medium: read this from the config file via monsterlibrary
-                range_of_sight = 8
-                range_of_attack = 2
-                distance = distance_between_actors(self.character, player)
-                # Only take action if player is within range of sight
-                if distance > range_of_sight:
-                    message("   Player is out of sight, no action needed", "AI")
-                    return
-                # Attack if player is within range of attack
-                elif distance < range_of_attack:
-                    message("   Attacking player", "AI")
-                    self.character.attack(player)
-                    return
-                else:
-                    message("   Moving towards player", "AI")
-                    self.character.moveTowards(player)
-                    return
+                self.character.moveTowards(player)
 
 
 class ConfusedMonsterAI(AI):
@@ -135,9 +255,37 @@ class ConfusedMonsterAI(AI):
         # Switch back to regular AI if confusedTurns are over
         self.confusedTurns -= 1
         if self.confusedTurns == 0:
-            self.character.AI = self.originalAI
-            self.character.state_confused = False
-            message(self.character.name + ' is no longer confused.', "GAME")
+            self._end_confusion()
+
+    def fast_forward(self, turns):
+        """
+        Skips a number of confused turns at once.
+        """
+        self.confusedTurns -= turns
+        if self.confusedTurns <= 0:
+            self._end_confusion()
+
+    def pack(self, packer):
+        record = super(ConfusedMonsterAI, self).pack(packer)
+        record["original"] = None if self.originalAI is None else self.originalAI.pack(packer)
+        record["source_effect"] = packer.effect(self.sourceEffect)
+        record["turns"] = self.confusedTurns
+        return record
+
+    @classmethod
+    def unpack(cls, record, character, unpacker):
+        # The constructor changes the character, the AI is filled in instead
+        ai = cls.__new__(cls)
+        ai._character = character
+        ai.originalAI = unpacker.ai(character, record["original"])
+        ai.sourceEffect = unpacker.get(record["source_effect"])
+        ai.confusedTurns = record["turns"]
+        return ai
+
+    def _end_confusion(self):
+        self.character.AI = self.originalAI
+        self.character.state_confused = False
+        message(self.character.name + ' is no longer confused.', "GAME")
 
     def random_direction(self):
         """
@@ -150,7 +298,7 @@ class ConfusedMonsterAI(AI):
         target_direction = None
         while len(directions) > 0:
             # Find a random tile to move to
-            direction = random.choice(directions)
+            direction = self.character.random_streams.stream(RNG.AI).choice(directions)
             # Don't try the same direction again
             directions.remove(direction)
             x = self.character.tile.x + direction[0]
@@ -1,11 +1,18 @@
-import random
-
-from WarrensGame.CONSTANTS import SPRITES, GAME, INTERACTION
+from WarrensGame.CONSTANTS import SPRITES, GAME, INTERACTION, RNG
 from WarrensGame.Interaction import Interaction
 from WarrensGame.Inventory import Inventory
+from collections import namedtuple
+
 import WarrensGame.AI  # Used in eval statement
 import WarrensGame.Effects as Effects
-from WarrensGame.Utilities import message, roll_hit_die, GameError, distance_between_actors, clamp, game_event
+from WarrensGame.Utilities import message, GameError, distance_between_actors, clamp, game_event, \
+    random_stream, default_random_streams, compile_dice
+
+# Dice for the hit roll of an attack
+_hit_dice = compile_dice("1d100")
+
+# Derived stats of a Character or Item, see Character.stats
+StatBlock = namedtuple("StatBlock", ["accuracy", "dodge", "damage", "armor", "body", "mind"])
 
 
 ##########
@@ -179,6 +186,9 @@ class Actor(object):
             self._tile.removeActor(self)
         self._tile = target_tile
         target_tile.addActor(self)
+        level = target_tile.map.level
+        if level is not None:
+            level.actor_moved(self)
 
     @property
     def level(self):
@@ -192,11 +202,22 @@ class Actor(object):
         """
         Moves this actor to the targetLevel
         """
-        if self._level is not None:
+        # Registering again on the same level changes nothing, the actor only leaves a level it is not staying on
+        if self._level is not None and self._level is not targetLevel:
             self.level.removeActor(self)
         self._level = targetLevel
         self.registerWithLevel(targetLevel)
 
+    @property
+    def random_streams(self):
+        """
+        The random streams of the game that owns the level of this Actor, see Utilities.RandomStreams.
+        Actors that are not on a level use the default streams.
+        """
+        if self._level is None:
+            return default_random_streams()
+        return self._level.random_streams
+
     @property
     def actionTaken(self):
         """
@@ -284,9 +305,12 @@ class Actor(object):
     def moveToRandomTile(self):
         """
         moves this actor to a random tile on the current level
+        The actor stays put if there are no empty tiles on the level.
         """
         if self.level is not None:
-            self.moveToTile(self.level.getRandomEmptyTile)
+            target_tile = self.level.getRandomEmptyTile()
+            if target_tile is not None:
+                self.moveToTile(target_tile)
 
     def moveToTile(self, targetTile):
         """
@@ -331,9 +355,16 @@ class Actor(object):
     def moveTowards(self, targetActor):
         """
         Moves this actor towards the provided actor.
+        The shortest path on the map is followed, if there is none the actor moves in the direction of the target.
         arguments
             actor - the target Actor object
         """
+        # follow the shortest path if there is one
+        if self.level is not None and self.level.map is not None:
+            path = self.level.map.find_path(self.tile, targetActor.tile)
+            if path is not None and len(path) > 0:
+                self.moveToTile(path[0])
+                return
         # vector towards the target
         dx = targetActor.tile.x - self.tile.x
         dy = targetActor.tile.y - self.tile.y
@@ -364,6 +395,49 @@ class Actor(object):
         """
         pass
 
+    def leave_map(self):
+        """
+        Forgets the tile of this actor without updating the tile, used when the map of the level is dropped
+        from memory. See Level.hibernate().
+        """
+        self._tile = None
+
+    def pack(self, packer):
+        """
+        Returns the state of this actor in plain values, other objects are referred to by their index.
+        See SaveGame.Packer.
+        """
+        return {
+            "class": type(self).__name__,
+            "json": dict(self.json),
+            "level": packer.level(self.level)
+        }
+
+    def unpack(self, record, unpacker):
+        """
+        Fills in this actor from the result of pack(), the actor was created without calling its constructor.
+        The level puts the actor back on its tile, see unpack_tile().
+        """
+        self._json = dict(record["json"])
+        self.state_healing_animation_id = 0
+        self._tile = None
+        self._level = unpacker.get(record["level"])
+        self._sceneObject = None
+
+    def unpack_inventory(self, record, unpacker):
+        """
+        Fills in the inventory of this actor, it is called after all actors were unpacked.
+        Actors without an inventory have nothing to do.
+        """
+        pass
+
+    def unpack_tile(self, tile):
+        """
+        Puts this actor back on a tile of a map that is being unpacked, the level is not notified.
+        """
+        self._tile = tile
+        tile.addActor(self)
+
 
 ############
 # Specials #
@@ -417,6 +491,15 @@ class Portal(Actor):
         """
         level.addPortal(self)
 
+    def pack(self, packer):
+        record = super(Portal, self).pack(packer)
+        record["destination"] = packer.actor(self.destinationPortal)
+        return record
+
+    def unpack(self, record, unpacker):
+        super(Portal, self).unpack(record, unpacker)
+        self._destination = unpacker.get(record["destination"])
+
 
 class Chest(Actor):
     """
@@ -458,6 +541,17 @@ class Chest(Actor):
         else:
             self.inventory.remove(item)
             #self.sprite_id = SPRITES.CHEST_OPEN
+
+    def pack(self, packer):
+        record = super(Chest, self).pack(packer)
+        record["inventory"] = [packer.actor(item) for item in self.inventory.items]
+        return record
+
+    def unpack_inventory(self, record, unpacker):
+        # Inventories index their items by base item and modifiers, the items have to be unpacked
+        self._inventory = Inventory(self)
+        for index in record["inventory"]:
+            self._inventory.insert(unpacker.get(index))
         
 
 ##############
@@ -571,24 +665,34 @@ class Character(Actor):
     def baseMind(self):
         return self._baseMind
 
+    @property
+    def stats(self):
+        """
+        StatBlock with the derived stats of this character.
+        It is only recalculated after invalidate_stats(), equiping, unequiping and leveling up call it.
+        """
+        if self._stats is None:
+            self._stats = self._compute_stats()
+        return self._stats
+
     @property
     def accuracy(self):
-        return self.baseAccuracy + self.equipmentBonusAccuracy
+        return self.stats.accuracy
     @property
     def dodge(self):
-        return self.baseDodge + self.equipmentBonusDodge
+        return self.stats.dodge
     @property
     def damage(self):
-        return self.baseDamage + self.equipmentBonusDamage
+        return self.stats.damage
     @property
     def armor(self):
-        return self.baseArmor + self.equipmentBonusArmor
+        return self.stats.armor
     @property
     def body(self):
-        return self.baseBody + self.equipmentBonusBody
+        return self.stats.body
     @property
     def mind(self):
-        return self.baseMind + self.equipmentBonusMind
+        return self.stats.mind
 
     @property
     def AI(self):
@@ -603,6 +707,42 @@ class Character(Actor):
         """
         self._AI = myAI
 
+    @property
+    def speed(self):
+        """
+        Speed of this character, at GAME.NORMAL_SPEED it acts once every tick.
+        """
+        return self.json["speed"]
+
+    @speed.setter
+    def speed(self, speed):
+        self.json["speed"] = speed
+
+    @property
+    def action_delay(self):
+        """
+        Time until the next action of this character, None if it can't act. See Scheduler.
+        The AI can think less often than the character could act, see AI.ThinkingPolicy.
+        """
+        if self.AI is None or not self.state_alive:
+            return None
+        return self._turn_delay * self.AI.think_interval()
+
+    @property
+    def _turn_delay(self):
+        """
+        Time of one turn of this character, it depends on the speed.
+        """
+        return GAME.TICK * GAME.NORMAL_SPEED // max(1, self.speed)
+
+    def scheduled(self, delay):
+        """
+        Called by the scheduler when this character is scheduled to act after the given delay.
+        The AI learns how many ticks pass until its next decision.
+        """
+        if self.AI is not None:
+            self.AI.scheduled(max(1, delay // self._turn_delay))
+
     def __init__(self):
         """
         Creates a new character object, normally not used directly but called
@@ -611,6 +751,7 @@ class Character(Actor):
         super(Character, self).__init__()
 
         # Initialize class variables
+        self._stats = None
         self._equipedItems = []
         self._inventory = Inventory(self)
         self._baseAccuracy = 10
@@ -627,6 +768,7 @@ class Character(Actor):
         self._AI = None
         self.json["state_alive"] = True
         self.json["state_confused"] = False
+        self.json["speed"] = GAME.NORMAL_SPEED
 
     def __str__(self):
         return self.json["name"] + " (" \
@@ -638,6 +780,20 @@ class Character(Actor):
             + "Mind:" + str(self.mind) + ") " \
             + super(Actor, self).__str__()
 
+    def invalidate_stats(self):
+        """
+        Makes sure the stats are recalculated the next time they are read.
+        """
+        self._stats = None
+
+    def _compute_stats(self):
+        return StatBlock(self.baseAccuracy + self.equipmentBonusAccuracy,
+                         self.baseDodge + self.equipmentBonusDodge,
+                         self.baseDamage + self.equipmentBonusDamage,
+                         self.baseArmor + self.equipmentBonusArmor,
+                         self.baseBody + self.equipmentBonusBody,
+                         self.baseMind + self.equipmentBonusMind)
+
     def registerWithLevel(self, level):
         """
         Makes the level aware that this character is on it.
@@ -666,11 +822,12 @@ class Character(Actor):
         equipment slots. Should be overridden in subclass implementations.
         """
         #can only equip if item is in inventory
-        if item in self.inventory.items:
+        if item in self.inventory:
             #can only equip if not yet equiped
             if item not in self.equipedItems:
                 self.equipedItems.append(item)
                 item.isEquiped = True
+                self.invalidate_stats()
                 message(self.name.capitalize() + ' equips a '
                         + item.name + '.', "GAME")
 
@@ -683,6 +840,7 @@ class Character(Actor):
         if item in self.equipedItems:
             self.equipedItems.remove(item)
             item.isEquiped = False
+            self.invalidate_stats()
             message(self.name.capitalize() + ' unequips a '
                         + item.name + '.', "GAME")
 
@@ -709,7 +867,7 @@ class Character(Actor):
         if item in self.equipedItems:
             self.unEquipItem(item)
         #if it is in the inventory remove it
-        if item in self.inventory.items:
+        if item in self.inventory:
             self.inventory.remove(item)
         #add it to the current tile of the character
         item.moveToLevel(self.level, self.tile)
@@ -724,7 +882,7 @@ class Character(Actor):
             target - the Character to be attacked
         """
         # Check if the attack hits
-        hitRoll = roll_hit_die("1d100")
+        hitRoll = _hit_dice.roll(self.random_streams.stream(RNG.COMBAT))
         # In case of an equal accuracy and dodge rating there is a 50% chance to hit
         toHit = 100 - (50 + self.accuracy - target.dodge)
         message(self.name.capitalize() + ' attacks ' + target.name + ': ' + str(hitRoll) + ' vs ' + str(toHit), "COMBAT")
@@ -810,6 +968,39 @@ class Character(Actor):
         if self.AI is not None:
             self.AI.take_turn()
 
+    def fast_forward(self, ticks):
+        """
+        Skips a number of ticks at once, used when a level catches up with the time it slept.
+        The AI skips the turns the character would have taken at its speed.
+        """
+        if self.AI is not None:
+            self.AI.fast_forward(ticks * self.speed // GAME.NORMAL_SPEED)
+
+    def pack(self, packer):
+        record = super(Character, self).pack(packer)
+        record["inventory"] = [packer.actor(item) for item in self.inventory.items]
+        record["equiped"] = [packer.actor(item) for item in self.equipedItems]
+        record["base_stats"] = (self._baseAccuracy, self._baseDodge, self._baseDamage,
+                                self._baseArmor, self._baseBody, self._baseMind)
+        record["xp_value"] = self.xpValue
+        record["ai"] = None if self.AI is None else self.AI.pack(packer)
+        return record
+
+    def unpack(self, record, unpacker):
+        super(Character, self).unpack(record, unpacker)
+        self._stats = None
+        self._equipedItems = [unpacker.get(index) for index in record["equiped"]]
+        (self._baseAccuracy, self._baseDodge, self._baseDamage,
+         self._baseArmor, self._baseBody, self._baseMind) = record["base_stats"]
+        self._xpValue = record["xp_value"]
+        self._AI = unpacker.ai(self, record["ai"])
+
+    def unpack_inventory(self, record, unpacker):
+        # Inventories index their items by base item and modifiers, the items have to be unpacked
+        self._inventory = Inventory(self)
+        for index in record["inventory"]:
+            self._inventory.insert(unpacker.get(index))
+
 
 class Player(Character):
     """
@@ -848,11 +1039,14 @@ class Player(Character):
     def direction(self,direction):
         self._direction = direction
 
-    def __init__(self):
+    def __init__(self, rng=None):
         """
         Creates and initializes new player object. Note that the object is not
         linked to a game tile. It should be moved to the tile after creation.
+        :param rng: random generator used to create the player, defaults to the default spawn stream
         """
+        if rng is None:
+            rng = random_stream(RNG.SPAWN)
         # Call super class constructor
         super(Player, self).__init__()
 
@@ -860,7 +1054,7 @@ class Player(Character):
         # Actor properties
         self.json["key"] = 'player'
         self.json["char"] = '@'
-        self.json["name"] = random.choice(('Joe', 'Wesley', 'Frost'))
+        self.json["name"] = rng.choice(('Joe', 'Wesley', 'Frost'))
         # Player is white
         self.json["color"] = (250,250,250)
         # Character properties
@@ -903,6 +1097,7 @@ class Player(Character):
         self._baseArmor += GAME.PLAYER_LEVEL_ARMOR
         self._baseBody += GAME.PLAYER_LEVEL_BODY
         self._baseMind += GAME.PLAYER_LEVEL_MIND
+        self.invalidate_stats()
          
     def gainXp(self, amount):
         """
@@ -922,8 +1117,9 @@ class Player(Character):
         """
         #Game message
         message(portal.message, "GAME")
-        #Move the player to the destination
+        #Move the player to the destination, the level is generated on the first visit or rehydrated
         destinationLevel = portal.destinationPortal.level
+        destinationLevel.wake()
         destinationTile = portal.destinationPortal.tile
         self.moveToLevel(destinationLevel, destinationTile)
         #change the current level of the game to the destinationlevel
@@ -1024,6 +1220,15 @@ class Player(Character):
                 return
         self.dropItem(item)
 
+    def pack(self, packer):
+        record = super(Player, self).pack(packer)
+        record["direction"] = self.direction
+        return record
+
+    def unpack(self, record, unpacker):
+        super(Player, self).unpack(record, unpacker)
+        self._direction = record["direction"]
+
 
 class NPC(Character):
     """
@@ -1033,11 +1238,14 @@ class NPC(Character):
 
     NPC_NAMES = ["John", "Jake", "jacob", "Jeremy", "Mr J"]
 
-    def __init__(self):
+    def __init__(self, rng=None):
         """
         Creates and initializes new player object. Note that the object is not
         linked to a game tile. It should be moved to the tile after creation.
+        :param rng: random generator used to create the npc, defaults to the default spawn stream
         """
+        if rng is None:
+            rng = random_stream(RNG.SPAWN)
         #call super class constructor
         super(NPC, self).__init__()
 
@@ -1045,7 +1253,7 @@ class NPC(Character):
         #Actor properties
         self.json["key"] = 'npc'
         self.json["char"] = '@'
-        self.json["name"] = random.choice(self.NPC_NAMES)
+        self.json["name"] = rng.choice(self.NPC_NAMES)
         #npcs are light grey
         self.json["color"] = (200,200,200)
         #Character properties
@@ -1060,25 +1268,6 @@ class Monster(Character):
     Later we can consider more specialised subclasses
     for example Humanoid, Undead, Animal
     """
-    @property
-    def accuracy(self):
-        return self.baseAccuracy + self.modifierBonusAccuracy + self.equipmentBonusAccuracy
-    @property
-    def dodge(self):
-        return self.baseDodge + self.modifierBonusDodge + self.equipmentBonusDodge
-    @property
-    def damage(self):
-        return self.baseDamage + self.modifierBonusDamage + self.equipmentBonusDamage
-    @property
-    def armor(self):
-        return self.baseArmor + self.modifierBonusArmor + self.equipmentBonusArmor
-    @property
-    def body(self):
-        return self.baseBody + self.modifierBonusBody + self.equipmentBonusBody
-    @property
-    def mind(self):
-        return self.baseMind + self.modifierBonusMind + self.equipmentBonusMind
-
     @property
     def baseMonster(self):
         return self._baseMonster
@@ -1158,11 +1347,29 @@ class Monster(Character):
         """
         return self.baseMonster.killedBy
 
-    def __init__(self, baseMonster):
+    def add_modifier(self, modifier):
+        """
+        Adds a MonsterModifier to this monster.
+        """
+        self.modifiers.append(modifier)
+        self.invalidate_stats()
+
+    def _compute_stats(self):
+        return StatBlock(self.baseAccuracy + self.modifierBonusAccuracy + self.equipmentBonusAccuracy,
+                         self.baseDodge + self.modifierBonusDodge + self.equipmentBonusDodge,
+                         self.baseDamage + self.modifierBonusDamage + self.equipmentBonusDamage,
+                         self.baseArmor + self.modifierBonusArmor + self.equipmentBonusArmor,
+                         self.baseBody + self.modifierBonusBody + self.equipmentBonusBody,
+                         self.baseMind + self.modifierBonusMind + self.equipmentBonusMind)
+
+    def __init__(self, baseMonster, rng=None):
         """
         Creates a new uninitialized Monster object.
         Use MonsterLibrary.createMonster() to create an initialized Monster.
+        :param rng: random generator used to roll the hit points, defaults to the default spawn stream
         """
+        if rng is None:
+            rng = random_stream(RNG.SPAWN)
         self._baseMonster = baseMonster
         self._modifiers = []
 
@@ -1172,7 +1379,7 @@ class Monster(Character):
         # Actor components
         self.json["key"] = baseMonster.key
         self.json["char"] = baseMonster.char
-        self.json["maxHitPoints"] = roll_hit_die(baseMonster.hitdie)
+        self.json["maxHitPoints"] = baseMonster.hitDice.roll(rng)
         self.json["currentHitPoints"] = self.json["maxHitPoints"]
         self.json["name"] = baseMonster.name
         self.json["flavorText"] = baseMonster.flavor
@@ -1187,6 +1394,17 @@ class Monster(Character):
         # For monsters we use the baseMonster key as sprite_id
         self.sprite_id = baseMonster.key
 
+    def pack(self, packer):
+        record = super(Monster, self).pack(packer)
+        record["base_monster"] = packer.base_monster(self.baseMonster)
+        record["modifiers"] = [dict(modifier) for modifier in self.modifiers]
+        return record
+
+    def unpack(self, record, unpacker):
+        super(Monster, self).unpack(record, unpacker)
+        self._baseMonster = unpacker.base_monster(record["base_monster"])
+        self._modifiers = [unpacker.monster_modifier(modifier) for modifier in record["modifiers"]]
+
 
 #########
 # ITEMS #
@@ -1225,28 +1443,46 @@ class Item(Actor):
     @stackSize.setter
     def stackSize(self, newStackSize):
         """
-        Stack size setter
+        Stack size setter, the inventory that holds this item keeps count.
         """
+        difference = newStackSize - self.json["stackSize"]
         self.json["stackSize"] = newStackSize
+        inventory = getattr(self.owner, "inventory", None)
+        if inventory is not None:
+            inventory.stack_size_changed(self, difference)
+
+    @property
+    def stats(self):
+        """
+        StatBlock with the bonuses of this item, it is only recalculated after invalidate_stats().
+        """
+        if self._stats is None:
+            self._stats = StatBlock(self.baseAccuracy + self.modifierBonusAccuracy,
+                                    self.baseDodge + self.modifierBonusDodge,
+                                    self.baseDamage + self.modifierBonusDamage,
+                                    self.baseArmor + self.modifierBonusArmor,
+                                    self.baseBody + self.modifierBonusBody,
+                                    self.baseMind + self.modifierBonusMind)
+        return self._stats
 
     @property
     def accuracy(self):
-        return self.baseAccuracy + self.modifierBonusAccuracy
+        return self.stats.accuracy
     @property
     def dodge(self):
-        return self.baseDodge + self.modifierBonusDodge
+        return self.stats.dodge
     @property
     def damage(self):
-        return self.baseDamage + self.modifierBonusDamage
+        return self.stats.damage
     @property
     def armor(self):
-        return self.baseArmor + self.modifierBonusArmor
+        return self.stats.armor
     @property
     def body(self):
-        return self.baseBody + self.modifierBonusBody
+        return self.stats.body
     @property
     def mind(self):
-        return self.baseMind + self.modifierBonusMind
+        return self.stats.mind
 
     @property
     def baseItem(self):
@@ -1359,6 +1595,25 @@ class Item(Actor):
         """
         self._owner = owner
 
+    def add_modifier(self, modifier):
+        """
+        Adds an ItemModifier to this item, the inventory that holds this item stacks it accordingly.
+        """
+        self.modifiers.append(modifier)
+        self.invalidate_stats()
+        inventory = getattr(self.owner, "inventory", None)
+        if inventory is not None:
+            inventory.modifiers_changed(self)
+
+    def invalidate_stats(self):
+        """
+        Makes sure the stats are recalculated the next time they are read, also those of the character that
+        has this item equiped.
+        """
+        self._stats = None
+        if isinstance(self.owner, Character) and self in self.owner.equipedItems:
+            self.owner.invalidate_stats()
+
     def registerWithLevel(self, level):
         """
         Makes the level aware that this item is on it.
@@ -1374,6 +1629,7 @@ class Item(Actor):
         super(Item, self).__init__()
         # Initialize Item components
         self._baseItem = baseItem
+        self._stats = None
         self.json["key"] = baseItem.key
         self.json["char"] = baseItem.char
         self.json["name"] = baseItem.name
@@ -1387,6 +1643,20 @@ class Item(Actor):
         # For Items we use the baseItem.key as sprite ID
         self.sprite_id = baseItem.key
 
+    def pack(self, packer):
+        record = super(Item, self).pack(packer)
+        record["base_item"] = self.baseItem.key
+        record["modifiers"] = [modifier.key for modifier in self.modifiers]
+        record["owner"] = packer.actor(self.owner)
+        return record
+
+    def unpack(self, record, unpacker):
+        super(Item, self).unpack(record, unpacker)
+        self._stats = None
+        self._baseItem = unpacker.base_item(record["base_item"])
+        self._modifiers = [unpacker.item_modifier(key) for key in record["modifiers"]]
+        self._owner = unpacker.get(record["owner"])
+
 
 class Equipment(Item):
     """
@@ -1479,6 +1749,15 @@ class Consumable(Item):
             nbr += modifier.effectHitDie
         return str(nbr) + 'd' + die
 
+    @property
+    def effectDice(self):
+        """
+        The compiled HitDie of the effect that this consumable can generate, see Utilities.Dice.
+        """
+        if all(modifier.effectHitDie == 0 for modifier in self.modifiers):
+            return self.baseItem.effectDice
+        return compile_dice(self.effectHitDie)
+
     @property
     def effectDuration(self):
         """
@@ -1534,6 +1813,15 @@ class Consumable(Item):
                     self.effect.applyTo(target)
             self.stackSize -= 1
 
+    def pack(self, packer):
+        record = super(Consumable, self).pack(packer)
+        record["effect"] = packer.effect(self.effect)
+        return record
+
+    def unpack(self, record, unpacker):
+        super(Consumable, self).unpack(record, unpacker)
+        self._effect = unpacker.get(record["effect"])
+
 
 class QuestItem(Item):
     """
@@ -19,6 +19,8 @@ class WORLD:
     """
     DUNGEON_LEVELS = 10
     CAVE_LEVELS = 2
+    RESIDENT_LEVELS = 8  # Levels kept in memory before the least recently visited are hibernated, None for no limit
+    HIBERNATION_DIRECTORY = None  # Directory for the database files of hibernated levels, None for the temp directory
 
 
 class DUNGEON:
@@ -87,12 +89,44 @@ class EFFECT:
     MIND = 6
 
 
+class FOV:
+    """
+    Enumerator class to describe the algorithm used to calculate the field of view on a map.
+    """
+    RAYCASTING = 0  # Bresenham line of sight towards every tile of the map
+    SHADOWCASTING = 1  # Recursive shadowcasting, only visits tiles within range of view
+
+
+class LOD:
+    """
+    Level of detail of the AI, characters far from a player think less often. See AI.ThinkingPolicy.
+    """
+    NEAR_DISTANCE = 1.5  # Characters this close to a player (adjacent) think every tick
+    SIGHT_DISTANCE = 8  # Characters this close to a player think every SIGHT_INTERVAL ticks
+    SIGHT_INTERVAL = 2
+    FAR_INTERVAL = 5  # Ticks between the decisions of characters further away
+
+
+class RNG:
+    """
+    Enumerator with the names of the independent random streams, see Utilities.RandomStreams.
+    """
+    MAP = "map"  # Map generation
+    SPAWN = "spawn"  # Creation and placement of monsters, items and other actors
+    COMBAT = "combat"  # Combat dice
+    AI = "ai"  # AI decisions
+
+
 class GAME:
     """
     Gameplay related system parameters
     """
     QUICK_START = True
     SPEED = 1000  # Game speed in milliseconds
+    TICK = 100  # Scheduler time units in one game tick, see Scheduler
+    NORMAL_SPEED = 100  # Speed of a character that acts once every tick
+    WAKE_RADIUS = 12  # Monsters this close to a player are awake and get scheduled, see Level.update_awake()
+    ACTOR_INDEX_CELL_SIZE = 8  # Size of the cells of the spatial index of the actors on a level
 
     XP_BASE = 300
     XP_FACTOR = 1.3
@@ -3,13 +3,42 @@ Created on Apr 14, 2014
 
 @author: pi
 
-This file contains some testing code to access a sqlite database.
-It should not be used.
-Currently there are no plans to store the game data in sqlite.
+This module stores a Game or World in an sqlite database.
+Every level has its own rows, one for the level and its actors, inventories and effects, and one for its map.
+The game itself (players, libraries and random state) is stored in the world table. The rows contain the
+tables of SaveGame.Packer, objects in other rows are referred to by an id that stays the same for the life
+of the database.
+Saving only packs the levels that changed since they were last saved or loaded, see Level.version, and only
+writes the rows that changed. Levels can also be saved and loaded on their own.
 '''
+import hashlib
 import sqlite3
+import weakref
+import zlib
+
+from WarrensGame.Actors import Item
+from WarrensGame.Effects import Effect
+from WarrensGame.Levels import Level
+import WarrensGame.SaveGame as SaveGame
+
+# Version of the database layout
+SCHEMA_VERSION = 1
+
+# SQL statements, parameters are always bound so sqlite can reuse the prepared statements
+_CREATE_TABLES = [
+    "CREATE TABLE IF NOT EXISTS world (key TEXT PRIMARY KEY, value BLOB)",
+    "CREATE TABLE IF NOT EXISTS level (id INTEGER PRIMARY KEY, name TEXT, data BLOB)",
+    "CREATE TABLE IF NOT EXISTS level_map (level_id INTEGER PRIMARY KEY, data BLOB)"
+]
+_WRITE_WORLD = "INSERT OR REPLACE INTO world (key, value) VALUES (?, ?)"
+_READ_WORLD = "SELECT value FROM world WHERE key = ?"
+_WRITE_LEVEL = "INSERT OR REPLACE INTO level (id, name, data) VALUES (?, ?, ?)"
+_READ_LEVEL = "SELECT data FROM level WHERE id = ?"
+_READ_LEVELS = "SELECT id, data FROM level"
+_WRITE_MAP = "INSERT OR REPLACE INTO level_map (level_id, data) VALUES (?, ?)"
+_READ_MAP = "SELECT data FROM level_map WHERE level_id = ?"
+_READ_MAPS = "SELECT level_id, data FROM level_map"
 
-DB_FILE_NAME = "./NonGit/srd35-db-SQLite-v1.3/dnd35.db"
 
 class DatabaseError(Exception):
     def __init__(self, value):
@@ -17,7 +46,8 @@ class DatabaseError(Exception):
 
     def __str__(self):
         return repr(self.value)
-    
+
+
 class Database(object):
     '''
     This class provides a database access layer.
@@ -26,36 +56,337 @@ class Database(object):
     @property
     def db(self):
         return self._db
-    
+
     @property
-    def cursor(self):
-        return self._cursor
-
-    def __init__(self):
-        '''
-        Constructor
-        '''
-        mydatabase=DB_FILE_NAME
-        self._db = sqlite3.connect(mydatabase)
-        #this makes returned rows behave like dictionaries
-        self._db.row_factory = sqlite3.Row
-        self._cursor = self.db.cursor()
-    
-    def getMonsterData(self,monsterId):
-        '''
-        Retrieve the monster data for the provided monsterId
-        '''
-        #Read set record from database
-        QUERY = 'SELECT * ' + \
-                'FROM monster ' + \
-                'WHERE id = ' + str(monsterId)
-        print(QUERY)
-        self.cursor.execute(QUERY)
-        rows = self.cursor.fetchall()
-        print("Results:" + str(len(rows)))
-        if len(rows) == 0:
-            return None
-        elif len(rows) == 1:
-            return rows[0]
+    def file_name(self):
+        return self._file_name
+
+    def __init__(self, file_name):
+        '''
+        Constructor, opens or creates the database in write ahead log mode.
+        :param file_name: sqlite database file
+        '''
+        self._file_name = file_name
+        self._db = sqlite3.connect(file_name)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            for statement in _CREATE_TABLES:
+                self._db.execute(statement)
+            row = self._db.execute(_READ_WORLD, ("schema_version",)).fetchone()
+            if row is None:
+                self._db.execute(_WRITE_WORLD, ("schema_version", SCHEMA_VERSION))
+            elif row[0] != SCHEMA_VERSION:
+                raise DatabaseError("Unsupported database version " + str(row[0]))
+        row = self._db.execute(_READ_WORLD, ("next_id",)).fetchone()
+        self._next_id = 0 if row is None else row[0]
+        # Ids of the levels, actors and effects that were saved or loaded
+        self._ids = weakref.WeakKeyDictionary()
+        self._objects = weakref.WeakValueDictionary()
+        # Digest of every row as it was last written or read, used to skip unchanged rows
+        self._digests = {}
+        # Ids of the objects in every level row as it was last written or read
+        self._row_ids = {}
+        # Version of every level as it was last saved or loaded, used to skip levels that did not change
+        self._versions = weakref.WeakKeyDictionary()
+
+    def close(self):
+        '''
+        Closes the database connection.
+        '''
+        self._db.close()
+
+    def object_id(self, game_object):
+        '''
+        Returns the id of a level, actor or effect in this database, new objects get a new id.
+        '''
+        if game_object not in self._ids:
+            self._ids[game_object] = self._next_id
+            self._objects[self._next_id] = game_object
+            self._next_id += 1
+        return self._ids[game_object]
+
+    def get_object(self, object_id):
+        '''
+        Returns the live object with the given id, None if it is not in memory.
+        '''
+        return self._objects.get(object_id)
+
+    def save(self, owner):
+        '''
+        Saves a Game or World, only the rows that changed since the last save or load are written.
+        :param owner: Game or World object
+        :return: number of rows that were written
+        '''
+        packer = _RowPacker(owner, self)
+        rows = []
+        versions = []
+        for level in _all_levels(owner):
+            if level.hibernated and getattr(level.hibernation, "database", None) is self:
+                # The rows of a level that is hibernated in this database are up to date
+                packer.skip_row(self._stored_ids(level))
+                continue
+            if level.version is not None and self._versions.get(level) == level.version:
+                # Nothing happened on the level since it was saved or loaded, it is not packed again
+                packer.skip_row(self._stored_ids(level))
+                continue
+            rows.extend(self._level_rows(packer, level))
+            versions.append((level, level.version))
+        # The world row gets everything that is not stored with a level
+        rows.append((_WRITE_WORLD, "world", "owner", packer.pack_owner_row(owner)))
+        written = 0
+        with self._db:
+            for statement, table, key, record in rows:
+                written += self._write_row(statement, table, key, record)
+            self._db.execute(_WRITE_WORLD, ("next_id", self._next_id))
+        self._remember_versions(versions)
+        return written
+
+    def save_level(self, owner, level):
+        '''
+        Saves a single level, its map and the actors, inventories and effects on it.
+        Objects on other levels are only referred to.
+        :param owner: Game or World that owns the level
+        :param level: Level object
+        :return: number of rows that were written
+        '''
+        packer = _RowPacker(owner, self)
+        written = 0
+        rows = self._level_rows(packer, level)
+        version = level.version
+        with self._db:
+            for statement, table, key, record in rows:
+                written += self._write_row(statement, table, key, record)
+            self._db.execute(_WRITE_WORLD, ("next_id", self._next_id))
+        self._remember_versions([(level, version)])
+        return written
+
+    def load(self, owner):
+        '''
+        Loads a Game or World, the current state of the owner is replaced.
+        :param owner: Game or World object of the same type as the one that was saved
+        :return: None
+        '''
+        row = self._db.execute(_READ_WORLD, ("owner",)).fetchone()
+        if row is None:
+            raise DatabaseError("No game saved in " + self.file_name)
+        tables = self._read_row("world", "owner", row[0])
+        for level_id, data in self._db.execute(_READ_LEVELS):
+            self._merge(tables, self._read_row("level", level_id, data))
+        maps = {level_id: self._read_row("level_map", level_id, data)
+                for level_id, data in self._db.execute(_READ_MAPS)}
+        for level_id, level_record in tables["levels"].items():
+            level_record["map"] = maps.get(level_id)
+        unpacker = SaveGame.Unpacker(tables)
+        unpacker.unpack_owner(owner)
+        self._remember_objects(unpacker)
+
+    def load_level(self, owner, level):
+        '''
+        Loads a single level that was saved before, the level object is filled in again.
+        Objects on other levels that are referred to have to be in memory.
+        :param owner: Game or World that owns the level
+        :param level: Level object
+        :return: None
+        '''
+        level_id = self.object_id(level)
+        tables = self._stored_level(level)
+        row = self._db.execute(_READ_MAP, (level_id,)).fetchone()
+        tables["levels"][level_id]["map"] = None if row is None else self._read_row("level_map", level_id, row[0])
+        unpacker = _RowUnpacker(tables, self)
+        unpacker.unpack_tables(owner, owner.monster_library, owner.item_library)
+        self._remember_objects(unpacker)
+
+    def _remember_objects(self, unpacker):
+        '''
+        Keeps track of the ids and the level versions of the objects that were loaded.
+        '''
+        for object_id, game_object in unpacker.objects.items():
+            self._ids[game_object] = object_id
+            self._objects[object_id] = game_object
+        self._remember_versions([(game_object, game_object.version) for game_object in unpacker.objects.values()
+                                 if isinstance(game_object, Level)])
+
+    def _remember_versions(self, versions):
+        '''
+        Keeps the versions of levels that are stored as they are now, levels that are awake have no version.
+        :param versions: list of (level, version)
+        '''
+        for level, version in versions:
+            if version is None:
+                self._versions.pop(level, None)
+            else:
+                self._versions[level] = version
+
+    def _stored_ids(self, level):
+        '''
+        Returns the ids of the objects in the stored row of a level.
+        '''
+        level_id = self.object_id(level)
+        if level_id not in self._row_ids:
+            # Reading the row keeps track of its ids
+            self._stored_level(level)
+        return self._row_ids[level_id]
+
+    def _stored_level(self, level):
+        '''
+        Reads the tables in the row of a level.
+        '''
+        level_id = self.object_id(level)
+        row = self._db.execute(_READ_LEVEL, (level_id,)).fetchone()
+        if row is None:
+            raise DatabaseError("Level " + level.name + " is not saved in " + self.file_name)
+        return self._read_row("level", level_id, row[0])
+
+    def _level_rows(self, packer, level):
+        '''
+        Packs the rows of a level, the map is stored in a row of its own.
+        :return: list of (statement, table, key, record)
+        '''
+        tables = packer.pack_level_row(level)
+        level_id = self.object_id(level)
+        map_record = tables["levels"][level_id].pop("map")
+        return [(_WRITE_LEVEL, "level", level_id, tables),
+                (_WRITE_MAP, "level_map", level_id, map_record)]
+
+    def _write_row(self, statement, table, key, record):
+        '''
+        Writes a row if it changed since it was last written or read.
+        :return: 1 if the row was written, 0 otherwise
+        '''
+        data = SaveGame.dump_record(record)
+        digest = hashlib.sha1(data).digest()
+        if table == "level":
+            self._row_ids[key] = _row_ids(record)
+        if self._digests.get((table, key)) == digest:
+            return 0
+        if statement == _WRITE_LEVEL:
+            self._db.execute(statement, (key, record["levels"][key]["name"], zlib.compress(data)))
         else:
-            raise DatabaseError("Multiple occurences of id " + str(monsterId) + " in monster table.")
\ No newline at end of file
+            self._db.execute(statement, (key, zlib.compress(data)))
+        self._digests[(table, key)] = digest
+        return 1
+
+    def _read_row(self, table, key, data):
+        data = zlib.decompress(data)
+        self._digests[(table, key)] = hashlib.sha1(data).digest()
+        record = SaveGame.load_record(data)
+        if table == "level":
+            self._row_ids[key] = _row_ids(record)
+        return record
+
+    @staticmethod
+    def _merge(tables, row_tables):
+        for table_name in ["levels", "actors", "effects"]:
+            tables[table_name].update(row_tables[table_name])
+
+
+class _RowPacker(SaveGame.Packer):
+    '''
+    Packer that only packs the objects that belong to one row, other objects are referred to by their database id.
+    '''
+
+    def __init__(self, owner, database):
+        super(_RowPacker, self).__init__(owner)
+        self._database = database
+        self._row_level = None
+        self._packed = set()
+
+    def index(self, game_object):
+        return self._database.object_id(game_object)
+
+    def packs(self, game_object):
+        object_id = self.index(game_object)
+        if object_id in self._packed:
+            return False
+        if self._row_level is not None and _row_level(game_object) is not self._row_level:
+            return False
+        self._packed.add(object_id)
+        return True
+
+    def skip_row(self, object_ids):
+        '''
+        Marks the objects of a stored row as packed, they are only referred to.
+        '''
+        self._packed.update(object_ids)
+
+    def pack_level_row(self, level):
+        '''
+        Packs a level and the objects that belong to it.
+        '''
+        self._row_level = level
+        self.levels, self.actors, self.effects = {}, {}, {}
+        self.level(level)
+        return {"levels": self.levels, "actors": self.actors, "effects": self.effects}
+
+    def pack_owner_row(self, owner):
+        '''
+        Packs the Game or World and the objects that were not packed with a level.
+        '''
+        self._row_level = None
+        self.levels, self.actors, self.effects = {}, {}, {}
+        return self.pack_owner(owner)
+
+
+class _RowUnpacker(SaveGame.Unpacker):
+    '''
+    Unpacker for a single row, objects that are still in memory are filled in again instead of recreated
+    and objects of other rows are taken from memory.
+    '''
+
+    def __init__(self, tables, database):
+        self._database = database
+        super(_RowUnpacker, self).__init__(tables)
+
+    def create(self, index, record):
+        game_object = self._database.get_object(index)
+        if game_object is not None:
+            return game_object
+        return super(_RowUnpacker, self).create(index, record)
+
+    def get(self, index):
+        if index is None or index in self.objects:
+            return super(_RowUnpacker, self).get(index)
+        game_object = self._database.get_object(index)
+        if game_object is None:
+            raise DatabaseError("Object " + str(index) + " is not in memory")
+        return game_object
+
+
+def _row_ids(tables):
+    '''
+    Returns the ids of the objects in the tables of a row.
+    '''
+    return frozenset(object_id for table_name in ["levels", "actors", "effects"] for object_id in tables[table_name])
+
+
+def _all_levels(owner):
+    '''
+    Returns the levels of a Game or World, including the sub levels.
+    '''
+    levels = []
+    to_visit = list(owner.levels)
+    while len(to_visit) > 0:
+        level = to_visit.pop(0)
+        levels.append(level)
+        to_visit.extend(level.subLevels)
+    return levels
+
+
+def _row_level(game_object):
+    '''
+    Returns the level in whose row a level, actor or effect is stored, None for the world row.
+    Actors belong to the level they are on, items in an inventory belong to the level of their owner.
+    '''
+    if isinstance(game_object, Level):
+        return game_object
+    if isinstance(game_object, Effect):
+        return game_object.owner
+    actor = game_object
+    while actor is not None:
+        if actor.level is not None:
+            return actor.level
+        if actor.tile is not None:
+            return actor.tile.map.level
+        actor = actor.owner if isinstance(actor, Item) else None
+    return None
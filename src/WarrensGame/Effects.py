@@ -5,8 +5,8 @@ This ranges from magical effects to melee effects and healing effectss.
 
 import WarrensGame.AI
 from WarrensGame.Maps import Tile
-from WarrensGame.Utilities import roll_hit_die, GameError, message
-from WarrensGame.CONSTANTS import EFFECT
+from WarrensGame.Utilities import GameError, message
+from WarrensGame.CONSTANTS import EFFECT, GAME, RNG
 
 
 class TARGET:
@@ -83,6 +83,13 @@ class Effect(object):
         """
         return self.source.effectHitDie
 
+    @property
+    def effectDice(self):
+        """
+        Compiled hit die of this effect, see Utilities.Dice.
+        """
+        return self.source.effectDice
+
     @property
     def effectDuration(self):
         """
@@ -109,6 +116,19 @@ class Effect(object):
         """
         return self.source.effectElement
 
+    @property
+    def action_delay(self):
+        """
+        Time until the next tick of this effect, effects tick once every game tick. See Scheduler.
+        """
+        return GAME.TICK
+
+    def scheduled(self, delay):
+        """
+        Called by the scheduler when this effect is scheduled, effects don't need to know their delay.
+        """
+        pass
+
     def __init__(self, source, owner):
         """
         Constructor for a new Effect, meant to be used by the Effect subclasses.
@@ -116,13 +136,13 @@ class Effect(object):
         """
         self._source = source
         self._owner = owner
-        self.owner.active_effects.append(self)
         self._tiles = []
         self._actors = []
         self._targetType = TARGET.SELF
         self._effectDuration = self.source.effectDuration
         self._effectDescription = "Description not set"
         self._sceneObject = None
+        self.owner.addEffect(self)
 
     def applyTo(self, target):
         """
@@ -141,11 +161,65 @@ class Effect(object):
         if self.effectDuration <= 0:
             self.end()
 
+    def fast_forward(self, ticks):
+        """
+        Skips a number of ticks at once, used when a level catches up with the time it slept.
+        The effect ends if it runs out.
+        """
+        self.effectDuration -= ticks
+        if self.effectDuration <= 0:
+            self.end()
+
     def end(self):
         """
         Clean up at the end of the effect.
         """
-        self.owner.active_effects.remove(self)
+        self.owner.removeEffect(self)
+
+    def leave_map(self):
+        """
+        Forgets the tiles of this effect, used when the map of the level is dropped from memory.
+        See Level.hibernate().
+        """
+        self._tiles = []
+
+    def pack(self, packer):
+        """
+        Returns the state of this effect in plain values, tiles are stored by their coordinates.
+        See SaveGame.Packer.
+        """
+        record = {
+            "class": type(self).__name__,
+            "source": packer.actor(self.source),
+            "owner": packer.level(self.owner),
+            "tiles": [(tile.x, tile.y) for tile in self.tiles],
+            "actors": [packer.actor(actor) for actor in self.actors],
+            "target_type": self.targetType,
+            "duration": self.effectDuration,
+            "description": self.effectDescription,
+            "center": None,
+            "map": None
+        }
+        if len(self.tiles) > 0:
+            record["map"] = packer.level(self.tiles[0].map.level)
+        return record
+
+    def unpack(self, record, unpacker):
+        """
+        Fills in this effect from the result of pack(), the effect was created without calling its constructor.
+        The maps of the levels have to be unpacked already.
+        """
+        self._source = unpacker.get(record["source"])
+        self._owner = unpacker.get(record["owner"])
+        self._tiles = []
+        if record["map"] is not None:
+            tiles = unpacker.get(record["map"]).map.tiles
+            self._tiles = [tiles[x][y] for x, y in record["tiles"]]
+        self._actors = [unpacker.get(index) for index in record["actors"]]
+        self._targetType = record["target_type"]
+        self._effectDuration = record["duration"]
+        self._effectDescription = record["description"]
+        self._sceneObject = None
 
 
 class HealEffect(Effect):
@@ -175,9 +249,9 @@ class HealEffect(Effect):
         :return: None
         """
         super(HealEffect, self).tick()
-        # Apply healing
-        for target in self.actors:
-            heal_amount = roll_hit_die(self.effectHitDie)
+        # Apply healing, the dice are rolled for all targets at once
+        heal_amounts = self.effectDice.roll_many(len(self.actors), self.owner.random_streams.stream(RNG.COMBAT))
+        for target, heal_amount in zip(self.actors, heal_amounts):
             target.takeHeal(heal_amount, self.source)
             target.state_healing = True
 
@@ -213,7 +287,7 @@ class ConfuseEffect(Effect):
             raise GameError("Can not apply confuse effect to " + str(target))
         confused_turns = self.effectDuration
         WarrensGame.AI.ConfusedMonsterAI(self, target, confused_turns)
-        target.level.active_effects.append(self)
+        target.level.addEffect(self)
         self.actors.append(target)
         message(target.name + ' is confused for ' + str(confused_turns) + ' turns.', "GAME")
 
@@ -291,20 +365,31 @@ class DamageEffect(Effect):
         if self.effectDuration > 0:
             # Reduce the remaining duration with one tick.
             self.effectDuration -= 1
-            # Find all targets in range
-            self._actors = []
-            for tile in self.tiles:
-                for actor in tile.actors:
-                    self.actors.append(actor)
-            # apply damage to every target
-            for target in self.actors:
-                damage_amount = roll_hit_die(self.effectHitDie)
+            # Find all targets in range, the actor index of the level narrows down the actors to look at
+            tiles = set(self.tiles)
+            level = self.centerTile.map.level
+            self._actors = [actor for actor in level.actors_within_radius(self.centerTile.x, self.centerTile.y,
+                                                                          self.effectRadius + 1)
+                            if actor.tile in tiles]
+            # apply damage to every target, the dice are rolled for all targets at once
+            damage_amounts = self.effectDice.roll_many(len(self.actors),
+                                                           level.random_streams.stream(RNG.COMBAT))
+            for target, damage_amount in zip(self.actors, damage_amounts):
                 message(self.source.name.capitalize() + ' hits '
                         + target.name + ' for ' + str(damage_amount) + ' Damage.', "GAME")
                 target.takeDamage(damage_amount, self.source.owner)
                 # Modify actor states
                 self._set_actor_state(target, True)
 
+    def fast_forward(self, ticks):
+        """
+        Skips a number of ticks at once, the actors that were hit in the last tick are no longer hit.
+        """
+        for previous_target in self.actors:
+            self._set_actor_state(previous_target, False)
+        self._actors = []
+        super(DamageEffect, self).fast_forward(ticks)
+
     def _set_actor_state(self, actor, new_state):
         """
         Private helper routine to set the proper state on target actors to True or False.
@@ -319,3 +404,21 @@ class DamageEffect(Effect):
             actor.state_earth_damage = new_state
         else:
             print("Warning: No state change available for " + str(self.effectElement))
+
+    def leave_map(self):
+        super(DamageEffect, self).leave_map()
+        self._centerTile = None
+
+    def pack(self, packer):
+        record = super(DamageEffect, self).pack(packer)
+        if self.centerTile is not None:
+            record["center"] = (self.centerTile.x, self.centerTile.y)
+            record["map"] = packer.level(self.centerTile.map.level)
+        return record
+
+    def unpack(self, record, unpacker):
+        super(DamageEffect, self).unpack(record, unpacker)
+        self._centerTile = None
+        if record["center"] is not None:
+            x, y = record["center"]
+            self._centerTile = unpacker.get(record["map"]).map.tiles[x][y]
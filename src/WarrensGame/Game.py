@@ -6,6 +6,9 @@ Created on Apr 13, 2014
 from WarrensGame.Levels import *
 from WarrensGame.Libraries import *
 from WarrensGame.Maps import *
+import WarrensGame.SaveGame as SaveGame
+from WarrensGame.Scheduler import Scheduler
+from WarrensGame.AI import ThinkingPolicy
 
 
 class Game(object):
@@ -53,6 +56,20 @@ class Game(object):
         self._currentLevel = level
         Utilities.game_event("Level", level.json)
 
+    @property
+    def scheduler(self):
+        """
+        The scheduler that decides which characters and effects act in a turn.
+        """
+        return self._scheduler
+
+    @property
+    def thinking_policy(self):
+        """
+        The level of detail policy of the AI in this game, see AI.ThinkingPolicy.
+        """
+        return self._thinking_policy
+
     @property
     def monster_library(self):
         """
@@ -67,6 +84,13 @@ class Game(object):
         """
         return self._itemLibrary
 
+    @property
+    def random_streams(self):
+        """
+        The random streams of this game, see Utilities.RandomStreams.
+        """
+        return self._random_streams
+
     def __init__(self):
         """
         Constructor to create a new game
@@ -76,9 +100,47 @@ class Game(object):
         self._player = None
         self._levels = []
         self._currentLevel = None
+        self._scheduler = Scheduler()
+        self._thinking_policy = ThinkingPolicy()
+        self._random_streams = Utilities.RandomStreams()
         # Initialize libraries
-        self._monsterLibrary = MonsterLibrary()
-        self._itemLibrary = ItemLibrary()
+        self._monsterLibrary = MonsterLibrary(self.random_streams)
+        self._itemLibrary = ItemLibrary(self.random_streams)
+
+    def level_generated(self, level):
+        """
+        Called by a level when it was generated, a game keeps all its levels in memory.
+        :param level: Level that was generated
+        :return: None
+        """
+        pass
+
+    def pack(self, packer):
+        """
+        Returns the state of the game in plain values, see SaveGame.Packer.
+        :param packer: SaveGame.Packer that packs the levels, actors and effects
+        :return: Dictionary
+        """
+        record = packer.owner_record(self)
+        record["current_level"] = packer.level(self.current_level)
+        record["player"] = packer.actor(self.player)
+        record["state"] = self.state
+        return record
+
+    def unpack(self, record, unpacker):
+        """
+        Replaces the state of the game with the result of pack().
+        :param record: Dictionary created by pack()
+        :param unpacker: SaveGame.Unpacker that provides the levels, actors and effects
+        :return: None
+        """
+        self._scheduler = Scheduler(record["scheduler_time"])
+        self._monsterLibrary, self._itemLibrary = unpacker.unpack_libraries(self, record)
+        self._levels = [unpacker.get(index) for index in record["levels"]]
+        self._currentLevel = unpacker.get(record["current_level"])
+        self._player = unpacker.get(record["player"])
+        self._state = record["state"]
+        self.random_streams.setstate(record["random_streams"])
 
     def setup_debug_game(self):
         """
@@ -87,6 +149,7 @@ class Game(object):
         """
         # Create some maps to debug
         self._levels = []
+        self._scheduler = Scheduler()
 
         # Debug town level
         level_name = "Debugging Level"
@@ -106,12 +169,15 @@ class Game(object):
         # Clear up
         Utilities.reset_utility_queues()
         self._levels = []
+        self._scheduler = Scheduler()
 
         # Generate a town level
         level_name = "Town"
         level_difficulty = 1
         Utilities.message("Creating level: " + level_name + '(difficulty:' + str(level_difficulty) + ')', "GENERATION")
         town = TownLevel(self, level_difficulty, level_name)
+        # The town is where the player starts, the other levels are generated when they are first visited
+        town.generate()
         self._levels.append(town)
         self._currentLevel = town
 
@@ -152,11 +218,11 @@ class Game(object):
             # Add portal in previous level to current level
             down_portal = Portal('>', 'stairs down', 'You follow the stairs down, looking for more adventure.')
             down_portal.sprite_id = SPRITES.STAIRS_DOWN
-            down_portal.moveToLevel(lvl, lvl.getRandomEmptyTile())
+            lvl.placePortal(down_portal)
             # Add portal in current level to previous level
             up_portal = Portal('<', 'stairs up', 'You follow the stairs up, hoping to find the exit.')
             up_portal.sprite_id = SPRITES.STAIRS_UP
-            up_portal.moveToLevel(dungeon_level, dungeon_level.getRandomEmptyTile())
+            dungeon_level.placePortal(up_portal)
             # Connect the two portals
             down_portal.connectTo(up_portal)
 
@@ -179,10 +245,10 @@ class Game(object):
             pit_message = 'You jump into the pit. As you fall deeper and deeper, you realize you didn\'t ' \
                       'think about how to get back out afterward...'
             down_portal = Portal('>', 'Pit', pit_message)
-            down_portal.moveToLevel(lvl, lvl.getRandomEmptyTile())
+            lvl.placePortal(down_portal)
             # create a portal in the new cave that leads back
             up_portal = Portal('<', 'Opening above', 'After great difficulties you manage to get out of the pit.')
-            up_portal.moveToLevel(cave_level, cave_level.getRandomEmptyTile())
+            cave_level.placePortal(up_portal)
             # connect the two portals
             down_portal.connectTo(up_portal)
 
@@ -191,7 +257,7 @@ class Game(object):
         Reset the player for this game.
         :return : None
         """
-        self._player = Player()
+        self._player = Player(self.random_streams.stream(RNG.SPAWN))
         first_level = self.levels[0]
         self.player.moveToLevel(first_level, first_level.getRandomEmptyTile())
 
@@ -242,21 +308,20 @@ class Game(object):
 
     def load_game(self, file_name):
         """
-        Loads game state from a file
+        Loads game state from a file, see SaveGame for the file format.
+        Nothing is generated, the levels, actors and effects are restored as they were saved.
         :param file_name: File to load from.
         :return : None
         """
-        # TODO: Implement loading of game state
-        raise NotImplementedError("Can't load from " + file_name + ". Loading not implemented.")
+        SaveGame.load_game(self, file_name)
 
     def save_game(self, file_name):
         """
-        Saves state of current game to a file.
+        Saves state of current game to a file, see SaveGame for the file format.
         :param file_name: File to save to.
         :return : None
         """
-        # TODO: Implement saving of game state
-        raise NotImplementedError("Can't save to " + file_name + ". Saving not implemented.")
+        SaveGame.save_game(self, file_name)
 
     def try_to_play_turn(self):
         """
@@ -267,24 +332,11 @@ class Game(object):
         """
         # Wait for player to take action
         if self.player.actionTaken:
-            # Let characters take a turn
-            for c in self.current_level.characters:
-                assert isinstance(c, Character)
-                if c.state_alive:
-                    c.takeTurn()
-                    c.actionTaken = False
+            # The action of the player takes one tick, the characters and effects that are due act
+            self.player.actionTaken = False
+            self.scheduler.advance(CONSTANTS.GAME.TICK)
             # Update field of view
             self.current_level.map.updateFieldOfView(self.player.tile.x, self.player.tile.y)
-            # Let effects tick
-            to_remove = []
-            for effect in self.current_level.active_effects:
-                if effect.effectDuration <= 0:
-                    to_remove.append(effect)
-                else:
-                    effect.tick()
-            # Remove effects that are no longer active
-            for effect in to_remove:
-                self.current_level.active_effects.remove(effect)
             # Broadcast game state
             self.broadcast_game_state()
             return True
@@ -305,11 +357,7 @@ class Game(object):
             return []
         elif seeker_actor.baseItem.effect == "DamageEffect":
             # Target can be an Actor or a Tile
-            targets = []
-            for tile in self.current_level.map.visible_tiles:
-                for actor in tile.actors:
-                    if isinstance(actor, Actor):
-                        targets.append(actor)
+            targets = self._visible_actors(Actor)
             targets.extend(self.current_level.map.visible_tiles)
             return targets
         elif seeker_actor.baseItem.effect == "HealEffect":
@@ -318,11 +366,15 @@ class Game(object):
             return [self.player]
         elif seeker_actor.baseItem.effect == "ConfuseEffect":
             # Target has to be of type Monster
-            targets = []
-            for tile in self.current_level.map.visible_tiles:
-                for actor in tile.actors:
-                    if isinstance(actor, Monster):
-                        targets.append(actor)
-            return targets
+            return self._visible_actors(Monster)
         else:
             raise GameError("Unknown effect type")
+
+    def _visible_actors(self, actor_type):
+        """
+        Returns the actors of the given type that the player can see, they are within range of view of the player.
+        """
+        level = self.current_level
+        tile = self.player.tile
+        return [actor for actor in level.actors_within_radius(tile.x, tile.y, level.map.range_of_view, actor_type)
+                if actor.tile.inView]
@@ -3,20 +3,26 @@ Created on Apr 13, 2014
 
 @author: pi
 """
+from collections import OrderedDict
 
 
 class Inventory(object):
     """
     This class represents an inventory of Items.
     It will stack incoming items if they are stackable.
+    Items are indexed by their stack key, see stack_key(), so finding, adding and removing an item and counting
+    the items don't need to look at the other items.
     """
 
     @property
     def items(self):
         """
-        Basic array of all items in this inventory
+        List of all items in this inventory, in the order in which they were added.
+        The list is kept until the inventory changes, use add() and remove() instead of changing it.
         """
-        return self._items
+        if self._item_list is None:
+            self._item_list = list(self._items)
+        return self._item_list
 
     @property
     def owner(self):
@@ -40,7 +46,12 @@ class Inventory(object):
         :param actor: Actor owning this inventory
         """
         self._json = {}
-        self._items = []
+        # Stack key of every item, in the order in which the items were added
+        self._items = OrderedDict()
+        self._item_list = None
+        # Items per stack key, in the order in which they were added
+        self._stacks = {}
+        self._item_count = 0
         self._owner = actor
 
     def __str__(self):
@@ -49,26 +60,34 @@ class Inventory(object):
         :return: Multiline String
         """
         out = ""
-        for item in self.items:
+        for item in self._items:
             if item.stackable:
                 out += item.name + " (stack: " + str(item.stackSize) + ") "
             else:
                 out += item.name + " "
         return out
 
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
     @property
     def item_count(self):
         """
-        Calculate the number of items in this inventory. This will include the stacksize in the totals.
+        The number of items in this inventory. This will include the stacksize in the totals.
         :return: Integer
         """
-        count = 0
-        for item in self.items:
-            if item.stackable:
-                count += item.stackSize
-            else:
-                count += 1
-        return count
+        return self._item_count
+
+    @staticmethod
+    def stack_key(item):
+        """
+        Items with the same base item and the same modifiers have the same stack key.
+        :return: (item key, sorted tuple of modifier keys)
+        """
+        return item.key, tuple(sorted(modifier.key for modifier in item.modifiers))
 
     def add(self, item):
         """
@@ -83,15 +102,27 @@ class Inventory(object):
             existing_item = self.find(item)
             if existing_item is None:
                 # If there is no existing item just add the new one
-                self.items.append(item)
-                self.json[id(item)] = item.json
+                self.insert(item)
             else:
                 # Item already exists, increase the stack with one
                 existing_item.stackSize += 1
         else:
             # Add non stackable item
-            self.items.append(item)
-            self.json[id(item)] = item.json
+            self.insert(item)
+
+    def insert(self, item):
+        """
+        Puts an item in this inventory as it is, without stacking it.
+        This is used when an inventory is restored from a save game.
+        :param item: item to be added
+        :return: None
+        """
+        key = self.stack_key(item)
+        self._items[item] = key
+        self._item_list = None
+        self._stacks.setdefault(key, []).append(item)
+        self._item_count += self._count(item)
+        self.json[id(item)] = item.json
 
     def remove(self, item):
         """
@@ -108,7 +139,9 @@ class Inventory(object):
                 found_item.stackSize -= 1
             else:
                 # remove the item
-                self.items.remove(found_item)
+                self._remove_from_stack(found_item, self._items.pop(found_item))
+                self._item_list = None
+                self._item_count -= self._count(found_item)
                 del self.json[id(found_item)]
 
     def find(self, item):
@@ -119,13 +152,44 @@ class Inventory(object):
         :param item: Item to search for
         :return:Item or None
         """
-        for available_item in self.items:
-            # Same base item
-            if available_item.key == item.key:
-                available_mod_keys = [mod.key for mod in available_item.modifiers]
-                available_mod_keys.sort()
-                item_mod_keys = [mod.key for mod in item.modifiers]
-                item_mod_keys.sort()
-                if str(available_mod_keys) == str(item_mod_keys):
-                    return available_item
-        return None
+        stack = self._stacks.get(self.stack_key(item))
+        if stack is None:
+            return None
+        return stack[0]
+
+    def stack_size_changed(self, item, difference):
+        """
+        Keeps the item count up to date when the stack size of an item changes, see Item.stackSize.
+        :param item: item of which the stack size changed
+        :param difference: change of the stack size
+        :return: None
+        """
+        if item.stackable and item in self._items:
+            self._item_count += difference
+
+    def modifiers_changed(self, item):
+        """
+        Moves an item to the stack of its new stack key after its modifiers changed, see Item.add_modifier().
+        :param item: item of which the modifiers changed
+        :return: None
+        """
+        old_key = self._items.get(item)
+        if old_key is None:
+            return
+        key = self.stack_key(item)
+        if key != old_key:
+            self._remove_from_stack(item, old_key)
+            self._items[item] = key
+            self._stacks.setdefault(key, []).append(item)
+
+    def _remove_from_stack(self, item, key):
+        stack = self._stacks[key]
+        stack.remove(item)
+        if len(stack) == 0:
+            del self._stacks[key]
+
+    @staticmethod
+    def _count(item):
+        if item.stackable:
+            return item.stackSize
+        return 1
@@ -1,10 +1,19 @@
 #!/usr/bin/python
 
+import itertools
 import random
+from collections import OrderedDict
 
-from WarrensGame.Actors import Portal, Player, NPC
+from WarrensGame.Actors import Portal, Character, Player, NPC, Monster
+from WarrensGame.AI import DIRECTIONS
 import WarrensGame.CONSTANTS as CONSTANTS
+from WarrensGame.CONSTANTS import RNG
 import WarrensGame.Maps as Maps
+import WarrensGame.Utilities as Utilities
+from WarrensGame.Utilities import GameError
+
+# Source of the level versions, every change gets a number that was never used before, see Level.version
+_versions = itertools.count(1)
 
 
 class Level(object):
@@ -25,47 +34,117 @@ class Level(object):
         """
         The name of the level.
         """
-        return self.json["name"]
+        return self._json["name"]
 
     @property
     def difficulty(self):
         """
         The difficulty of this level.
         """
-        return self.json["difficulty"]
+        return self._json["difficulty"]
+
+    @property
+    def seed(self):
+        """
+        The seed that is used to generate this level.
+        """
+        return self._seed
+
+    @property
+    def generated(self):
+        """
+        Boolean indicating if this level has been generated, see generate().
+        """
+        return self._generated
+
+    @property
+    def hibernated(self):
+        """
+        Boolean indicating if this level is hibernated, its map and actors are dropped from memory, see hibernate().
+        """
+        return self._hibernation is not None
+
+    @property
+    def hibernation(self):
+        """
+        The storage that holds this level while it is hibernated, None if the level is in memory.
+        """
+        return self._hibernation
+
+    @property
+    def asleep(self):
+        """
+        Boolean indicating if this level is asleep, its characters and effects are not scheduled, see sleep().
+        """
+        return self._asleep_since is not None
+
+    @property
+    def version(self):
+        """
+        Number that changes when something happens on this level, a saved copy of the level is up to date as long
+        as the version stays the same. A level that is awake can change at every tick, its version is None.
+        """
+        if self._asleep_since is None:
+            return None
+        return self._version
 
     @property
     def map(self):
         """
-        The map of this level
+        The map of this level, the level is generated or rehydrated when its map is needed.
         """
+        if self._hibernation is not None:
+            self.rehydrate()
+        elif not self._generated:
+            self.generate()
         return self._map
 
     @map.setter
     def map(self, new_map):
         self._map = new_map
-        self.json["map"] = new_map.json
+        self._actor_index = None
+
+    @property
+    def awake_characters(self):
+        """
+        The characters within GAME.WAKE_RADIUS of a player, only these are scheduled. See update_awake().
+        """
+        return list(self._awake)
 
     @property
     def portals(self):
         """
         The portals on this level
         """
-        return self._portals
+        return list(self._portals)
 
     @property
     def characters(self):
         """
-        The characters on this level
+        The characters on this level, in the order in which they arrived
         """
-        return self._characters
+        return list(self._characters)
 
     @property
     def players(self):
         """
         The players on this level
         """
-        return [player for player in self.characters if isinstance(player, Player)]
+        return list(self._players)
+
+    @property
+    def monsters(self):
+        """
+        The monsters on this level
+        """
+        return list(self._monsters)
+
+    @property
+    def npcs(self):
+        """
+        The NPCs on this level
+        """
+        return list(self._npcs)
 
     @property
     def player_present(self):
@@ -73,16 +152,31 @@ class Level(object):
         Property that indicates if a player is present on this level.
         :return: Boolean
         """
-        if len(self.players) > 0:
-            return True
-        return False
+        return len(self._players) > 0
+
+    @property
+    def flow_field(self):
+        """
+        Distance field towards the nearest player on this level, see Map.distance_field().
+        It is shared by all monsters on this level and only recalculated when a player moved
+        or when tiles of the map became blocked or unblocked.
+        :return: array of distances or None if there is no map
+        """
+        if self.map is None:
+            return None
+        player_tiles = [player.tile for player in self.players if player.tile is not None]
+        flow_field_key = (tuple((tile.x, tile.y) for tile in player_tiles), self.map.blocked_version)
+        if flow_field_key != self._flow_field_key:
+            self._flow_field = self.map.distance_field(player_tiles)
+            self._flow_field_key = flow_field_key
+        return self._flow_field
 
     @property
     def items(self):
         """
         The items on this level
         """
-        return self._items
+        return list(self._items)
 
     @property
     def subLevels(self):
@@ -91,6 +185,27 @@ class Level(object):
         """
         return self._subLevels
 
+    @property
+    def scheduler(self):
+        """
+        The scheduler of the Game or World that owns this level.
+        """
+        return self.owner.scheduler
+
+    @property
+    def thinking_policy(self):
+        """
+        The level of detail policy of the AI of the Game or World that owns this level, see AI.ThinkingPolicy.
+        """
+        return self.owner.thinking_policy
+
+    @property
+    def random_streams(self):
+        """
+        The random streams of the Game or World that owns this level, see Utilities.RandomStreams.
+        """
+        return self.owner.random_streams
+
     @property
     def active_effects(self):
         """
@@ -104,28 +219,265 @@ class Level(object):
         """
         Json dictionary representation of the Level.
         This will contain the data elements that are needed for the game client to function.
+        The map representation is only created when the json is requested.
         :return: Json dictionary object
         """
+        if self._map is not None:
+            self._json["map"] = self._map.json
         return self._json
     
-    def __init__(self, owner, difficulty, name):
+    def __init__(self, owner, difficulty, name, seed=None):
         """
         Constructor to create a new level.
+        The level is only a stub, the map and the actors on it are created by generate().
         Arguments
             owner - Game object that owns this level
             difficulty - Difficulty of this level
             name - a textual name for this level
+            seed - seed for the generation of this level, a random seed is used if None
         """
         self._json = {}
         self._owner = owner
-        self.json["name"] = name
-        self.json["difficulty"] = difficulty
+        if seed is None:
+            seed = self.random_streams.stream(RNG.MAP).getrandbits(32)
+        self._seed = seed
+        self._generated = False
+        self._json["name"] = name
+        self._json["difficulty"] = difficulty
         self._map = None
-        self._portals = []
-        self._characters = []
-        self._items = []
+        # Ordered dictionaries of the actors on this level, characters are also kept per type
+        self._portals = OrderedDict()
+        self._characters = OrderedDict()
+        self._players = OrderedDict()
+        self._monsters = OrderedDict()
+        self._npcs = OrderedDict()
+        self._items = OrderedDict()
         self._subLevels = []
         self._activeEffects = []
+        self._flow_field = None
+        self._flow_field_key = None
+        self._hibernation = None
+        self._asleep_since = None
+        self._version = next(_versions)
+        # Spatial index of the actors on the map and the characters that are near a player
+        self._actor_index = None
+        self._awake = OrderedDict()
+
+    @property
+    def map_recipe(self):
+        """
+        Tuple (map class, keyword arguments) that describes how the map of this level is created.
+        The arguments don't refer to other game objects so the map can be built in another process.
+        To be implemented by the sub classes.
+        """
+        raise GameError("Missing implementation map_recipe")
+
+    def generate(self, built_map=None):
+        """
+        Generates the map of this level and populates it.
+        Levels start out as stubs, this is called when the level is needed for the first time
+        (for example when a player follows a portal to it). Generation is driven by the seed
+        of the level so the result does not depend on when it happens. The map and spawn random streams
+        are seeded for the level and restored afterwards.
+        Arguments
+            built_map - optional result of build_level_map() for this level, for example built in another process
+        """
+        if self._generated:
+            return
+        self._generated = True
+        map_random = self.random_streams.stream(RNG.MAP)
+        spawn_random = self.random_streams.stream(RNG.SPAWN)
+        random_states = (map_random.getstate(), spawn_random.getstate())
+        try:
+            if built_map is None:
+                map_class, map_arguments = self.map_recipe
+                built_map = build_level_map(self.seed, map_class, map_arguments)
+            new_map, generation_state = built_map
+            # Continue with the state in which the map generation ended
+            map_random.setstate(generation_state)
+            spawn_random.seed(Utilities.derive_seed(self.seed, RNG.SPAWN))
+            new_map.level = self
+            self.map = new_map
+            self._prepareMap()
+            # Place the portals that were added while this level was a stub
+            for portal in self.portals:
+                if portal.tile is None:
+                    self._placePortal(portal)
+            self._populate()
+        finally:
+            map_random.setstate(random_states[0])
+            spawn_random.setstate(random_states[1])
+        self.owner.level_generated(self)
+        if not self.player_present:
+            self.sleep()
+
+    def sleep(self):
+        """
+        Takes the characters and effects of this level off the scheduler, this happens when there are no players
+        on the level. The level catches up with the time it slept when it wakes up, see wake().
+        """
+        if self._asleep_since is not None:
+            return
+        self._asleep_since = self.scheduler.time
+        self._changed()
+        for effect in self.active_effects:
+            self.scheduler.unschedule(effect)
+        for character in self.characters:
+            self.scheduler.unschedule(character)
+        self._awake = OrderedDict()
+
+    def wake(self):
+        """
+        Makes this level ready for a player to arrive. It is generated on the first visit and rehydrated if it
+        is hibernated. A level that was asleep catches up with the ticks it slept in one step and its characters
+        and effects are scheduled again.
+        """
+        if self._hibernation is not None:
+            self.rehydrate()
+        elif not self._generated:
+            self.generate()
+        if self._asleep_since is not None:
+            ticks = (self.scheduler.time - self._asleep_since) // CONSTANTS.GAME.TICK
+            self._asleep_since = None
+            self._catch_up(ticks)
+            self.schedule_actors()
+
+    def _changed(self):
+        """
+        Gives this level a new version, called when actors or effects arrive, leave or move. See version.
+        """
+        self._version = next(_versions)
+
+    def _catch_up(self, ticks):
+        """
+        Moves this level forward by a number of ticks without playing them, timers advance in bulk and effects
+        that ran out end.
+        """
+        if ticks <= 0:
+            return
+        for effect in list(self.active_effects):
+            effect.fast_forward(ticks)
+        for character in self.characters:
+            character.fast_forward(ticks)
+
+    def hibernate(self, storage):
+        """
+        Drops the map and the actors of this level from memory. The level has to be saved in the storage first,
+        the storage loads it again when rehydrate() is called. The portals and sub levels stay, portals on other
+        levels lead to them, but the portals are no longer on a tile.
+        Arguments
+            storage - object with a rehydrate(level) method, for example a World.LevelManager
+        """
+        if self.player_present:
+            raise GameError("Can't hibernate level " + self.name + ", there are players on it.")
+        for effect in self._activeEffects:
+            self.scheduler.unschedule(effect)
+        for character in self._characters:
+            self.scheduler.unschedule(character)
+        # Nothing may keep a reference to the map
+        for column in self._map.tiles:
+            for tile in column:
+                for actor in tile.actors:
+                    actor.leave_map()
+        for effect in self._activeEffects:
+            effect.leave_map()
+        self._map = None
+        self._json.pop("map", None)
+        self._characters = OrderedDict()
+        self._players = OrderedDict()
+        self._monsters = OrderedDict()
+        self._npcs = OrderedDict()
+        self._items = OrderedDict()
+        self._activeEffects = []
+        self._flow_field = None
+        self._flow_field_key = None
+        self._actor_index = None
+        self._awake = OrderedDict()
+        self._hibernation = storage
+
+    def rehydrate(self):
+        """
+        Loads a hibernated level back into memory.
+        """
+        storage = self._hibernation
+        if storage is not None:
+            self._hibernation = None
+            storage.rehydrate(self)
+
+    def pack(self, packer):
+        """
+        Returns the state of this level in plain values, including its map and the actors on its tiles.
+        Other objects are referred to by their index, see SaveGame.Packer.
+        """
+        # The objects of a hibernated level have to be in memory to be packed
+        self.rehydrate()
+        record = {
+            "class": type(self).__name__,
+            "name": self.name,
+            "difficulty": self.difficulty,
+            "seed": self.seed,
+            "generated": self.generated,
+            "asleep_since": self._asleep_since,
+            "map": None,
+            "tile_actors": [],
+            "portals": [packer.actor(portal) for portal in self.portals],
+            "characters": [packer.actor(character) for character in self.characters],
+            "items": [packer.actor(item) for item in self.items],
+            "effects": [packer.effect(effect) for effect in self.active_effects],
+            "sub_levels": [packer.level(sub_level) for sub_level in self.subLevels]
+        }
+        if self.generated:
+            level_map = self.map
+            record["map"] = level_map.pack()
+            for column in level_map.tiles:
+                for tile in column:
+                    if len(tile.actors) > 0:
+                        record["tile_actors"].append((tile.x, tile.y, [packer.actor(actor) for actor in tile.actors]))
+        return record
+
+    def unpack(self, record, unpacker, owner):
+        """
+        Fills in this level from the result of pack(), the level was created without calling its constructor.
+        The actors are put back on the map by unpack_tile_actors().
+        """
+        # The level constructors only initialize attributes, the base constructor is enough for every level type
+        Level.__init__(self, owner, record["difficulty"], record["name"], record["seed"])
+        self._generated = record["generated"]
+        self._asleep_since = record["asleep_since"]
+        if record["map"] is not None:
+            self.map = unpacker.map(record["map"], self)
+        for table_name in ["portals", "characters", "items"]:
+            for index in record[table_name]:
+                self.register(unpacker.get(index))
+        self._activeEffects.extend(unpacker.get(index) for index in record["effects"])
+        self._subLevels.extend(unpacker.get(index) for index in record["sub_levels"])
+
+    def unpack_tile_actors(self, record, unpacker):
+        """
+        Puts the unpacked actors back on the tiles of the map, in their original order.
+        """
+        for x, y, actor_indexes in record["tile_actors"]:
+            tile = self._map.tiles[x][y]
+            for index in actor_indexes:
+                unpacker.get(index).unpack_tile(tile)
+
+    def _prepareMap(self):
+        """
+        Makes level specific changes to a freshly built map, can be overridden by the sub classes.
+        """
+        pass
+
+    def _placePortal(self, portal):
+        """
+        Puts a portal that was added before generation on the map, by default on a random empty tile.
+        """
+        portal.moveToTile(self.getRandomEmptyTile())
+
+    def _populate(self):
+        """
+        Adds actors to the generated map, can be overridden by the sub classes.
+        """
+        pass
 
     def removeActor(self, myActor):
         """
@@ -133,30 +485,204 @@ class Level(object):
         arguments
             myActor - the actor that should be removed
         """
-        for c in self.characters:
-            if c is myActor:
-                self.characters.remove(c)
-        for i in self.items:
-            if i is myActor:
-                self.items.remove(i)
+        self._changed()
+        if myActor in self._characters:
+            del self._characters[myActor]
+            self._character_registry(myActor).pop(myActor, None)
+            self.scheduler.unschedule(myActor)
+            self._awake.pop(myActor, None)
+        self._items.pop(myActor, None)
+        if self._actor_index is not None:
+            self._actor_index.discard(myActor)
+        # The level sleeps when the last player leaves
+        if isinstance(myActor, Player) and not self.player_present:
+            self.sleep()
+
+    def register(self, actor):
+        """
+        Adds an actor to the registries of this level without waking or scheduling anything.
+        The add methods use this, a save game uses it directly when it restores a level.
+        """
+        self._changed()
+        if isinstance(actor, Portal):
+            self._portals[actor] = None
+        elif isinstance(actor, Character):
+            self._characters[actor] = None
+            self._character_registry(actor)[actor] = None
+        else:
+            self._items[actor] = None
+
+    def _character_registry(self, character):
+        """
+        Returns the dictionary with the characters of the same type as the given one.
+        """
+        if isinstance(character, Player):
+            return self._players
+        if isinstance(character, Monster):
+            return self._monsters
+        if isinstance(character, NPC):
+            return self._npcs
+        # Characters of other types are only in the characters registry
+        return {}
 
     def addPortal(self, portal):
         """
         Register the given portal to this level.
         """
-        self.portals.append(portal)
+        self.register(portal)
+
+    def placePortal(self, portal):
+        """
+        Puts the given portal on a random empty tile of this level.
+        If this level is not generated yet the portal is placed during generation.
+        """
+        portal.level = self
+        if self.generated:
+            portal.moveToTile(self.getRandomEmptyTile())
 
     def addCharacter(self, character):
         """
-        Register the given character to this level.
+        Register the given character to this level, it is scheduled when it moves near a player.
+        A player wakes up the level.
         """
-        self.characters.append(character)
+        self.register(character)
+        if self._asleep_since is not None and isinstance(character, Player):
+            self.wake()
+
+    def addEffect(self, effect):
+        """
+        Register the given effect to this level and schedule it.
+        """
+        self._changed()
+        if effect not in self.active_effects:
+            self.active_effects.append(effect)
+        if self._asleep_since is None:
+            self.scheduler.schedule(effect)
+
+    def removeEffect(self, effect):
+        """
+        Remove the given effect from this level.
+        """
+        self._changed()
+        if effect in self.active_effects:
+            self.active_effects.remove(effect)
+        self.scheduler.unschedule(effect)
+
+    def schedule_actors(self):
+        """
+        Schedules the effects and the awake characters of this level, used when the level is loaded.
+        Nothing is scheduled while the level is asleep.
+        """
+        if self._asleep_since is not None:
+            return
+        for effect in self.active_effects:
+            self.scheduler.schedule(effect)
+        self._awake = OrderedDict()
+        self.update_awake()
+
+    @property
+    def actor_index(self):
+        """
+        Spatial index of the actors on the map of this level, it is kept up to date when actors move.
+        :return: Utilities.SpatialGrid
+        """
+        if self._actor_index is None:
+            self._actor_index = Utilities.SpatialGrid(CONSTANTS.GAME.ACTOR_INDEX_CELL_SIZE)
+            for column in self.map.tiles:
+                for tile in column:
+                    for actor in tile.actors:
+                        self._actor_index.add(actor, tile.x, tile.y)
+        return self._actor_index
+
+    def actors_within_radius(self, x, y, radius, actor_type=None):
+        """
+        Returns the actors within a radius around (x, y).
+        :param actor_type: optional class, only actors of this type are returned
+        """
+        actors = self.actor_index.within_radius(x, y, radius)
+        if actor_type is not None:
+            actors = [actor for actor in actors if isinstance(actor, actor_type)]
+        return actors
+
+    def actors_in_rect(self, x1, y1, x2, y2, actor_type=None):
+        """
+        Returns the actors in the rectangle from (x1, y1) to (x2, y2), borders included.
+        :param actor_type: optional class, only actors of this type are returned
+        """
+        actors = self.actor_index.within_rect(x1, y1, x2, y2)
+        if actor_type is not None:
+            actors = [actor for actor in actors if isinstance(actor, actor_type)]
+        return actors
+
+    def nearest_actor(self, x, y, actor_type=None, max_distance=None):
+        """
+        Returns the actor closest to (x, y), None if there is none.
+        :param actor_type: optional class, only actors of this type are considered
+        :param max_distance: optional maximum distance
+        """
+        accept = None
+        if actor_type is not None:
+            def accept(actor):
+                return isinstance(actor, actor_type)
+        return self.actor_index.nearest(x, y, accept, max_distance)
+
+    def actor_moved(self, actor):
+        """
+        Keeps the actor index and the awake characters up to date, called when an actor moves to a tile
+        of this level.
+        """
+        self._changed()
+        if self._actor_index is not None:
+            self._actor_index.add(actor, actor.tile.x, actor.tile.y)
+        if isinstance(actor, Player):
+            self.update_awake()
+        elif isinstance(actor, Character) and self._asleep_since is None:
+            self._set_awake(actor, self._near_player(actor))
+
+    def update_awake(self):
+        """
+        Determines the characters within GAME.WAKE_RADIUS of a player. Characters that wake up are scheduled,
+        the ones that fall asleep are taken off the scheduler.
+        """
+        if self._asleep_since is not None or self._map is None:
+            return
+        awake = OrderedDict()
+        for player in self.players:
+            if player.tile is None:
+                continue
+            for character in self.actors_within_radius(player.tile.x, player.tile.y, CONSTANTS.GAME.WAKE_RADIUS,
+                                                       Character):
+                if not isinstance(character, Player):
+                    awake[character] = None
+        for character in self._awake:
+            if character not in awake:
+                self.scheduler.unschedule(character)
+        for character in awake:
+            if character not in self._awake:
+                self.scheduler.schedule(character)
+            else:
+                # Characters that came closer to a player think sooner
+                delay = character.action_delay
+                if delay is not None:
+                    self.scheduler.reschedule(character, delay)
+        self._awake = awake
+
+    def _near_player(self, character):
+        return self.nearest_actor(character.tile.x, character.tile.y, Player, CONSTANTS.GAME.WAKE_RADIUS) is not None
+
+    def _set_awake(self, character, awake):
+        if awake and character not in self._awake:
+            self._awake[character] = None
+            self.scheduler.schedule(character)
+        elif not awake and character in self._awake:
+            del self._awake[character]
+            self.scheduler.unschedule(character)
 
     def addItem(self, item):
         """
         Register the given item to this level.
         """
-        self.items.append(item)
+        self.register(item)
 
     def getRandomEmptyTile(self):
         """
@@ -166,17 +692,34 @@ class Level(object):
             return None
         return self.map.getRandomEmptyTile()
 
-    def tick(self):
+    def flow_step(self, tile):
         """
-        Move time forward for this level.
-        :return: None
+        Returns the neighbouring tile that is one step closer to the nearest player according to the flow field.
+        Unoccupied tiles are preferred over tiles that already contain an actor.
+        Returns None if the players can not be reached from the given tile or if it is already next to a player.
         """
-        for level in self.subLevels:
-            level.tick()
-        for effect in self.active_effects:
-            effect.tick()
-        for character in self.characters:
-            character.tick()
+        flow_field = self.flow_field
+        if flow_field is None:
+            return None
+        width = self.map.width
+        height = self.map.height
+        distance = flow_field[tile.x * height + tile.y]
+        if distance <= 1:
+            return None
+        best_tile = None
+        best_key = None
+        for dx, dy in DIRECTIONS:
+            x = tile.x + dx
+            y = tile.y + dy
+            if 0 <= x < width and 0 <= y < height:
+                step_distance = flow_field[x * height + y]
+                if 0 <= step_distance < distance:
+                    step_tile = self.map.tiles[x][y]
+                    step_key = (len(step_tile.actors) > 0, step_distance)
+                    if best_key is None or step_key < best_key:
+                        best_tile = step_tile
+                        best_key = step_key
+        return best_tile
 
 
 class DungeonLevel(Level):
@@ -184,18 +727,23 @@ class DungeonLevel(Level):
     Class representing a randomly generated dungeon level.
     """
 
-    def __init__(self, owner, difficulty, name):
+    def __init__(self, owner, difficulty, name, seed=None):
         """
         Constructor to create a new generated level.
         Arguments
             owner - Game object that owns this level
             difficulty - Difficulty of this level
             name - a textual name for this level
+            seed - seed for the generation of this level
         """
         # call constructor of super class
-        super(DungeonLevel, self).__init__(owner, difficulty, name)
-        # generate the map
-        self.map = Maps.DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT, self)
+        super(DungeonLevel, self).__init__(owner, difficulty, name, seed)
+
+    @property
+    def map_recipe(self):
+        return Maps.DungeonMap, {}
+
+    def _populate(self):
         # add some monsters
         self._placeMonsters()
         # add some items
@@ -208,25 +756,11 @@ class DungeonLevel(Level):
         """
         # Grab the MonsterLibrary
         lib = self.owner.monster_library
-        # max number of monsters per room
-        max_monsters = lib.max_monsters_per_room(self.difficulty)
-
-        # generate monsters for every room
-        for room in self.map.rooms:
-            # choose random number of monsters to create
-            num_monsters = random.randrange(0, max_monsters)
-            for i in range(num_monsters + 1):
-                # choose random spot for new monster
-                x = random.randrange(room.x1 + 1, room.x2 - 1)
-                y = random.randrange(room.y1 + 1, room.y2 - 1)
-                target_tile = self.map.tiles[x][y]
-
-                # only place it if the tile is not blocked and empty
-                if not target_tile.blocked and target_tile.empty:
-
-                    # get a random monster
-                    new_monster = lib.get_random_monster(self.difficulty)
-                    new_monster.moveToLevel(self, target_tile)
+        # choose the tiles for the monsters, then create all monsters at once
+        target_tiles = self._spawnTiles(lib.max_monsters_per_room(self.difficulty))
+        new_monsters = lib.get_random_monsters(self.difficulty, len(target_tiles))
+        for new_monster, target_tile in zip(new_monsters, target_tiles):
+            new_monster.moveToLevel(self, target_tile)
 
     def _placeItems(self):
         """
@@ -235,25 +769,32 @@ class DungeonLevel(Level):
         """
         # Grab the ItemLibrary
         lib = self.owner.item_library
-        # max number of items per room
-        max_items = lib.max_items_per_room(self.difficulty)
+        # choose the tiles for the items, then create all items at once
+        target_tiles = self._spawnTiles(lib.max_items_per_room(self.difficulty))
+        new_items = lib.get_random_items(self.difficulty, len(target_tiles))
+        for new_item, target_tile in zip(new_items, target_tiles):
+            new_item.moveToLevel(self, target_tile)
 
-        # generate items for every room
+    def _spawnTiles(self, max_per_room):
+        """
+        Chooses a random number of random tiles in every room, the tiles are not blocked, empty and all different.
+        :param max_per_room: maximum number of tiles per room
+        :return: list of tiles
+        """
+        spawn_random = self.random_streams.stream(RNG.SPAWN)
+        positions = {}
         for room in self.map.rooms:
-            # choose random number of items to create
-            num_items = random.randrange(0, max_items)
-            for i in range(num_items + 1):
-                # choose random spot for new item
-                x = random.randrange(room.x1 + 1, room.x2 - 1)
-                y = random.randrange(room.y1 + 1, room.y2 - 1)
+            # choose random number of spots
+            num_spots = spawn_random.randrange(0, max_per_room)
+            for i in range(num_spots + 1):
+                # choose random spot
+                x = spawn_random.randrange(room.x1 + 1, room.x2 - 1)
+                y = spawn_random.randrange(room.y1 + 1, room.y2 - 1)
                 target_tile = self.map.tiles[x][y]
-
-                # only place it if the tile is not blocked and empty
+                # only use it if the tile is not blocked and empty
                 if not target_tile.blocked and target_tile.empty:
-
-                    # get a random item
-                    new_item = lib.get_random_item(self.difficulty)
-                    new_item.moveToLevel(self, target_tile)
+                    positions[(x, y)] = target_tile
+        return list(positions.values())
 
 
 class TownLevel(Level):
@@ -261,18 +802,23 @@ class TownLevel(Level):
     Class representing a randomly generated town level.
     """
 
-    def __init__(self, owner, difficulty, name):
+    def __init__(self, owner, difficulty, name, seed=None):
         """
         Constructor to create a new generated level.
         Arguments
             owner - Game object that owns this level
             difficulty - Difficulty of this level
             name - a textual name for this level
+            seed - seed for the generation of this level
         """
         # call constructor of super class
-        super(TownLevel, self).__init__(owner, difficulty, name)
-        # generate the map
-        self.map = Maps.TownMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT, self)
+        super(TownLevel, self).__init__(owner, difficulty, name, seed)
+
+    @property
+    def map_recipe(self):
+        return Maps.TownMap, {}
+
+    def _populate(self):
         # generate sublevels for the houses
         for house in self.map.houses:
             self.generateHouseInterior(house)
@@ -291,7 +837,7 @@ class TownLevel(Level):
                 for x in [house.x1, house.x2]
                 for y in range(house.y1 + 1, house.y2 - 1)]
         #Select actual location randomly
-        doorX, doorY = random.choice(doorLocations)
+        doorX, doorY = self.random_streams.stream(RNG.SPAWN).choice(doorLocations)
         doorTile = self.map.tiles[doorX][doorY]
         #Cut a hole in the wall for the door (this time in the town map)
         doorTile.blocked = False
@@ -300,25 +846,15 @@ class TownLevel(Level):
         #Create the door that leads into the house
         doorIn = Portal('>', 'door', 'You enter the house.')
         doorIn.moveToLevel(self, doorTile)
-        #Generate the level that represents the interior of the house
-        houseLevel = SingleRoomLevel(self.owner, self.difficulty, 'house', house)
+        #Create the level that represents the interior of the house, it is generated when it is entered
+        houseLevel = SingleRoomLevel(self.owner, self.difficulty, 'house', house, (doorX, doorY))
         self.subLevels.append(houseLevel)
-        doorTile = houseLevel.map.tiles[doorX][doorY]
-        #Cut a hole in the wall for the door (this time in the House map)
-        doorTile.blocked = False
-        doorTile.blockSight = False
-        doorTile.material = Maps.MaterialType.DOOR
         #Create the door that leads out of the house
         doorOut = Portal('<', 'door', 'You leave the house.')
-        doorOut.moveToLevel(houseLevel, doorTile)
+        houseLevel.placePortal(doorOut)
         #Connect the two doors
         doorIn.connectTo(doorOut)
 
-        #Add an NPC in the house
-        tile = houseLevel.getRandomEmptyTile()
-        npc = NPC()
-        npc.moveToLevel(houseLevel, tile)
-
 
 class SingleRoomLevel(Level):
     """
@@ -326,12 +862,54 @@ class SingleRoomLevel(Level):
     It can for example be used to represent the interior of a house
     arguments
         area - the area that represents the room
+        door - optional (x, y) position of the door in the wall of the room, portals are placed on it
     """
-    def __init__(self, owner, difficulty, name, area):
+    def __init__(self, owner, difficulty, name, area, door=None, seed=None):
         #call constructor of super class
-        super(SingleRoomLevel, self).__init__(owner, difficulty, name)
-        #generate the map
-        self.map = Maps.SingleRoomMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT, self, area)
+        super(SingleRoomLevel, self).__init__(owner, difficulty, name, seed)
+        self._area = area
+        self._door = door
+
+    @property
+    def map_recipe(self):
+        #The map only needs the outline of the room, not the map it was taken from
+        area = self._area
+        room = Maps.Room(None, area.x1, area.y1, area.x2 - area.x1, area.y2 - area.y1)
+        return Maps.SingleRoomMap, {"myRoom": room}
+
+    def pack(self, packer):
+        record = super(SingleRoomLevel, self).pack(packer)
+        area = self._area
+        record["area"] = (area.x1, area.y1, area.x2, area.y2)
+        record["door"] = self._door
+        return record
+
+    def unpack(self, record, unpacker, owner):
+        super(SingleRoomLevel, self).unpack(record, unpacker, owner)
+        x1, y1, x2, y2 = record["area"]
+        self._area = Maps.Room(None, x1, y1, x2 - x1, y2 - y1)
+        self._door = record["door"]
+
+    def _prepareMap(self):
+        if self._door is not None:
+            doorTile = self.map.tiles[self._door[0]][self._door[1]]
+            #Cut a hole in the wall for the door
+            doorTile.blocked = False
+            doorTile.blockSight = False
+            doorTile.material = Maps.MaterialType.DOOR
+
+    def _placePortal(self, portal):
+        #Portals are put on the door
+        if self._door is not None:
+            portal.moveToTile(self.map.tiles[self._door[0]][self._door[1]])
+        else:
+            super(SingleRoomLevel, self)._placePortal(portal)
+
+    def _populate(self):
+        #Add an NPC in the house
+        tile = self.getRandomEmptyTile()
+        npc = NPC(self.random_streams.stream(RNG.SPAWN))
+        npc.moveToLevel(self, tile)
 
 
 class CaveLevel(Level):
@@ -339,18 +917,23 @@ class CaveLevel(Level):
     Class representing a randomly generated cave level.
     """
     
-    def __init__(self, owner, difficulty, name):
+    def __init__(self, owner, difficulty, name, seed=None):
         """
         Constructor to create a new generated level.
         Arguments
             owner - Game object that owns this level
             difficulty - Difficulty of this level
             name - a textual name for this level
+            seed - seed for the generation of this level
         """
         #call constructor of super class
-        super(CaveLevel, self).__init__(owner, difficulty, name)
-        #generate the map
-        self.map = Maps.CaveMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT, self)
+        super(CaveLevel, self).__init__(owner, difficulty, name, seed)
+
+    @property
+    def map_recipe(self):
+        return Maps.CaveMap, {}
+
+    def _populate(self):
         #add some monsters
         self._placeMonsters()
         #add some items
@@ -360,9 +943,25 @@ class CaveLevel(Level):
         #Grab the MonsterLibrary
         lib = self.owner.monster_library
         #Randomly determine nbr of monsters
-        nbr = random.randrange(0, 4)
+        nbr = self.random_streams.stream(RNG.SPAWN).randrange(0, 4)
         for i in range(0, nbr):
             randTile = self.map.getRandomEmptyTile()
+            if randTile is None:
+                break
             new_monster = lib.generate_monster(2)
             new_monster.moveToLevel(self, randTile)
-            
\ No newline at end of file
+            
+
+
+def build_level_map(seed, map_class, map_arguments):
+    """
+    Builds a level map the same way Level.generate() does, without a link to the level.
+    This function can run in another process, the map and random state can be passed back to Level.generate().
+    Arguments
+        seed - seed of the level
+        map_class, map_arguments - the map recipe of the level, see Level.map_recipe
+    Returns a tuple with the new map and the state of the map random stream after building it.
+    """
+    map_random = random.Random(seed)
+    new_map = map_class(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT, level=None, rng=map_random, **map_arguments)
+    return new_map, map_random.getstate()
@@ -1,8 +1,10 @@
 import csv
-import random
+import itertools
+import weakref
+from operator import itemgetter
 from WarrensGame.Actors import *
-from WarrensGame.CONSTANTS import CONFIG, EFFECT
-from WarrensGame.Utilities import GameError
+from WarrensGame.CONSTANTS import CONFIG, EFFECT, RNG
+from WarrensGame.Utilities import GameError, random_stream, compile_dice
 
 
 class BaseMonster(dict):
@@ -18,6 +20,8 @@ class BaseMonster(dict):
         """
         super(BaseMonster, self).__init__(*args, **kwargs)
         self.__dict__ = self
+        # The hit die is parsed once, monsters roll the compiled dice
+        self.hitDice = compile_dice(self.hitdie)
 
 
 class MonsterModifier(dict):
@@ -52,9 +56,10 @@ class MonsterLibrary:
     @property
     def regular_monsters(self):
         """
-        Returns a list of all created regular Monster objects
+        Returns a list of the created regular Monster objects that are still in memory, in order of creation.
+        The library only keeps weak references, the monsters of hibernated levels are dropped from memory.
         """
-        return self._regularMonsters
+        return [monster for monster, sequence in sorted(self._regularMonsters.items(), key=itemgetter(1))]
 
     @property
     def monsters(self):
@@ -93,12 +98,26 @@ class MonsterLibrary:
         """
         return self._challengeIndex
 
-    def __init__(self):
+    def __init__(self, random_streams=None):
+        """
+        Constructor to create a new monster library
+        :param random_streams: RandomStreams of the game that owns the library, the default streams are used if None
+        """
+        # Random stream used to select and create monsters
+        if random_streams is None:
+            self._random = random_stream(RNG.SPAWN)
+        else:
+            self._random = random_streams.stream(RNG.SPAWN)
         # Initialize class variables
         self._uniqueMonsters = []
-        self._regularMonsters = []
+        # Regular monster -> sequence number of its registration, see regular_monsters
+        self._regularMonsters = weakref.WeakKeyDictionary()
+        self._sequence = itertools.count()
         self._monsterIndex = {}
         self._challengeIndex = {}
+        self._uniqueKeys = set()
+        # Monsters that can be selected per maximum challenge rating, see _spawn_table()
+        self._spawnTables = {}
 
         # Read data from CSV file
         with open(CONFIG.DATA_MONSTERS) as csvfile:
@@ -133,18 +152,38 @@ class MonsterLibrary:
             max_monsters = 1
         return max_monsters
 
+    def _spawn_table(self, max_challenge_rating):
+        """
+        Returns the tuple of base monsters from which a random monster is selected.
+        The tables are kept until the challenge index changes, when a unique monster is created.
+        """
+        table = self._spawnTables.get(max_challenge_rating)
+        if table is None:
+            challenge_rating = max_challenge_rating
+            while challenge_rating not in self.challenge_index.keys():
+                challenge_rating -= 1
+                if challenge_rating <= 0:
+                    raise GameError("No monsters available below the give challenge rating")
+            table = tuple(self.challenge_index[challenge_rating])
+            self._spawnTables[max_challenge_rating] = table
+        return table
+
     def get_random_monster(self, max_challenge_rating):
-        # Determine possibilities
-        while max_challenge_rating not in self.challenge_index.keys():
-            max_challenge_rating -= 1
-            if max_challenge_rating <= 0:
-                raise GameError("No monsters available below the give challenge rating")
-        # Make a random choice
-        possibilities = self.challenge_index[max_challenge_rating]
-        selection = random.choice(possibilities)
-        # create the monster
-        monster = self.create_monster(selection.key)
-        return monster
+        return self.get_random_monsters(max_challenge_rating, 1)[0]
+
+    def get_random_monsters(self, max_challenge_rating, count):
+        """
+        Creates a number of random monsters at once.
+        :param max_challenge_rating: maximum challenge rating of the monsters
+        :param count: number of monsters
+        :return: list of Monsters
+        """
+        monsters = []
+        for i in range(count):
+            # The spawn table is looked up for every monster, it changes when a unique monster is created
+            selection = self._random.choice(self._spawn_table(max_challenge_rating))
+            monsters.append(self.create_monster(selection.key))
+        return monsters
 
     def create_monster(self, monster_key):
         """
@@ -156,28 +195,48 @@ class MonsterLibrary:
         base_monster = self.monster_index[monster_key]
 
         # do not create multiple unique monsters
-        if base_monster.unique:
-            unique_keys = []
-            for unique_monster in self.unique_monsters:
-                unique_keys.append(unique_monster.key)
-            if monster_key in unique_keys:
-                # This unique was already created, do nothing
-                raise GameError('Unique monster' + monster_key + ' already exists.')
+        if base_monster.unique and monster_key in self._uniqueKeys:
+            # This unique was already created, do nothing
+            raise GameError('Unique monster' + monster_key + ' already exists.')
 
         # Create monster
-        new_monster = Monster(base_monster)
+        new_monster = Monster(base_monster, self._random)
 
         # register the monster
         if base_monster.unique:
-            self.unique_monsters.append(new_monster)
-            # Avoid randomly recreating the same unique monster in the future
-            self.challenge_index[base_monster.challengeRating].remove(base_monster)
-            if len(self.challenge_index[base_monster.challengeRating]) == 0:
-                del self.challenge_index[base_monster.challengeRating]
+            self.register_unique_monster(new_monster)
         else:
-            self.regular_monsters.append(new_monster)
+            self.register_regular_monster(new_monster)
         return new_monster
 
+    def register_regular_monster(self, monster):
+        """
+        Registers an existing regular monster, this is used when a saved game or a hibernated level is loaded.
+        Registering a monster again changes nothing.
+        :param monster: Monster
+        :return: None
+        """
+        if monster not in self._regularMonsters:
+            self._regularMonsters[monster] = next(self._sequence)
+
+    def register_unique_monster(self, monster):
+        """
+        Registers an existing unique monster, it will not be created again.
+        This is also used when a saved game is loaded.
+        :param monster: Monster
+        :return: None
+        """
+        base_monster = self.monster_index.get(monster.key, monster.baseMonster)
+        self.unique_monsters.append(monster)
+        self._uniqueKeys.add(monster.key)
+        # Avoid randomly recreating the same unique monster in the future
+        possibilities = self.challenge_index.get(base_monster.challengeRating, [])
+        if base_monster in possibilities:
+            possibilities.remove(base_monster)
+            if len(possibilities) == 0:
+                del self.challenge_index[base_monster.challengeRating]
+            self._spawnTables.clear()
+
     def generate_monster(self, difficulty):
         """
         Completely random generation of a monster, not based on the csv data file.
@@ -202,11 +261,11 @@ class MonsterLibrary:
 
         # Create monster
         base_monster = BaseMonster(monster_data)
-        new_monster = Monster(base_monster)
+        new_monster = Monster(base_monster, self._random)
         new_monster.sprite_overlay_id = SPRITES.EFFECT_GREEN_DUST
 
         # Register the monster
-        self.regular_monsters.append(new_monster)
+        self.register_regular_monster(new_monster)
         return new_monster
 
 
@@ -223,6 +282,10 @@ class BaseItem(dict):
         """
         super(BaseItem, self).__init__(*args, **kwargs)
         self.__dict__ = self
+        # The effect hit die is parsed once, effects roll the compiled dice
+        self.effectDice = None
+        if self.effectHitDie != "None":
+            self.effectDice = compile_dice(self.effectHitDie)
 
 
 class ItemModifier(dict):
@@ -249,9 +312,10 @@ class ItemLibrary:
     @property
     def items(self):
         """
-        Returns a list of all created items
+        Returns a list of the created items that are still in memory, in order of creation.
+        The library only keeps weak references, the items of hibernated levels are dropped from memory.
         """
-        return self._items
+        return [item for item, sequence in sorted(self._items.items(), key=itemgetter(1))]
 
     @property
     def available_items(self):
@@ -301,16 +365,27 @@ class ItemLibrary:
         """
         return self._modifierLevelIndex
 
-    def __init__(self):
+    def __init__(self, random_streams=None):
         """
         Constructor to create a new item library
+        :param random_streams: RandomStreams of the game that owns the library, the default streams are used if None
         """
+        # Random stream used to select items and modifiers
+        if random_streams is None:
+            self._random = random_stream(RNG.SPAWN)
+        else:
+            self._random = random_streams.stream(RNG.SPAWN)
         # Initialize class variables
-        self._items = []
+        # Item -> sequence number of its registration, see items
+        self._items = weakref.WeakKeyDictionary()
+        self._sequence = itertools.count()
         self._itemIndex = {}
         self._itemLevelIndex = {}
         self._modifierIndex = {}
         self._modifierLevelIndex = {}
+        # Items and modifiers that can be selected per maximum level, see _item_spawn_table()
+        self._itemSpawnTables = {}
+        self._modifierSpawnTables = {}
 
         # read item data from CSV file
         with open(CONFIG.DATA_ITEMS) as csvfile:
@@ -388,14 +463,24 @@ class ItemLibrary:
             modifier_data = self.modifier_index[modifier_key]
             mod = ItemModifier(modifier_data)
             if base_item.type == mod.type:
-                new_item.modifiers.append(mod)
+                new_item.add_modifier(mod)
             else:
                 raise GameError("Incompatible item modifier type. Can not apply " + modifier_key + " to " + item_key)
 
         # register the new item
-        self.items.append(new_item)
+        self.register_item(new_item)
         return new_item
 
+    def register_item(self, item):
+        """
+        Registers an existing item, this is used when a saved game or a hibernated level is loaded.
+        Registering an item again changes nothing.
+        :param item: Item
+        :return: None
+        """
+        if item not in self._items:
+            self._items[item] = next(self._sequence)
+
     @staticmethod
     def max_items_per_room(difficulty):
         # Maximum number of items per room
@@ -404,56 +489,78 @@ class ItemLibrary:
             max_items = 1
         return max_items
 
+    def _item_spawn_table(self, max_item_level):
+        """
+        Returns (item level, tuple of item data) from which a random item is selected, the tables are kept.
+        """
+        table = self._itemSpawnTables.get(max_item_level)
+        if table is None:
+            # Determine max item level at which items are available
+            item_level = max_item_level
+            while item_level not in self.item_level_index.keys():
+                item_level -= 1
+                if item_level <= 0:
+                    raise GameError("No items available below the give item level")
+            # Determine possibilities
+            possibilities = []
+            for level in [item_level, item_level + 1, item_level - 1, item_level - 2]:
+                possibilities.extend(self.item_level_index.get(level, []))
+            table = (item_level, tuple(possibilities))
+            self._itemSpawnTables[max_item_level] = table
+        return table
+
+    def _modifier_spawn_table(self, max_modifier_level):
+        """
+        Returns the tuple of modifier data from which a random modifier is selected, the tables are kept.
+        """
+        table = self._modifierSpawnTables.get(max_modifier_level)
+        if table is None:
+            # Determine max modifier level at which modifiers are available
+            modifier_level = max_modifier_level
+            while modifier_level not in self.modifier_level_index.keys():
+                modifier_level -= 1
+                if modifier_level <= 0:
+                    raise GameError("No modifiers available below the give modifier level")
+            # Determine possibilities
+            possibilities = []
+            for level in [modifier_level, modifier_level + 1, modifier_level - 1, modifier_level - 2]:
+                possibilities.extend(self.modifier_level_index.get(level, []))
+            # Include negative modifiers
+            for key in self.modifier_level_index.keys():
+                if key <= 0:
+                    possibilities.extend(self.modifier_level_index[key])
+            table = tuple(possibilities)
+            self._modifierSpawnTables[max_modifier_level] = table
+        return table
+
     def get_random_item(self, max_item_level):
-        # Determine max item level at which items are available
-        item_level = max_item_level
-        while item_level not in self.item_level_index.keys():
-            item_level -= 1
-            if item_level <= 0:
-                raise GameError("No items available below the give item level")
-        # Determine possibilities
-        possibilities = []
-        possibilities.extend(self.item_level_index[item_level])
-        if item_level + 1 in self.item_level_index.keys():
-            possibilities.extend(self.item_level_index[item_level + 1])
-        if item_level - 1 in self.item_level_index.keys():
-            possibilities.extend(self.item_level_index[item_level - 1])
-        if item_level - 2 in self.item_level_index.keys():
-            possibilities.extend(self.item_level_index[item_level - 2])
-        # Make a random choice
-        selection = random.choice(possibilities)
-        # Create the item
-        new_item = self.create_item(selection.key)
-        # Apply modifiers
-        max_modifier_level = max_item_level - item_level + 1
-        if max_modifier_level > 0:
-            modifier = self.get_random_modifier(max_modifier_level)
-            if new_item.type == modifier.type:
-                new_item.modifiers.append(modifier)
-        return new_item
+        return self.get_random_items(max_item_level, 1)[0]
+
+    def get_random_items(self, max_item_level, count):
+        """
+        Creates a number of random items at once.
+        :param max_item_level: maximum item level of the items
+        :param count: number of items
+        :return: list of Items
+        """
+        item_level, possibilities = self._item_spawn_table(max_item_level)
+        selections = [self._random.choice(possibilities) for i in range(count)]
+        new_items = []
+        for selection in selections:
+            # Create the item
+            new_item = self.create_item(selection.key)
+            # Apply modifiers
+            max_modifier_level = max_item_level - item_level + 1
+            if max_modifier_level > 0:
+                modifier = self.get_random_modifier(max_modifier_level)
+                if new_item.type == modifier.type:
+                    new_item.add_modifier(modifier)
+            new_items.append(new_item)
+        return new_items
 
     def get_random_modifier(self, max_modifier_level):
-        # Determine max modifier level at which modifiers are available
-        modifier_level = max_modifier_level
-        while modifier_level not in self.modifier_level_index.keys():
-            modifier_level -= 1
-            if modifier_level <= 0:
-                raise GameError("No modifiers available below the give modifier level")
-        # Determine possibilities
-        possibilities = []
-        possibilities.extend(self.modifier_level_index[modifier_level])
-        if modifier_level + 1 in self.modifier_level_index.keys():
-            possibilities.extend(self.modifier_level_index[modifier_level + 1])
-        if modifier_level - 1 in self.modifier_level_index.keys():
-            possibilities.extend(self.modifier_level_index[modifier_level - 1])
-        if modifier_level - 2 in self.modifier_level_index.keys():
-            possibilities.extend(self.modifier_level_index[modifier_level - 2])
-        # Include negative modifiers
-        for key in self.modifier_level_index.keys():
-            if key <= 0:
-                possibilities.extend(self.modifier_level_index[key])
         # Make a random choice
-        selection = random.choice(possibilities)
+        selection = self._random.choice(self._modifier_spawn_table(max_modifier_level))
         # Create the item
         modifier = ItemModifier(selection)
         return modifier
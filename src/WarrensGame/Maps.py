@@ -1,11 +1,25 @@
 #!/usr/bin/python
 
+import heapq
 import math
-import random
+import sys
+from array import array
+from collections import OrderedDict
 
-from WarrensGame.CONSTANTS import SPRITES, DAYLIGHT_RADIUS, TORCH_RADIUS, DUNGEON, TOWN, CAVE, TILE_DEFAULT_COLOR
+from WarrensGame.CONSTANTS import SPRITES, DAYLIGHT_RADIUS, TORCH_RADIUS, DUNGEON, TOWN, CAVE, TILE_DEFAULT_COLOR, FOV, RNG
 import WarrensGame.Utilities as Utilities
 
+# Number of paths that are cached per map by find_path()
+PATH_CACHE_SIZE = 128
+
+# Tile layers that are stored by Map.pack(), one byte per tile and 16 bit integers per tile
+_BYTE_LAYERS = ["_blocked", "_block_sight", "_explored", "_in_view", "_material", "_color"]
+_ARRAY_LAYERS = ["_texture_hash", "_texture_set", "_texture_id"]
+
+# Steps that are considered by find_path(), (dx, dy, cost)
+_PATH_STEPS = [(-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+               (-1, -1, math.sqrt(2)), (-1, 1, math.sqrt(2)), (1, -1, math.sqrt(2)), (1, 1, math.sqrt(2))]
+
 
 class Map(object):
     """
@@ -20,6 +34,21 @@ class Map(object):
         """
         return self._level
 
+    @level.setter
+    def level(self, new_level):
+        self._level = new_level
+
+    @property
+    def random(self):
+        """
+        The random generator of this map. A map on a level uses the map stream of the game that owns the level,
+        a map on its own (for example while it is built in another process) uses the generator it was created with.
+        :return: random.Random object
+        """
+        if self._level is not None:
+            return self._level.random_streams.stream(RNG.MAP)
+        return self._random
+
     @property
     def tiles(self):
         """
@@ -39,14 +68,14 @@ class Map(object):
         """
         Returns an integer indicating the width of the map
         """
-        return self.json["width"]
+        return self._json["width"]
 
     @property
     def height(self):
         """
         Returns an integer indicating the height of the map
         """
-        return self.json["height"]
+        return self._json["height"]
 
     @property
     def each_map_position(self):
@@ -61,14 +90,14 @@ class Map(object):
         Returns a list of all tiles explored.
         This includes tiles in and out of the visible range.
         """
-        return [t for sublist in self.tiles for t in sublist if t.explored]
+        return self._tiles_in_layer(self._explored)
     
     @property
     def visible_tiles(self):
         """
         Returns a list of visible tiles.
         """
-        return [t for sublist in self.tiles for t in sublist if t.inView]
+        return self._tiles_in_layer(self._in_view)
 
     @property
     def entryTile(self):
@@ -91,52 +120,265 @@ class Map(object):
         """
         return self._range_of_view
 
+    @property
+    def fov_algorithm(self):
+        """
+        Algorithm used to determine field of view on this map.
+        :return: FOV enumerator
+        """
+        return self._fov_algorithm
+
+    @fov_algorithm.setter
+    def fov_algorithm(self, new_fov_algorithm):
+        self._fov_algorithm = new_fov_algorithm
+        # Force a recalculation on the next field of view update
+        self._fov_origin = None
+
+    @property
+    def fov_changed_tiles(self):
+        """
+        The tiles for which the inView state changed during the last field of view update.
+        This enables renderers and network code to only process what changed.
+        :return: List of tiles
+        """
+        return self._fov_changed_tiles
+
+    @property
+    def solid_tile_matrix_version(self):
+        """
+        Integer that is increased every time the solidTileMatrix changes.
+        :return: Integer
+        """
+        return self._solid_tile_matrix_version
+
+    @property
+    def blocked_version(self):
+        """
+        Integer that is increased every time a tile of this map becomes blocked or unblocked.
+        :return: Integer
+        """
+        return self._blocked_version
+
     @property
     def texture_set(self):
-        return self.json["texture_set"]
+        return self._json["texture_set"]
 
     @texture_set.setter
     def texture_set(self, new_texture_set):
-        self.json["texture_set"] = new_texture_set
+        self._json["texture_set"] = new_texture_set
         # propagate texture set to all tiles in this map
-        for x in range(self.width):
-            for y in range(self.height):
-                t = self.tiles[x][y]
-                t.texture_set = new_texture_set
+        self._texture_set = array('h', [_encode_none(new_texture_set)]) * len(self._texture_set)
+        if "tiles" in self._json:
+            for tile in self._tile_list:
+                tile.json["texture_set"] = new_texture_set
 
     @property
     def json(self):
         """
         Json dictionary representation of the map.
         This will contain the data elements that are needed for the game client to function.
+        The tile representations are only created once the json is requested, after that they are kept up to date.
         :return: Json dictionary object
         """
+        if "tiles" not in self._json and self._tiles is not None:
+            self._json["tiles"] = [[tile.json for tile in column] for column in self.tiles]
         return self._json
 
-    def __init__(self, map_width, map_height, level):
+    def __init__(self, map_width, map_height, level, rng=None):
         """
         Constructor to create a new empty map
         Arguments
             MapWidth - Map width in tiles
             MapHeight - Map height in tiles
+            rng - random generator of a map without level, defaults to the default map stream
+        """
+        self._init_state(map_width, map_height, level)
+        if rng is not None:
+            self._random = rng
+        # Generate the map
+        self.generate_map()
+        self.refreshBlockedTileMatrix()
+
+    def _init_state(self, map_width, map_height, level):
+        """
+        Initializes the defaults of an empty map, used by the constructor and by unpack().
         """
-        # Initialize defaults
         self._areas = None
         self._entryTile = None
         self._exitTile = None
         self._range_of_view = TORCH_RADIUS
+        self._fov_algorithm = FOV.SHADOWCASTING
+        self._fov_positions = None
+        self._fov_origin = None
+        self._fov_changed_tiles = []
+        self.solidTileMatrix = None
+        self._solid_tile_matrix_version = 0
+        self._blocked_version = 0
+        self._path_cost = None
+        self._path_parent = None
+        self._path_search = None
+        self._path_search_id = 0
+        self._path_cache = OrderedDict()
+        self._free_tiles = None
+        self._area_free_tiles = None
+        self._area_lookup = None
+        self._areas_with_free_tiles = None
         self._level = level
+        self._random = Utilities.random_stream(RNG.MAP)
+        self._tiles = None
+        self._tile_list = []
         self._json = {}
-        self.json["width"] = map_width
-        self.json["height"] = map_height
-        self.json["texture_set"] = None
-        # Generate the map
-        self.generate_map()
-        # Tiles get created during map generation so link up the json's afterward
-        self.json["tiles"] = [[self.tiles[x][y].json
-                               for y in range(map_height)]
-                              for x in range(map_width)]
-        self.refreshBlockedTileMatrix()
+        self._json["width"] = map_width
+        self._json["height"] = map_height
+        self._json["texture_set"] = None
+
+    def create_tiles(self):
+        """
+        Create a new set of empty tiles for this map.
+        The tile properties are stored per layer in flat arrays on the map (index x * height + y),
+        the Tile objects are lightweight views on these layers.
+        """
+        size = self.width * self.height
+        self._blocked = bytearray(size)
+        self._block_sight = bytearray(size)
+        self._explored = bytearray(size)
+        self._in_view = bytearray(b'\x01') * size
+        self._material = bytearray([MaterialType.NONE]) * size
+        self._texture_hash = array('h', [-1]) * size
+        self._texture_set = array('h', [_encode_none(self.texture_set)]) * size
+        self._texture_id = array('h', [-1]) * size
+        # Colors are stored as an index in a palette of the colors used on this map
+        self._palette = [TILE_DEFAULT_COLOR]
+        self._palette_index = {tuple(TILE_DEFAULT_COLOR): 0}
+        self._color = bytearray(size)
+        self._create_tile_views()
+        self._json.pop("tiles", None)
+        # The free tile index is built on first use
+        self._free_tiles = None
+
+    def _create_tile_views(self):
+        """
+        Creates the Tile objects that give access to the map layers.
+        """
+        self._tiles = [[Tile(self, x, y) for y in range(self.height)] for x in range(self.width)]
+        self._tile_list = [tile for column in self._tiles for tile in column]
+
+    def __getstate__(self):
+        """
+        The tiles are views on the map layers, they are not pickled but recreated when the map is unpickled.
+        This keeps maps that are built in another process cheap to transfer.
+        """
+        state = self.__dict__.copy()
+        state["_tiles"] = None
+        state["_tile_list"] = None
+        state["_tile_actors"] = {tile._index: tile.actors for tile in self._tile_list if len(tile.actors) > 0}
+        for key in ["_entryTile", "_exitTile"]:
+            if state[key] is not None:
+                state[key] = state[key]._index
+        state["_fov_changed_tiles"] = []
+        state["_free_tiles"] = None
+        # The json of the tiles is created again when needed
+        state["_json"] = dict(self._json)
+        state["_json"].pop("tiles", None)
+        return state
+
+    def __setstate__(self, state):
+        tile_actors = state.pop("_tile_actors")
+        self.__dict__.update(state)
+        self._create_tile_views()
+        for index, actors in tile_actors.items():
+            self._tile_list[index]._actors = actors
+        for key in ["_entryTile", "_exitTile"]:
+            if self.__dict__[key] is not None:
+                self.__dict__[key] = self._tile_list[self.__dict__[key]]
+
+    def pack(self):
+        """
+        Returns a description of this map in plain values (numbers, strings, bytes, lists and dicts).
+        The tile layers are stored as packed bytes, 16 bit layers in little endian byte order.
+        The actors on the map are not included, they are saved separately, see SaveGame.
+        :return: Dictionary
+        """
+        layers = {}
+        for name in _BYTE_LAYERS:
+            layers[name] = bytes(getattr(self, name))
+        for name in _ARRAY_LAYERS:
+            layer = getattr(self, name)
+            if sys.byteorder == "big":
+                layer = array('h', layer)
+                layer.byteswap()
+            layers[name] = layer.tobytes()
+        return {
+            "class": type(self).__name__,
+            "width": self.width,
+            "height": self.height,
+            "texture_set": self.texture_set,
+            "range_of_view": self._range_of_view,
+            "fov_algorithm": self._fov_algorithm,
+            "blocked_version": self._blocked_version,
+            "palette": list(self._palette),
+            "areas": None if self._areas is None else [_pack_area(area) for area in self._areas],
+            "entry": None if self._entryTile is None else self._entryTile._index,
+            "exit": None if self._exitTile is None else self._exitTile._index,
+            "layers": layers
+        }
+
+    @classmethod
+    def unpack(cls, record, level):
+        """
+        Recreates a map from the result of pack() without generating it again.
+        :param record: Dictionary created by pack()
+        :param level: Level to which the map belongs
+        :return: Map object
+        """
+        new_map = cls.__new__(cls)
+        new_map._init_state(record["width"], record["height"], level)
+        new_map._json["texture_set"] = record["texture_set"]
+        new_map._range_of_view = record["range_of_view"]
+        new_map._fov_algorithm = record["fov_algorithm"]
+        new_map._blocked_version = record["blocked_version"]
+        layers = record["layers"]
+        for name in _BYTE_LAYERS:
+            setattr(new_map, name, bytearray(layers[name]))
+        for name in _ARRAY_LAYERS:
+            layer = array('h')
+            layer.frombytes(layers[name])
+            if sys.byteorder == "big":
+                layer.byteswap()
+            setattr(new_map, name, layer)
+        new_map._palette = list(record["palette"])
+        new_map._palette_index = {tuple(color): index for index, color in enumerate(new_map._palette)}
+        new_map._create_tile_views()
+        if record["areas"] is not None:
+            new_map._areas = [_unpack_area(new_map, area) for area in record["areas"]]
+        if record["entry"] is not None:
+            new_map._entryTile = new_map._tile_list[record["entry"]]
+        if record["exit"] is not None:
+            new_map._exitTile = new_map._tile_list[record["exit"]]
+        new_map.refreshBlockedTileMatrix()
+        return new_map
+
+    def _color_index(self, color):
+        """
+        Returns the palette index for the given color, the color is added to the palette if needed.
+        """
+        key = tuple(color)
+        if key not in self._palette_index:
+            self._palette_index[key] = len(self._palette)
+            self._palette.append(color)
+        return self._palette_index[key]
+
+    def _tiles_in_layer(self, layer):
+        """
+        Returns the tiles for which the value in the given layer is set.
+        """
+        tile_list = self._tile_list
+        tiles = []
+        index = layer.find(1)
+        while index >= 0:
+            tiles.append(tile_list[index])
+            index = layer.find(1, index + 1)
+        return tiles
 
     def generate_map(self):
         """
@@ -149,102 +391,395 @@ class Map(object):
         Refresh a 2D matrix of with True/False values indicating if a Tile position blocks line of sight.
         It is calculated separately for efficiency.
         """
-        self.solidTileMatrix = [[False for y in range(0, self.height)] for x in range(0, self.width)]
-        for x, y in self.each_map_position:
-            self.solidTileMatrix[x][y] = self.tiles[x][y].blockSight
+        height = self.height
+        self.solidTileMatrix = [self._block_sight[x * height:(x + 1) * height] for x in range(self.width)]
+        self._solid_tile_matrix_version += 1
+
+    def update_solid_tile(self, tile):
+        """
+        Update the solidTileMatrix for a single tile that changed after the matrix was created.
+        :param tile: Tile object
+        :return: None
+        """
+        if self.solidTileMatrix is None:
+            # Matrix not yet created, it will be refreshed once the map is generated
+            return
+        if self.solidTileMatrix[tile.x][tile.y] != tile.blockSight:
+            self.solidTileMatrix[tile.x][tile.y] = tile.blockSight
+            self._solid_tile_matrix_version += 1
 
     def updateFieldOfView(self, x, y):
         """
         Update the map tiles with what is in field of view, marking
         those as explored.
-        """
-        view_range = self.range_of_view
-        for tx, ty in self.each_map_position:
+        The update is skipped if the origin, the range of view and the solidTileMatrix did not change
+        since the previous update. Otherwise only the tiles for which visibility changed are written,
+        these are available in fov_changed_tiles afterwards.
+        """
+        fov_origin = (x, y, self.range_of_view, self.solid_tile_matrix_version)
+        if fov_origin == self._fov_origin:
+            self._fov_changed_tiles = []
+            return
+        if self.fov_algorithm == FOV.SHADOWCASTING:
+            visible_positions = Utilities.shadowcast(self.solidTileMatrix, self.width, self.height,
+                                                     x, y, self.range_of_view)
+        elif self.fov_algorithm == FOV.RAYCASTING:
+            visible_positions = self._raycast_field_of_view(x, y)
+        else:
+            raise Utilities.GameError("Unknown field of view algorithm " + str(self.fov_algorithm))
+
+        if self._fov_positions is None:
+            # No previous field of view, every tile needs to be written once
+            hidden_positions = [position for position in self.each_map_position
+                                if position not in visible_positions]
+            shown_positions = visible_positions
+        else:
+            hidden_positions = self._fov_positions - visible_positions
+            shown_positions = visible_positions - self._fov_positions
+        changed_tiles = []
+        # Hide what is no longer visible
+        for tx, ty in hidden_positions:
             tile = self.tiles[tx][ty]
-            dist = Utilities.distance_between_points(x, y, tx, ty)
-            visible = dist <= view_range
-            line_of_sight = Utilities.line_of_sight(
-                self.solidTileMatrix, x, y, tx, ty)
-            if visible and line_of_sight:
-                tile.inView = True
-                tile.explored = True
-            else:
-                tile.inView = False
-            # set all actors as in view too
+            tile.inView = False
             for actor in tile.actors:
-                actor.inView = visible and line_of_sight
+                actor.inView = False
+            changed_tiles.append(tile)
+        # Show what became visible
+        for tx, ty in shown_positions:
+            tile = self.tiles[tx][ty]
+            tile.inView = True
+            tile.explored = True
+            for actor in tile.actors:
+                actor.inView = True
+            changed_tiles.append(tile)
+        self._fov_positions = visible_positions
+        self._fov_origin = fov_origin
+        self._fov_changed_tiles = changed_tiles
+
+    def _raycast_field_of_view(self, x, y):
+        """
+        Field of view based on a line of sight check towards every tile of the map.
+        :return: set of visible (x, y) tuples
+        """
+        positions = self.each_map_position
+        in_sight = Utilities.line_of_sight_matrix(self.solidTileMatrix, [(x, y)], positions, self.range_of_view)[0]
+        return {position for position, visible in zip(positions, in_sight) if visible}
+
+    def compute_texture_hashes(self):
+        """
+        Calculates the texture hash of every tile in a single pass over the blockSight layer.
+        Every hash has 9 bits, one for each tile in the 3x3 neighbourhood of the tile (1 means blocking sight).
+        Positions outside of the map count as blocking sight.
+        """
+        width = self.width
+        height = self.height
+        # Pad the blockSight layer with a border of blocking positions
+        stride = height + 2
+        padded = bytearray(b'\x01') * ((width + 2) * stride)
+        for x in range(width):
+            start = (x + 1) * stride + 1
+            padded[start:start + height] = self._block_sight[x * height:(x + 1) * height]
+        g = padded
+        # Offsets of the neighbours in the padded layer, most significant bit first
+        nw, n, ne = -stride - 1, -1, stride - 1
+        w, e = -stride, stride
+        sw, s, se = -stride + 1, 1, stride + 1
+        hashes = array('h', [
+            g[p + nw] << 8 | g[p + n] << 7 | g[p + ne] << 6 |
+            g[p + w] << 5 | g[p] << 4 | g[p + e] << 3 |
+            g[p + sw] << 2 | g[p + s] << 1 | g[p + se]
+            for p in [(x + 1) * stride + y + 1 for x in range(width) for y in range(height)]])
+        self._texture_hash = hashes
+        if "tiles" in self._json:
+            for tile in self._tile_list:
+                tile.json["texture_hash"] = tile.texture_hash
+
+    def assign_textures(self):
+        """
+        Assigns a texture ID to every tile of the map.
+        Tiles that don't block sight get a (random) floor texture.
+        Tiles that block sight get a wall texture based on their texture hash, see WALL_TEXTURES.
+        """
+        self.compute_texture_hashes()
+        texture_ids = array('h', [-1]) * len(self._texture_id)
+        unknown_hashes = set()
+        block_sight = self._block_sight
+        rng = self.random
+        for index, h in enumerate(self._texture_hash):
+            if not block_sight[index]:
+                texture_id = SPRITES.TILE_EMPTY
+                if rng.random() < 0.05:
+                    texture_id = SPRITES.TILE_SUBTILES
+                if rng.random() < 0.05:
+                    texture_id = SPRITES.TILE_LINED
+                if rng.random() < 0.05:
+                    texture_id = SPRITES.TILE_CRACKED
+            else:
+                texture_id = WALL_TEXTURES[h]
+                if texture_id is None:
+                    unknown_hashes.add(h)
+                    continue
+            texture_ids[index] = texture_id
+        self._texture_id = texture_ids
+        if "tiles" in self._json:
+            for tile in self._tile_list:
+                tile.json["texture_id"] = tile.texture_id
+        if len(unknown_hashes) > 0:
+            print("WARNING: Unknown hashes " + str(sorted(unknown_hashes)) + ", can't assign tileset ID.")
+
+    def _build_free_tile_index(self):
+        """
+        Builds the index of free tiles (not blocked and without actors).
+        There is one index for the whole map, excluding the outermost cells, and one for every area.
+        Once built the index is kept up to date by the tiles, see _update_free_tile().
+        """
+        width = self.width
+        height = self.height
+        blocked = self._blocked
+        tile_list = self._tile_list
+        self._free_tiles = Utilities.IndexSet(
+            x * height + y
+            for x in range(1, width - 1)
+            for y in range(1, height - 1)
+            if not blocked[x * height + y] and len(tile_list[x * height + y].actors) == 0)
+        self._area_free_tiles = []
+        self._area_lookup = {}
+        self._areas_with_free_tiles = Utilities.IndexSet()
+        for position, area in enumerate(self.areas or []):
+            area_tiles = Utilities.IndexSet()
+            for x in range(max(area.x1, 0), min(area.x2, width - 1) + 1):
+                for y in range(max(area.y1, 0), min(area.y2, height - 1) + 1):
+                    index = x * height + y
+                    self._area_lookup.setdefault(index, []).append(position)
+                    if not blocked[index] and len(tile_list[index].actors) == 0:
+                        area_tiles.add(index)
+            self._area_free_tiles.append(area_tiles)
+            if len(area_tiles) > 0:
+                self._areas_with_free_tiles.add(position)
+
+    def _check_free_tile_index(self):
+        """
+        Ensures the free tile index exists and covers all the areas of this map.
+        """
+        if self._free_tiles is None or len(self._area_free_tiles) != len(self.areas or []):
+            self._build_free_tile_index()
+
+    def _update_free_tile(self, index):
+        """
+        Updates the free tile index for the tile at the given index (x * height + y).
+        Called by the tiles when they become (un)blocked or when actors are added or removed.
+        """
+        if self._free_tiles is None:
+            # Index not yet built
+            return
+        height = self.height
+        free = not self._blocked[index] and len(self._tile_list[index].actors) == 0
+        x, y = divmod(index, height)
+        if 0 < x < self.width - 1 and 0 < y < height - 1:
+            if free:
+                self._free_tiles.add(index)
+            else:
+                self._free_tiles.discard(index)
+        for position in self._area_lookup.get(index, ()):
+            area_tiles = self._area_free_tiles[position]
+            if free:
+                area_tiles.add(index)
+                self._areas_with_free_tiles.add(position)
+            else:
+                area_tiles.discard(index)
+                if len(area_tiles) == 0:
+                    self._areas_with_free_tiles.discard(position)
 
     def getRandomEmptyTile(self):
         """
         Returns an empty tile on this level, excluding the outermost cells.
-        """
-        level_area = Room(self, 1, 1, self.width - 2, self.height - 2)
-        return level_area.getRandomEmptyTile()
+        Returns None if there are no empty tiles.
+        """
+        self._check_free_tile_index()
+        index = self._free_tiles.random_choice(self.random)
+        if index is None:
+            return None
+        return self._tile_list[index]
+
+    def getRandomEmptyAreaTile(self, area):
+        """
+        Returns an empty tile in the given area of this map.
+        Returns None if there are no empty tiles in the area.
+        """
+        self._check_free_tile_index()
+        for position, other_area in enumerate(self.areas or []):
+            if other_area is area:
+                index = self._area_free_tiles[position].random_choice(self.random)
+                if index is None:
+                    return None
+                return self._tile_list[index]
+        # Not one of the areas of this map, look at every tile
+        empty_tiles = [self.tiles[x][y]
+                       for x in range(area.x1, area.x2 + 1)
+                       for y in range(area.y1, area.y2 + 1)
+                       if not self.tiles[x][y].blocked and self.tiles[x][y].empty]
+        if len(empty_tiles) == 0:
+            return None
+        return self.random.choice(empty_tiles)
 
     def getRandomTile(self):
         """
         Returns a random Tile in this map.
         :return: Tile object
         """
-        x = random.randrange(self.width)
-        y = random.randrange(self.height)
+        x = self.random.randrange(self.width)
+        y = self.random.randrange(self.height)
         return self.tiles[x][y]
 
+    def distance_field(self, sources):
+        """
+        Calculates the number of steps from every tile towards the nearest source tile.
+        This is a breadth first search over the tiles that are not blocked, moving in 8 directions.
+        Arguments
+            sources - list of Tile objects from which the distances are measured
+        Returns an array with the distance for every position at index x * height + y, -1 if unreachable.
+        """
+        width = self.width
+        height = self.height
+        blocked = self._blocked
+        distances = array('h', [-1]) * (width * height)
+        frontier = []
+        for tile in sources:
+            index = tile.x * height + tile.y
+            if distances[index] == -1:
+                distances[index] = 0
+                frontier.append((tile.x, tile.y))
+        distance = 0
+        while len(frontier) > 0:
+            distance += 1
+            next_frontier = []
+            for x, y in frontier:
+                for nx in (x - 1, x, x + 1):
+                    if nx < 0 or nx >= width:
+                        continue
+                    for ny in (y - 1, y, y + 1):
+                        if ny < 0 or ny >= height:
+                            continue
+                        index = nx * height + ny
+                        if distances[index] == -1 and not blocked[index]:
+                            distances[index] = distance
+                            next_frontier.append((nx, ny))
+            frontier = next_frontier
+        return distances
+
+    def find_path(self, start, goal):
+        """
+        Finds the shortest path between two tiles, moving in 8 directions around blocked tiles.
+        The last PATH_CACHE_SIZE results are cached until tiles of the map become blocked or unblocked.
+        Arguments
+            start - Tile where the path starts
+            goal - Tile where the path should end
+        Returns a list of tiles from the first step up to and including the goal.
+        The list is empty if start is goal, None is returned if the goal can not be reached.
+        """
+        height = self.height
+        start_index = start.x * height + start.y
+        goal_index = goal.x * height + goal.y
+        key = (start_index, goal_index, self.blocked_version)
+        cache = self._path_cache
+        if key in cache:
+            cache.move_to_end(key)
+            path = cache[key]
+        else:
+            path = self._a_star(start_index, goal_index)
+            cache[key] = path
+            if len(cache) > PATH_CACHE_SIZE:
+                cache.popitem(last=False)
+        if path is None:
+            return None
+        tiles = self._tile_list
+        return [tiles[index] for index in path]
+
+    def _a_star(self, start_index, goal_index):
+        """
+        Private helper for find_path(), A* search with an octile distance heuristic.
+        The cost and parent buffers are reused between searches, a search id marks the entries
+        that were written by the current search so they don't have to be cleared.
+        Returns a tuple of position indexes (x * height + y) or None if there is no path.
+        """
+        width = self.width
+        height = self.height
+        size = width * height
+        if self._path_search is None or len(self._path_search) != size:
+            self._path_cost = array('d', [0.0]) * size
+            self._path_parent = array('l', [-1]) * size
+            self._path_search = array('l', [0]) * size
+        cost = self._path_cost
+        parent = self._path_parent
+        search = self._path_search
+        self._path_search_id += 1
+        search_id = self._path_search_id
+        blocked = self._blocked
+        if blocked[goal_index]:
+            return None
+        goal_x, goal_y = divmod(goal_index, height)
+        diagonal_bonus = math.sqrt(2) - 2
+        cost[start_index] = 0.0
+        parent[start_index] = -1
+        search[start_index] = search_id
+        open_heap = [(0.0, 0.0, start_index)]
+        while len(open_heap) > 0:
+            estimate, distance, index = heapq.heappop(open_heap)
+            if index == goal_index:
+                path = []
+                while index != start_index:
+                    path.append(index)
+                    index = parent[index]
+                path.reverse()
+                return tuple(path)
+            if distance > cost[index]:
+                # Outdated heap entry, a shorter way to this position was found
+                continue
+            x, y = divmod(index, height)
+            for dx, dy, step_cost in _PATH_STEPS:
+                nx = x + dx
+                ny = y + dy
+                if nx < 0 or nx >= width or ny < 0 or ny >= height:
+                    continue
+                next_index = nx * height + ny
+                if blocked[next_index]:
+                    continue
+                next_distance = distance + step_cost
+                if search[next_index] != search_id or next_distance < cost[next_index]:
+                    search[next_index] = search_id
+                    cost[next_index] = next_distance
+                    parent[next_index] = index
+                    hx = abs(goal_x - nx)
+                    hy = abs(goal_y - ny)
+                    heuristic = hx + hy + diagonal_bonus * min(hx, hy)
+                    heapq.heappush(open_heap, (next_distance + heuristic, next_distance, next_index))
+        return None
+
     def getCircleTiles(self, x, y, radius, full_circle=False, exclude_blocked_tiles=False):
         """
         This utility function returns an array of tiles that approximates a circle on the map.
+        The shape of the circle is taken from a cached stencil, see circle_stencil().
         Arguments
             x - the x coordinate of the center of the circle
             y - the y coordinate of the center of the circle
             radius - the radius of the circle
             full_circle - when false only the tiles on the border of the circle are returned
                        - when true all tiles inside.
-            exclude_blocked_tiles - excludes blocked tiles
+            exclude_blocked_tiles - excludes blocked tiles (the center of a full circle is always included)
         """
-        # Prepare variables
+        width = self.width
+        height = self.height
+        tiles = self.tiles
+        blocked = self._blocked
         circle_tiles = []
-        max_x = self.width - 1
-        max_y = self.height - 1
-        # max_i is a relevant sample size, if it is to small it will lead to gaps in the circle.
-        # the following works for reasonably sized circles.
-        max_i = 6 * radius
-        half_max_i = max_i / 2
-        if full_circle:
-            # add center
-            circle_tiles.append(self.tiles[x][y])
-        # go around the edge of the circle in max_i samples
-        for i in range(0, max_i):
-            # for each edge sample calculate the coordinates
-            x_pos = int(round(x + radius * math.cos((math.pi/half_max_i)*i)))
-            y_pos = int(round(y + radius * math.sin((math.pi/half_max_i)*i)))
-            # add relevant tiles between the found circle edge and the circle center
-            while x_pos != x or y_pos != y:
-                # tile has to be on the map
-                if x_pos >= 0 and y_pos >= 0 and x_pos <= max_x and y_pos <= max_y:
-                    # avoid adding duplicates
-                    if self.tiles[x_pos][y_pos] not in circle_tiles:
-                        possible_tile = self.tiles[x_pos][y_pos]
-                        if exclude_blocked_tiles:
-                            # exclude blocked tiles
-                            if not possible_tile.blocked:
-                                circle_tiles.append(possible_tile)
-                        else:
-                            # include all tiles
-                            circle_tiles.append(possible_tile)
-                if full_circle:
-                    # move towards interior
-                    if x_pos > x:
-                        x_pos -= 1
-                    elif x_pos < x:
-                        x_pos += 1
-                    elif x_pos == x:
-                        if y_pos > y:
-                            y_pos -= 1
-                        elif y_pos < y:
-                            y_pos += 1
-                else:
-                    # adding only the edge is enough
-                    break
+        for dx, dy in circle_stencil(radius, full_circle):
+            tx = x + dx
+            ty = y + dy
+            # tile has to be on the map
+            if 0 <= tx < width and 0 <= ty < height:
+                if exclude_blocked_tiles and blocked[tx * height + ty] and (dx != 0 or dy != 0):
+                    continue
+                circle_tiles.append(tiles[tx][ty])
         return circle_tiles
     
     def __str__(self):
@@ -282,14 +817,14 @@ class DungeonMap(Map):
         """
         self._areas = []
 
-    def __init__(self, map_width, map_height, level=None):
+    def __init__(self, map_width, map_height, level=None, rng=None):
         """
         Constructor to create a new dungeon map
         Arguments
             MapWidth - Map width in tiles
             MapHeight - Map height in tiles
         """
-        super(DungeonMap, self).__init__(map_width, map_height, level)
+        super(DungeonMap, self).__init__(map_width, map_height, level, rng)
         self.texture_set = TextureSet.STONE
         # Initialize range of view
         self._rangeOfView = TORCH_RADIUS
@@ -310,7 +845,7 @@ class DungeonMap(Map):
             raise Utilities.GameError("Requested size is too small, can't generate dungeon.")
 
         # Create a new map with empty tiles
-        self._tiles = [[Tile(self, x, y) for y in range(self. height)] for x in range(self. width)]
+        self.create_tiles()
 
         # Block all tiles
         for y in range(self.height):
@@ -322,14 +857,14 @@ class DungeonMap(Map):
                 t.material = MaterialType.STONE
 
         # Cut out rooms (minimum 2)
-        rooms_to_generate = random.randint(2, max_rooms)
+        rooms_to_generate = self.random.randint(2, max_rooms)
         while len(self.rooms) < rooms_to_generate:
             # Random width and height
-            w = random.randrange(room_min_size, room_max_size)
-            h = random.randrange(room_min_size, room_max_size)
+            w = self.random.randrange(room_min_size, room_max_size)
+            h = self.random.randrange(room_min_size, room_max_size)
             # Random position without going out of the boundaries of the map
-            x = random.randrange(0, self.width - w - 1)
-            y = random.randrange(0, self.height - h - 1)
+            x = self.random.randrange(0, self.width - w - 1)
+            y = self.random.randrange(0, self.height - h - 1)
             # Create a new room
             new_room = Room(self, x, y, w, h)
 
@@ -371,56 +906,7 @@ class DungeonMap(Map):
         self._exitTile = self._tiles[exitX][exitY]
 
         # Assign texture ID based on texture hash
-        # The assignments below are calculated using a helper spreadsheet
-        for x in range(self.width):
-            for y in range(self.height):
-                t = self.tiles[x][y]
-                h = t.texture_hash
-                # Map hash to a tileset ID
-                if not self.tiles[x][y].blockSight:
-                    t.texture_id = SPRITES.TILE_EMPTY
-                    if random.random() < 0.05:
-                        t.texture_id = SPRITES.TILE_SUBTILES
-                    if random.random() < 0.05:
-                        t.texture_id = SPRITES.TILE_LINED
-                    if random.random() < 0.05:
-                        t.texture_id = SPRITES.TILE_CRACKED
-                elif h in [16, 511]:
-                    t.texture_id = SPRITES.PILLAR
-                elif h in [24, 25, 88, 89]:
-                    t.texture_id = SPRITES.NS_WALL_W_CAP
-                elif h in [56, 57, 60, 63, 120, 121, 124, 125, 127, 312, 313, 316, 317, 319, 377, 380, 381, 383, 504,
-                           505, 508, 509]:
-                    t.texture_id = SPRITES.NS_WALL
-                elif h in [48, 52, 304, 308]:
-                    t.texture_id = SPRITES.NS_WALL_E_CAP
-                elif h in [18, 19, 22, 23]:
-                    t.texture_id = SPRITES.EW_WALL_N_CAP
-                elif h in [146, 147, 150, 151, 210, 214, 215, 219, 223, 402, 403, 407, 438, 439, 466, 467, 470, 471,
-                           475, 479, 502, 503]:
-                    t.texture_id = SPRITES.EW_WALL
-                elif h in [144, 208, 400, 464]:
-                    t.texture_id = SPRITES.EW_WALL_S_CAP
-                elif h in [26, 27, 30, 31, 90, 91, 94, 95, 283, 510]:
-                    t.texture_id = SPRITES.NW_CORNER
-                elif h in [50, 51, 54, 55, 118, 306, 307, 310, 311, 507]:
-                    t.texture_id = SPRITES.NE_CORNER
-                elif h in [152, 153, 216, 217, 220, 408, 409, 447, 472, 473]:
-                    t.texture_id = SPRITES.SW_CORNER
-                elif h in [176, 180, 240, 244, 255, 432, 433, 436, 496, 500]:
-                    t.texture_id = SPRITES.SE_CORNER
-                elif h in [186, 187, 190, 250, 254, 442, 443]:
-                    t.texture_id = SPRITES.CROSS
-                elif h in [58, 59, 62, 122, 123, 126, 314, 315, 318, 378, 379, 382, 506]:
-                    t.texture_id = SPRITES.T_SOUTH
-                elif h in [178, 179, 182, 183, 242, 243, 246, 247, 251, 434, 435, 498, 499]:
-                    t.texture_id = SPRITES.T_WEST
-                elif h in [154, 155, 158, 159, 218, 222, 410, 411, 414, 415, 446, 474, 478]:
-                    t.texture_id = SPRITES.T_EAST
-                elif h in [184, 185, 188, 189, 191, 248, 249, 252, 253, 440, 441, 444, 445]:
-                    t.texture_id = SPRITES.T_NORTH
-                else:
-                    print("WARNING: Unknown hash " + str(h) + ", can't assign tileset ID.")
+        self.assign_textures()
 
     def _create_horizontal_tunnel(self, x1, x2, y):
         for x in range(min(x1, x2), max(x1, x2) + 1):
@@ -438,16 +924,17 @@ class DungeonMap(Map):
 
     def getRandomEmptyTile(self):
         """
-        finds a random empty tile on the map of this level
+        finds a random empty tile in one of the rooms of this map
+        Returns None if all rooms are full.
         """
-        empty_tile = None
-        # TODO: Issue here, if all tiles of the map are occupied this will be an infinite loop.
-        while empty_tile is None:
-            # Pick a random room of the map
-            room = random.choice(self.rooms)
-            # Find an empty tile in the room
-            empty_tile = room.getRandomEmptyTile()
-        return empty_tile
+        self._check_free_tile_index()
+        # Pick a random room that still has empty tiles
+        position = self._areas_with_free_tiles.random_choice(self.random)
+        if position is None:
+            return None
+        # Pick a random empty tile in the room
+        index = self._area_free_tiles[position].random_choice(self.random)
+        return self._tile_list[index]
 
 
 class TextureSet:
@@ -482,14 +969,14 @@ class TownMap(Map):
         """
         self._areas = []
 
-    def __init__(self, map_width, map_height, level=None):
+    def __init__(self, map_width, map_height, level=None, rng=None):
         """
         Constructor to create a new town map
         Arguments
             MapWidth - Map width in tiles
             MapHeight - Map height in tiles
         """
-        super(TownMap, self).__init__(map_width, map_height, level)
+        super(TownMap, self).__init__(map_width, map_height, level, rng)
         #Initialize range of view
         self._rangeOfView = DAYLIGHT_RADIUS
 
@@ -506,9 +993,7 @@ class TownMap(Map):
         MAX_HOUSES = TOWN.MAX_HOUSES
 
         #Create a new map with empty tiles
-        self._tiles = [[Tile(self, x, y)
-               for y in range(self. height)]
-           for x in range(self. width)]
+        self.create_tiles()
 
         #Block only the town border
         for y in range(self.height):
@@ -531,11 +1016,11 @@ class TownMap(Map):
         num_houses = 0
         for r in range(MAX_HOUSES):
             #random width and height
-            w = random.randrange(HOUSE_MIN_SIZE, HOUSE_MAX_SIZE)
-            h = random.randrange(HOUSE_MIN_SIZE, HOUSE_MAX_SIZE)
+            w = self.random.randrange(HOUSE_MIN_SIZE, HOUSE_MAX_SIZE)
+            h = self.random.randrange(HOUSE_MIN_SIZE, HOUSE_MAX_SIZE)
             #random position staying away from the edges of town
-            x = random.randrange(2, self.width - w - 2)
-            y = random.randrange(2, self.height - h - 2)
+            x = self.random.randrange(2, self.width - w - 2)
+            y = self.random.randrange(2, self.height - h - 2)
             #create a new house
             new_house = Room(self, x, y, w, h)
 
@@ -576,7 +1061,7 @@ class SingleRoomMap(Map):
         """
         return self._room
 
-    def __init__(self, map_width, map_height, level, myRoom):
+    def __init__(self, map_width, map_height, level, myRoom, rng=None):
         """
         Constructor to create a new empty map
         Arguments
@@ -585,15 +1070,24 @@ class SingleRoomMap(Map):
         """
         #Register room
         self._room = myRoom
-        super(SingleRoomMap, self).__init__(map_width, map_height, level)
+        super(SingleRoomMap, self).__init__(map_width, map_height, level, rng)
         #Initialize range of view
         self._rangeOfView = TORCH_RADIUS
 
+    def pack(self):
+        record = super(SingleRoomMap, self).pack()
+        record["room"] = _pack_area(self.room)
+        return record
+
+    @classmethod
+    def unpack(cls, record, level):
+        new_map = super(SingleRoomMap, cls).unpack(record, level)
+        new_map._room = _unpack_area(None, record["room"])
+        return new_map
+
     def generate_map(self):
         #Create a new map with empty tiles
-        self._tiles = [[Tile(self, x, y)
-               for y in range(self. height)]
-           for x in range(self. width)]
+        self.create_tiles()
 
         #Block all tiles
         for y in range(self.height):
@@ -618,22 +1112,20 @@ class CaveMap(Map):
     This class represents a randomized cave system map.
     """
     
-    def __init__(self, map_width, map_height, level=None):
+    def __init__(self, map_width, map_height, level=None, rng=None):
         """
         Constructor to create a new cave system map
         Arguments
             MapWidth - Map width in tiles
             MapHeight - Map height in tiles
         """
-        super(CaveMap, self).__init__(map_width, map_height, level)
+        super(CaveMap, self).__init__(map_width, map_height, level, rng)
         #Initialize range of view
         self._rangeOfView = TORCH_RADIUS
 
     def generate_map(self):
         #Create a new map with empty tiles
-        self._tiles = [[Tile(self, x, y)
-               for y in range(self. height)]
-           for x in range(self. width)]
+        self.create_tiles()
 
         #Block all tiles
         for y in range(self.height):
@@ -645,9 +1137,9 @@ class CaveMap(Map):
                 myTile.material = MaterialType.STONE 
         
         #Cut out a starting cave area
-        x = random.randrange(2, self.width - 2)
-        y = random.randrange(2, self.height - 2)
-        radius = random.randrange(5, 10)
+        x = self.random.randrange(2, self.width - 2)
+        y = self.random.randrange(2, self.height - 2)
+        radius = self.random.randrange(5, 10)
         fullCircle = True
         circleTiles = self.getCircleTiles(x, y, radius, fullCircle)
         for tile in circleTiles:
@@ -656,13 +1148,13 @@ class CaveMap(Map):
         firstX = x
         firstY = y
         #Grow additional cave areas.
-        for i in range(2, random.randint(3,8)):
+        for i in range(2, self.random.randint(3,8)):
             prevX = x
             prevY = y
             prevRadius = radius
-            x = random.randint(2, self.width - 3)
-            y = random.randint(2, self.height - 3)
-            radius = random.randint(5, 15)
+            x = self.random.randint(2, self.width - 3)
+            y = self.random.randint(2, self.height - 3)
+            radius = self.random.randint(5, 15)
             fullCircle = True
             circleTiles = self.getCircleTiles(x, y, radius, fullCircle)
             for tile in circleTiles:
@@ -699,7 +1191,7 @@ class CaveMap(Map):
         while not (prevX == x and prevY ==y):
             if prevX != x: x += modX
             if prevY != y: y += modY
-            for i in range(0, random.randint(1, 3)):
+            for i in range(0, self.random.randint(1, 3)):
                 self.clearTile(self.tiles[x+i][y+i])
                 self.clearTile(self.tiles[x+i][y])
                 self.clearTile(self.tiles[x][y+i])
@@ -742,16 +1234,10 @@ class Room:
                 self.y1 - border <= other.y2 and self.y2 + border >= other.y1)
 
     def getRandomEmptyTile(self):
-        aTile = None
-        xRange = list(range(self.x1, self.x2 + 1))
-        random.shuffle(xRange)
-        yRange = list(range(self.y1, self.y2 + 1))
-        random.shuffle(yRange)
-        for x in xRange:
-            for y in yRange:
-                if not self._map.tiles[x][y].blocked and self._map.tiles[x][y].empty:
-                    aTile = self._map.tiles[x][y]
-        return aTile
+        """
+        Returns a random empty tile in this room, None if there is none.
+        """
+        return self._map.getRandomEmptyAreaTile(self)
 
 
 class MaterialType:
@@ -765,24 +1251,150 @@ class MaterialType:
     WATER = 4
 
 
+def _build_wall_textures():
+    """
+    Builds the lookup table that maps every possible texture hash (0-511) of a wall tile to a sprite ID.
+    The assignments below are calculated using a helper spreadsheet.
+    Hashes without a suitable wall texture map to None.
+    """
+    assignments = [
+        (SPRITES.PILLAR, [16, 511]),
+        (SPRITES.NS_WALL_W_CAP, [24, 25, 88, 89]),
+        (SPRITES.NS_WALL, [56, 57, 60, 63, 120, 121, 124, 125, 127, 312, 313, 316, 317, 319, 377, 380, 381, 383,
+                           504, 505, 508, 509]),
+        (SPRITES.NS_WALL_E_CAP, [48, 52, 304, 308]),
+        (SPRITES.EW_WALL_N_CAP, [18, 19, 22, 23]),
+        (SPRITES.EW_WALL, [146, 147, 150, 151, 210, 214, 215, 219, 223, 402, 403, 407, 438, 439, 466, 467, 470, 471,
+                           475, 479, 502, 503]),
+        (SPRITES.EW_WALL_S_CAP, [144, 208, 400, 464]),
+        (SPRITES.NW_CORNER, [26, 27, 30, 31, 90, 91, 94, 95, 283, 510]),
+        (SPRITES.NE_CORNER, [50, 51, 54, 55, 118, 306, 307, 310, 311, 507]),
+        (SPRITES.SW_CORNER, [152, 153, 216, 217, 220, 408, 409, 447, 472, 473]),
+        (SPRITES.SE_CORNER, [176, 180, 240, 244, 255, 432, 433, 436, 496, 500]),
+        (SPRITES.CROSS, [186, 187, 190, 250, 254, 442, 443]),
+        (SPRITES.T_SOUTH, [58, 59, 62, 122, 123, 126, 314, 315, 318, 378, 379, 382, 506]),
+        (SPRITES.T_WEST, [178, 179, 182, 183, 242, 243, 246, 247, 251, 434, 435, 498, 499]),
+        (SPRITES.T_EAST, [154, 155, 158, 159, 218, 222, 410, 411, 414, 415, 446, 474, 478]),
+        (SPRITES.T_NORTH, [184, 185, 188, 189, 191, 248, 249, 252, 253, 440, 441, 444, 445])
+    ]
+    table = [None] * 512
+    for sprite_id, hashes in assignments:
+        for h in hashes:
+            table[h] = sprite_id
+    return table
+
+
+# Lookup table from texture hash to wall sprite ID, shared by all maps
+WALL_TEXTURES = _build_wall_textures()
+
+
+# Cache of circle stencils, keys are (radius, full_circle) tuples
+_circle_stencils = {}
+
+
+def circle_stencil(radius, full_circle=False):
+    """
+    Returns a list of (dx, dy) offsets that approximates a circle around (0, 0).
+    Stencils are calculated once per radius and cached. The order of the offsets is stable:
+    the center first (full circle only), then per sample on the edge the offsets towards the center.
+    Arguments
+        radius - the radius of the circle
+        full_circle - when false only the offsets on the border of the circle are returned
+                    - when true all offsets inside.
+    """
+    key = (radius, full_circle)
+    if key not in _circle_stencils:
+        offsets = []
+        seen = set()
+        # max_i is a relevant sample size, if it is to small it will lead to gaps in the circle.
+        # the following works for reasonably sized circles.
+        max_i = 6 * radius
+        half_max_i = max_i / 2
+        if full_circle:
+            # add center
+            offsets.append((0, 0))
+            seen.add((0, 0))
+        # go around the edge of the circle in max_i samples
+        for i in range(0, max_i):
+            # for each edge sample calculate the offsets
+            dx = int(round(radius * math.cos((math.pi / half_max_i) * i)))
+            dy = int(round(radius * math.sin((math.pi / half_max_i) * i)))
+            # add offsets between the found circle edge and the circle center
+            while dx != 0 or dy != 0:
+                if (dx, dy) not in seen:
+                    offsets.append((dx, dy))
+                    seen.add((dx, dy))
+                if full_circle:
+                    # move towards interior
+                    if dx > 0:
+                        dx -= 1
+                    elif dx < 0:
+                        dx += 1
+                    elif dy > 0:
+                        dy -= 1
+                    elif dy < 0:
+                        dy += 1
+                else:
+                    # adding only the edge is enough
+                    break
+        _circle_stencils[key] = offsets
+    return _circle_stencils[key]
+
+
+def _pack_area(area):
+    """
+    Describes a rectangular area by its corners (x1, y1, x2, y2), see Map.pack().
+    """
+    return area.x1, area.y1, area.x2, area.y2
+
+
+def _unpack_area(map, corners):
+    """
+    Recreates an area from the result of _pack_area().
+    """
+    x1, y1, x2, y2 = corners
+    return Room(map, x1, y1, x2 - x1, y2 - y1)
+
+
+def _encode_none(value):
+    """
+    Encodes an optional integer for storage in a tile layer array, None is stored as -1.
+    """
+    if value is None:
+        return -1
+    return value
+
+
+def _decode_none(value):
+    """
+    Decodes an optional integer stored in a tile layer array.
+    """
+    if value == -1:
+        return None
+    return value
+
+
 class Tile(object):
     """
     represents a Tile on the map
+    The tile data is stored in the layers of the map, a Tile object is a lightweight view on these layers.
     """
 
+    __slots__ = ["_map", "_x", "_y", "_index", "_actors", "_json", "_type"]
+
     @property
     def x(self):
         """
         Returns x coordinate of tile relevant to map
         """
-        return self.json["x"]
+        return self._x
 
     @property
     def y(self):
         """
         Returns y coordinate of tile relevant to map
         """
-        return self.json["y"]
+        return self._y
 
     @property
     def map(self):
@@ -796,37 +1408,47 @@ class Tile(object):
         """
         Returns a boolean indicating if this tile has been explored.
         """
-        return self.json["explored"]
+        return self._map._explored[self._index] == 1
 
     @explored.setter
     def explored(self, isExplored):
-        self.json["explored"] = isExplored
+        self._map._explored[self._index] = isExplored
+        if self._json is not None:
+            self._json["explored"] = isExplored
 
     @property
     def blocked(self):
         """
         Returns a boolean indicating if this tile is blocked.
         """
-        return self.json["blocked"]
+        return self._map._blocked[self._index] == 1
 
     @blocked.setter
     def blocked(self, isBlocked):
-        self.json["blocked"] = isBlocked
+        if self._map._blocked[self._index] != isBlocked:
+            self._map._blocked[self._index] = isBlocked
+            self._map._blocked_version += 1
+            self._map._update_free_tile(self._index)
+        if self._json is not None:
+            self._json["blocked"] = isBlocked
         # Blocked tiles also block line of sight
         # TODO: Potential development would be windows and fences (block movement but not sight)
         if isBlocked is True:
-            self._block_sight = True
+            self.blockSight = True
 
     @property
     def blockSight(self):
         """
         Returns a boolean indicating if this tile blocks line of sight.
         """
-        return self.json["blockSight"]
+        return self._map._block_sight[self._index] == 1
 
     @blockSight.setter
     def blockSight(self, blocksLineOfSight):
-        self.json["blockSight"] = blocksLineOfSight
+        self._map._block_sight[self._index] = blocksLineOfSight
+        if self._json is not None:
+            self._json["blockSight"] = blocksLineOfSight
+        self.map.update_solid_tile(self)
 
     @property
     def inView(self):
@@ -834,11 +1456,13 @@ class Tile(object):
         Returns if this tile is in the player field of vision.
         This is set by the game engine during each turn.
         """
-        return self.json["inView"]
+        return self._map._in_view[self._index] == 1
 
     @inView.setter
     def inView(self, new_in_view):
-        self.json["inView"] = new_in_view
+        self._map._in_view[self._index] = new_in_view
+        if self._json is not None:
+            self._json["inView"] = new_in_view
     
     @property
     def actors(self):
@@ -861,11 +1485,13 @@ class Tile(object):
         """
         Property to store the material type of the tile.
         """
-        return self.json["material"]
+        return self._map._material[self._index]
     
     @material.setter
     def material(self, newMaterial):
-        self.json["material"] = newMaterial
+        self._map._material[self._index] = newMaterial
+        if self._json is not None:
+            self._json["material"] = newMaterial
 
     @property
     def texture_hash(self):
@@ -873,34 +1499,9 @@ class Tile(object):
         Integer hash representing the tile and the surrounding tiles.
         This hash can be used to decide which texture to use for the tile.
         """
-        if self.json["texture_hash"] is None:
-            x = self.x
-            y = self.y
-            # Take binary representation of surrounding tiles
-            bits = [1, 1, 1, 1, 1, 1, 1, 1, 1]
-            if 0 <= y - 1:
-                if 0 <= x - 1:
-                    if not self.map.tiles[x - 1][y - 1].blockSight: bits[0] = 0
-                if not self.map.tiles[x][y - 1].blockSight: bits[1] = 0
-                if x + 1 < self.map.width:
-                    if not self.map.tiles[x + 1][y - 1].blockSight: bits[2] = 0
-            if 0 <= x - 1:
-                if not self.map.tiles[x - 1][y].blockSight: bits[3] = 0
-            if not self.map.tiles[x][y].blockSight: bits[4] = 0
-            if x + 1 < self.map.width:
-                if not self.map.tiles[x + 1][y].blockSight: bits[5] = 0
-            if y + 1 < self.map.height:
-                if 0 <= x - 1:
-                    if not self.map.tiles[x - 1][y + 1].blockSight: bits[6] = 0
-                if not self.map.tiles[x][y + 1].blockSight: bits[7] = 0
-                if x + 1 < self.map.width:
-                    if not self.map.tiles[x + 1][y + 1].blockSight: bits[8] = 0
-            # Transform binary to integer hash
-            h = 0
-            for bit in bits:
-                h = (h << 1) | bit
-            self.json["texture_hash"] = h
-        return self.json["texture_hash"]
+        if self._map._texture_hash[self._index] == -1:
+            self._map.compute_texture_hashes()
+        return self._map._texture_hash[self._index]
 
     @property
     def texture_set(self):
@@ -908,11 +1509,13 @@ class Tile(object):
         Property to store the texture set id for this tile.
         The GUI can use this to visualize the tile.
         """
-        return self.json["texture_set"]
+        return _decode_none(self._map._texture_set[self._index])
 
     @texture_set.setter
     def texture_set(self, new_texture_set):
-        self.json["texture_set"] = new_texture_set
+        self._map._texture_set[self._index] = _encode_none(new_texture_set)
+        if self._json is not None:
+            self._json["texture_set"] = new_texture_set
 
     @property
     def texture_id(self):
@@ -920,22 +1523,26 @@ class Tile(object):
         Property to store the tile set texture id for this tile.
         The GUI can use this to visualize the tile.
         """
-        return self.json["texture_id"]
+        return _decode_none(self._map._texture_id[self._index])
 
     @texture_id.setter
     def texture_id(self, new_texture_id):
-        self.json["texture_id"] = new_texture_id
+        self._map._texture_id[self._index] = _encode_none(new_texture_id)
+        if self._json is not None:
+            self._json["texture_id"] = new_texture_id
 
     @property
     def color(self):
         """
         Returns the preferred color of this tile.
         """
-        return self.json["color"]
+        return self._map._palette[self._map._color[self._index]]
     
     @color.setter
     def color(self, newColor):
-        self.json["color"] = newColor
+        self._map._color[self._index] = self._map._color_index(newColor)
+        if self._json is not None:
+            self._json["color"] = newColor
     
     @property
     def type(self):
@@ -948,54 +1555,48 @@ class Tile(object):
     def type(self, newType):
         self._type = newType
 
-    # DEPRECATED
-    # @property
-    # def sceneObject(self):
-    #     '''
-    #     Property used to store the scene object that represents this tile in the GUI.
-    #     :return: SceneObject
-    #     '''
-    #     return self._sceneObject
-    #
-    # @sceneObject.setter
-    # def sceneObject(self, sceneObject):
-    #     self._sceneObject = sceneObject
-
     @property
     def json(self):
         """
         Json dictionary representation of the tile.
         This will contain the data elements that are needed for the game client to function.
+        It is created from the map layers on first use and kept up to date afterwards.
         :return: Json dictionary object
         """
+        if self._json is None:
+            self._json = {
+                "x": self.x,
+                "y": self.y,
+                "explored": self.explored,
+                "blocked": self.blocked,
+                "blockSight": self.blockSight,
+                "material": self.material,
+                "texture_hash": _decode_none(self._map._texture_hash[self._index]),
+                "texture_set": self.texture_set,
+                "texture_id": self.texture_id,
+                "inView": self.inView,
+                "color": self.color,
+                "actors": {id(actor): actor.json for actor in self._actors}
+            }
         return self._json
     
     def __init__(self, map, x, y):
         """
         Constructor to create a new tile, all tiles are created empty
         (unexplored, unblocked and not blocking line of sight)
+        The tile data itself lives in the layers of the map, see Map.create_tiles().
         Arguments
             map - Map object of which this tile is a part
             x - x coordinate of the tile on the map
             y - y coordinate of the tile on the map
         """
         self._map = map
-        self._json = {}
-        self.json["x"] = x
-        self.json["y"] = y
-        self.json["explored"] = False
-        self.json["blocked"] = False
-        self.json["blockSight"] = False
-        self.json["material"] = MaterialType.NONE
-        self.json["texture_hash"] = None
-        self.json["texture_set"] = None
-        self.json["texture_id"] = None
-        self.json["inView"] = True
-        self.json["color"] = TILE_DEFAULT_COLOR
+        self._x = x
+        self._y = y
+        self._index = x * map.height + y
         self._actors = []
-        self.json["actors"] = {}
-        # DEPRECATED
-        # self._sceneObject = None
+        self._json = None
+        self._type = None
 
     def __str__(self):
         """
@@ -1008,12 +1609,18 @@ class Tile(object):
         """
         This function adds an actor to this tile
         """
+        # Actors are visible when the tile they move onto is visible
+        myActor.inView = self.inView
         self._actors.append(myActor)
-        self.json["actors"][id(myActor)] = myActor.json
+        self._map._update_free_tile(self._index)
+        if self._json is not None:
+            self._json["actors"][id(myActor)] = myActor.json
 
     def removeActor(self, myActor):
         """
         This function removes an actor from this tile
         """
         self._actors.remove(myActor)
-        del self.json["actors"][id(myActor)]
\ No newline at end of file
+        self._map._update_free_tile(self._index)
+        if self._json is not None:
+            del self._json["actors"][id(myActor)]
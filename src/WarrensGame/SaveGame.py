@@ -0,0 +1,334 @@
+"""
+This module implements saving and loading of a Game or World.
+
+A save starts with a header (magic bytes and the format version) followed by a zlib compressed body.
+The body only contains plain values (numbers, strings, bytes, lists, tuples and dicts). The game objects
+are stored in tables and refer to each other by index, levels, actors and effects share one index space:
+    levels  - one record per level, including its map, see Map.pack()
+    actors  - one record per actor, inventories, portals and equipment refer to actor indexes
+    effects - one record per effect
+Loading rebuilds the object graph from these tables, nothing is generated again.
+"""
+
+import io
+import pickle
+import struct
+import zlib
+
+from WarrensGame.Actors import Portal, Chest, Player, NPC, Monster, Item, Equipment, Consumable, QuestItem
+from WarrensGame.AI import BasicMonsterAI, ConfusedMonsterAI
+from WarrensGame.Effects import DamageEffect, HealEffect, ConfuseEffect
+from WarrensGame.Levels import TownLevel, DungeonLevel, SingleRoomLevel, CaveLevel
+from WarrensGame.Libraries import BaseMonster, BaseItem, ItemModifier, MonsterModifier, MonsterLibrary, ItemLibrary
+import WarrensGame.Maps as Maps
+from WarrensGame.Utilities import GameError
+
+# File format
+MAGIC = b"WARRENS\x00"
+VERSION = 1
+_HEADER = struct.Struct("<8sH")
+
+# Classes that can occur in a save, by name
+_CLASSES = {cls.__name__: cls for cls in [
+    TownLevel, DungeonLevel, SingleRoomLevel, CaveLevel,
+    Maps.DungeonMap, Maps.TownMap, Maps.SingleRoomMap, Maps.CaveMap,
+    Portal, Chest, Player, NPC, Monster, Item, Equipment, Consumable, QuestItem,
+    BasicMonsterAI, ConfusedMonsterAI,
+    DamageEffect, HealEffect, ConfuseEffect]}
+
+
+def save_game(owner, file_name):
+    """
+    Saves a Game or World to a file.
+    :param owner: Game or World object
+    :param file_name: File to save to.
+    :return: None
+    """
+    data = pack_game(owner)
+    with open(file_name, "wb") as save_file:
+        save_file.write(data)
+
+
+def load_game(owner, file_name):
+    """
+    Loads the state of a Game or World from a file, the current state of the owner is replaced.
+    :param owner: Game or World object of the same type as the one that was saved
+    :param file_name: File to load from.
+    :return: None
+    """
+    with open(file_name, "rb") as save_file:
+        data = save_file.read()
+    unpack_game(owner, data)
+
+
+def pack_game(owner):
+    """
+    Packs a Game or World into bytes in the save format.
+    :param owner: Game or World object
+    :return: bytes
+    """
+    record = Packer(owner).pack_owner(owner)
+    return _HEADER.pack(MAGIC, VERSION) + zlib.compress(dump_record(record))
+
+
+def unpack_game(owner, data):
+    """
+    Restores the state of a Game or World from bytes created by pack_game().
+    :param owner: Game or World object of the same type as the one that was packed
+    :param data: bytes
+    :return: None
+    """
+    if len(data) < _HEADER.size:
+        raise GameError("Not a saved game, the data is too short.")
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise GameError("Not a saved game, unknown file header.")
+    if version != VERSION:
+        raise GameError("Unsupported save format version " + str(version) + ", expected " + str(VERSION))
+    record = load_record(zlib.decompress(data[_HEADER.size:]))
+    Unpacker(record).unpack_owner(owner)
+
+
+def dump_record(record):
+    """
+    Serializes a record of plain values, the result is not compressed.
+    Shared values are written out every time, so records that are equal give the same bytes.
+    :param record: plain values, for example a table created by Packer
+    :return: bytes
+    """
+    stream = io.BytesIO()
+    pickler = pickle.Pickler(stream, protocol=4)
+    pickler.fast = True
+    pickler.dump(record)
+    return stream.getvalue()
+
+
+def load_record(data):
+    """
+    Deserializes the result of dump_record(), data that refers to classes or functions is refused.
+    :param data: bytes
+    :return: plain values
+    """
+    return _PlainUnpickler(io.BytesIO(data)).load()
+
+
+class _PlainUnpickler(pickle.Unpickler):
+    """
+    Unpickler that only accepts plain values, a save can not refer to classes or functions.
+    """
+
+    def find_class(self, module, name):
+        raise GameError("Invalid save, it refers to " + module + "." + name)
+
+
+class Packer(object):
+    """
+    Converts the object graph of a game into tables of plain values.
+    Levels, actors and effects share one index space, every object gets an index the first time it is encountered.
+    Sub classes can provide other indexes and leave objects out of the tables, see index() and packs().
+    """
+
+    def __init__(self, owner):
+        self._monster_index = owner.monster_library.monster_index
+        self.levels = {}
+        self.actors = {}
+        self.effects = {}
+        self._indexes = {}
+
+    def index(self, game_object):
+        """
+        Returns the index of a level, actor or effect.
+        """
+        key = id(game_object)
+        if key not in self._indexes:
+            self._indexes[key] = len(self._indexes)
+        return self._indexes[key]
+
+    def packs(self, game_object):
+        """
+        Returns True if the given object should be packed in the tables.
+        Objects that are left out can still be referred to by their index.
+        """
+        return True
+
+    def pack_owner(self, owner):
+        """
+        Packs the Game or World and everything it refers to.
+        :return: Dictionary with the owner record and the tables
+        """
+        return {
+            "owner": owner.pack(self),
+            "levels": self.levels,
+            "actors": self.actors,
+            "effects": self.effects
+        }
+
+    def owner_record(self, owner):
+        """
+        Returns the part of the owner record that a Game and a World have in common, see World.pack().
+        """
+        return {
+            "class": type(owner).__name__,
+            "levels": [self.level(level) for level in owner.levels],
+            "scheduler_time": owner.scheduler.time,
+            "unique_monsters": [self.actor(monster) for monster in owner.monster_library.unique_monsters],
+            "regular_monsters": [self.actor(monster) for monster in owner.monster_library.regular_monsters],
+            "library_items": [self.actor(item) for item in owner.item_library.items],
+            "random_streams": owner.random_streams.getstate()
+        }
+
+    def level(self, level):
+        """
+        Returns the index of a level, the level is packed if needed.
+        """
+        return self._table_entry(self.levels, level)
+
+    def actor(self, actor):
+        """
+        Returns the index of an actor, the actor is packed if needed.
+        """
+        return self._table_entry(self.actors, actor)
+
+    def effect(self, effect):
+        """
+        Returns the index of an effect, the effect is packed if needed.
+        """
+        return self._table_entry(self.effects, effect)
+
+    def base_monster(self, base_monster):
+        """
+        Returns the value that refers to the data of a monster.
+        Monsters from the library refer to their key, generated monsters bring their own data.
+        """
+        if self._monster_index.get(base_monster.key) is base_monster:
+            return base_monster.key
+        # The compiled dice are not saved, they are compiled again by BaseMonster
+        data = dict(base_monster)
+        del data["hitDice"]
+        return data
+
+    def _table_entry(self, table, game_object):
+        if game_object is None:
+            return None
+        index = self.index(game_object)
+        if index not in table and self.packs(game_object):
+            # Reserve the entry first, the object can be referred to while it is packed
+            table[index] = None
+            table[index] = game_object.pack(self)
+        return index
+
+
+class Unpacker(object):
+    """
+    Rebuilds the object graph of a game from the tables created by Packer.
+    All objects are created first without calling their constructors, after that they are filled in
+    so they can refer to each other.
+    """
+
+    def __init__(self, tables):
+        self._tables = tables
+        self.objects = {}
+        for table_name in ["levels", "actors", "effects"]:
+            for index, record in tables[table_name].items():
+                self.objects[index] = self.create(index, record)
+
+    def create(self, index, record):
+        """
+        Returns the object that will be filled in with the given record, by default a new object.
+        """
+        object_class = _CLASSES[record["class"]]
+        return object_class.__new__(object_class)
+
+    def get(self, index):
+        """
+        Returns the object for the given index.
+        """
+        if index is None:
+            return None
+        return self.objects[index]
+
+    def unpack_owner(self, owner):
+        """
+        Replaces the state of the Game or World with the unpacked one.
+        """
+        owner_record = self._tables["owner"]
+        if owner_record["class"] != type(owner).__name__:
+            raise GameError("Can't load a saved " + owner_record["class"] + " into a " + type(owner).__name__)
+        owner.unpack(owner_record, self)
+
+    def unpack_libraries(self, owner, owner_record):
+        """
+        Recreates the libraries of the owner and fills in the tables, the scheduler of the owner has to be set.
+        The libraries keep track of the monsters and items that exist.
+        :return: tuple (MonsterLibrary, ItemLibrary)
+        """
+        monster_library = MonsterLibrary(owner.random_streams)
+        item_library = ItemLibrary(owner.random_streams)
+        self.unpack_tables(owner, monster_library, item_library)
+        # Existing unique monsters can not be created again
+        for index in owner_record["unique_monsters"]:
+            monster_library.register_unique_monster(self.get(index))
+        return monster_library, item_library
+
+    def unpack_tables(self, owner, monster_library, item_library):
+        """
+        Fills in the levels, actors and effects of the tables.
+        :param owner: Game or World that owns the levels
+        :param monster_library: library that provides the monster data
+        :param item_library: library that provides the item data
+        """
+        self.monster_library = monster_library
+        self.item_library = item_library
+        levels = self._tables["levels"]
+        actors = self._tables["actors"]
+        for index, record in levels.items():
+            self.objects[index].unpack(record, self, owner)
+        for index, record in actors.items():
+            self.objects[index].unpack(record, self)
+        # The libraries keep track of the regular monsters and items that exist
+        for index in actors:
+            actor = self.objects[index]
+            if isinstance(actor, Monster) and not actor.baseMonster.get("unique", False):
+                monster_library.register_regular_monster(actor)
+            elif isinstance(actor, Item):
+                item_library.register_item(actor)
+        # Inventories index their items by base item and modifiers, they are filled in after the items
+        for index, record in actors.items():
+            self.objects[index].unpack_inventory(record, self)
+        for index, record in levels.items():
+            self.objects[index].unpack_tile_actors(record, self)
+        for index, record in self._tables["effects"].items():
+            self.objects[index].unpack(record, self)
+        for index in levels:
+            self.objects[index].schedule_actors()
+
+    def map(self, record, level):
+        """
+        Recreates the map of a level, see Map.unpack().
+        """
+        return _CLASSES[record["class"]].unpack(record, level)
+
+    def ai(self, character, record):
+        """
+        Recreates the AI of a character, None if the character has no AI. See AI.unpack().
+        """
+        if record is None:
+            return None
+        return _CLASSES[record["class"]].unpack(record, character, self)
+
+    def base_monster(self, value):
+        """
+        Returns the monster data for a value created by Packer.base_monster().
+        """
+        if isinstance(value, dict):
+            return BaseMonster(value)
+        return self.monster_library.monster_index[value]
+
+    def monster_modifier(self, data):
+        return MonsterModifier(data)
+
+    def base_item(self, key):
+        return BaseItem(self.item_library.item_index[key])
+
+    def item_modifier(self, key):
+        return ItemModifier(self.item_library.modifier_index[key])
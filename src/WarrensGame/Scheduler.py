@@ -0,0 +1,115 @@
+"""
+This module contains the turn scheduler of a Game or World.
+
+Characters and effects are kept in a heap ordered by the time of their next action, moving time forward only
+visits the entries that are due. Time is counted in scheduler units, one tick of the game is GAME.TICK units.
+An entry is an object with:
+    tick()            - makes the entry act
+    action_delay      - time until its next action, None if it can't act (anymore)
+    scheduled(delay)  - called when the entry is scheduled to act after the given delay
+"""
+
+import heapq
+import itertools
+
+
+class Scheduler(object):
+    """
+    Event driven scheduler, a heap of (next_action_time, sequence, entry).
+    Entries that act at the same time act in the order in which they were scheduled.
+    """
+
+    @property
+    def time(self):
+        """
+        The current time of the scheduler.
+        """
+        return self._time
+
+    @property
+    def actions(self):
+        """
+        Number of actions taken during the last call to advance().
+        """
+        return self._actions
+
+    def __init__(self, time=0):
+        """
+        Constructor for an empty scheduler.
+        :param time: start time, for example the time of a saved scheduler
+        """
+        self._time = time
+        self._actions = 0
+        self._heap = []
+        self._sequence = itertools.count()
+        # (sequence, action_time) of the heap item of every scheduled entry, other heap items are skipped when popped
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry):
+        return entry in self._entries
+
+    def schedule(self, entry, delay=None):
+        """
+        Schedules an entry, nothing happens if it is already scheduled or can't act.
+        :param entry: object with tick(), action_delay and scheduled()
+        :param delay: time until the first action, the action_delay of the entry is used if None
+        :return: None
+        """
+        if entry in self._entries:
+            return
+        if delay is None:
+            delay = entry.action_delay
+            if delay is None:
+                return
+        self._push(entry, self._time, delay)
+
+    def reschedule(self, entry, delay):
+        """
+        Moves a scheduled entry forward if its next action is later than the given delay from now.
+        :return: None
+        """
+        scheduled = self._entries.get(entry)
+        if scheduled is not None and scheduled[1] > self._time + delay:
+            self._push(entry, self._time, delay)
+
+    def unschedule(self, entry):
+        """
+        Removes an entry from the scheduler, it is safe to call this for an entry that is not scheduled.
+        """
+        self._entries.pop(entry, None)
+
+    def advance(self, duration):
+        """
+        Moves time forward, every entry that is due acts and is scheduled again after its action delay.
+        :param duration: amount of time to move forward
+        :return: number of actions taken
+        """
+        end_time = self._time + duration
+        heap = self._heap
+        entries = self._entries
+        self._actions = 0
+        while len(heap) > 0 and heap[0][0] <= end_time:
+            action_time, sequence, entry = heapq.heappop(heap)
+            if entries.get(entry) != (sequence, action_time):
+                continue
+            self._time = action_time
+            entry.tick()
+            self._actions += 1
+            # The entry stays registered while it acts, it is gone if it unscheduled itself
+            if entries.get(entry) == (sequence, action_time):
+                del entries[entry]
+                delay = entry.action_delay
+                if delay is not None:
+                    self._push(entry, action_time, max(1, delay))
+        self._time = end_time
+        return self._actions
+
+    def _push(self, entry, time, delay):
+        action_time = time + delay
+        entry.scheduled(delay)
+        sequence = next(self._sequence)
+        self._entries[entry] = (sequence, action_time)
+        heapq.heappush(self._heap, (action_time, sequence, entry))
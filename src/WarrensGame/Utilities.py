@@ -2,35 +2,222 @@
 Module with reusable utility functions
 """
 
+import hashlib
 import math
 import random
-from collections import deque
+from collections import deque, OrderedDict
 
 import WarrensGame.CONSTANTS as CONSTANTS
 
 
-def roll_hit_die(hitdie):
+class RandomStreams(object):
+    """
+    Registry with an independent random generator per subsystem, see CONSTANTS.RNG.
+    Every World and Game owns a registry so games in the same process don't influence each other.
+    Streams are reseeded in place so references to them stay valid.
+    """
+
+    def __init__(self, master_seed=None):
+        """
+        Constructor, creates the streams.
+        :param master_seed: seeds the streams, see seed(). The streams are seeded randomly if None.
+        """
+        self._streams = OrderedDict()
+        for name in [CONSTANTS.RNG.MAP, CONSTANTS.RNG.SPAWN, CONSTANTS.RNG.COMBAT, CONSTANTS.RNG.AI]:
+            self._streams[name] = random.Random()
+        if master_seed is not None:
+            self.seed(master_seed)
+
+    def stream(self, name):
+        """
+        Returns the random generator for the given subsystem.
+        :param name: name of the stream, see CONSTANTS.RNG
+        :return: random.Random object
+        """
+        return self._streams[name]
+
+    def seed(self, master_seed):
+        """
+        Seeds all streams from a master seed, every stream gets its own derived seed.
+        :param master_seed: the master seed, for example the seed of the world
+        :return: None
+        """
+        for name, stream in self._streams.items():
+            stream.seed(derive_seed(master_seed, name))
+
+    def getstate(self):
+        """
+        Returns the state of all streams, it can be restored with setstate().
+        :return: dictionary with the state per stream name
+        """
+        return {name: stream.getstate() for name, stream in self._streams.items()}
+
+    def setstate(self, states):
+        """
+        Restores the state of the streams.
+        :param states: dictionary created by getstate()
+        :return: None
+        """
+        for name, state in states.items():
+            self._streams[name].setstate(state)
+
+
+# Streams for objects that are not owned by a World or Game, for example a library on its own
+_default_streams = RandomStreams()
+
+
+def default_random_streams():
+    """
+    Returns the RandomStreams for objects that are not owned by a World or Game.
+    :return: RandomStreams object
+    """
+    return _default_streams
+
+
+def random_stream(name):
+    """
+    Returns the default random generator for the given subsystem, see CONSTANTS.RNG.
+    Objects that belong to a World or Game use the streams of their owner instead, see RandomStreams.
+    :param name: name of the stream
+    :return: random.Random object
+    """
+    return _default_streams.stream(name)
+
+
+def derive_seed(*parts):
+    """
+    Derives a 32 bit seed from the given parts, for example a master seed and a level index.
+    The result is the same on every platform and in every process.
+    :param parts: values that identify the seed
+    :return: integer seed
+    """
+    key = "/".join(str(part) for part in parts)
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def roll_hit_die(hitdie, rng=None):
     """
     this function simulates rolling hit dies and returns the resulting
     nbr of hitpoints. Hit dies are specified in the format xdy where
     x indicates the number of times that a die (d) with y sides is
     thrown. For example 2d6 means rolling 2 six sided dices.
     Arguments
-        hitdie - a string in hitdie format
+        hitdie - a string in hitdie format or a Dice object
+        rng - random generator to use, defaults to the default combat stream
     Returns
         integer number of hitpoints
     """
-    # interpret the hitdie string
-    d_index = hitdie.lower().index('d')
-    nbr_of_rolls = int(hitdie[0:d_index])
-    dice_size = int(hitdie[d_index + 1:])
-    # roll the dice
-    role_count = 0
-    hitpoints = 0
-    while role_count < nbr_of_rolls:
-        role_count += 1
-        hitpoints += random.randrange(1, dice_size)
-    return hitpoints
+    if not isinstance(hitdie, Dice):
+        hitdie = compile_dice(hitdie)
+    return hitdie.roll(rng)
+
+
+# Dice objects per hit die string, see compile_dice()
+_compiled_dice = {}
+
+
+def compile_dice(hitdie):
+    """
+    Returns the Dice object for a hit die string, every string is only parsed once.
+    :param hitdie: string in hitdie format, for example "2d6"
+    :return: Dice object
+    """
+    dice = _compiled_dice.get(hitdie)
+    if dice is None:
+        dice = Dice(hitdie)
+        _compiled_dice[hitdie] = dice
+    return dice
+
+
+class Dice(object):
+    """
+    A parsed hit die like "2d6", see roll_hit_die().
+    Every die rolls 1 to its number of sides, 3d6 rolls 3 to 18.
+    """
+
+    __slots__ = ("_hitdie", "_count", "_sides")
+
+    @property
+    def count(self):
+        """
+        Number of dice that are thrown.
+        """
+        return self._count
+
+    @property
+    def sides(self):
+        """
+        Number of sides of every die.
+        """
+        return self._sides
+
+    def __init__(self, hitdie):
+        """
+        Constructor, parses the hit die string.
+        :param hitdie: string in hitdie format, for example "2d6"
+        """
+        d_index = hitdie.lower().index('d')
+        self._hitdie = hitdie
+        self._count = int(hitdie[0:d_index])
+        self._sides = int(hitdie[d_index + 1:])
+
+    def __str__(self):
+        return self._hitdie
+
+    def roll(self, rng=None):
+        """
+        Rolls the dice once.
+        :param rng: random generator to use, defaults to the default combat stream
+        :return: integer total of the dice
+        """
+        if rng is None:
+            rng = random_stream(CONSTANTS.RNG.COMBAT)
+        if self._count == 1:
+            return rng.randint(1, self._sides)
+        randint = rng.randint
+        sides = self._sides
+        total = 0
+        for i in range(self._count):
+            total += randint(1, sides)
+        return total
+
+    def roll_many(self, n, rng=None):
+        """
+        Rolls the dice n times in one batch. The random bits for all the dice are drawn at once and split into
+        die results, every die takes the lowest bits it needs of one or more bytes. Results that are too high are
+        dropped and drawn again, this never happens when the number of sides is a power of two.
+        The rolls use other random numbers than calling roll() n times.
+        :param n: number of rolls
+        :param rng: random generator to use, defaults to the default combat stream
+        :return: list of n integer totals
+        """
+        if rng is None:
+            rng = random_stream(CONSTANTS.RNG.COMBAT)
+        count = self._count
+        sides = self._sides
+        needed = n * count
+        if needed <= 0:
+            return [0] * n
+        bits = (sides - 1).bit_length()
+        if bits == 0:
+            # Dice with one side always roll 1
+            return [count] * n
+        mask = (1 << bits) - 1
+        width = (bits + 7) // 8
+        # Draw a few extra dice when results can be dropped
+        spare = 0 if sides == mask + 1 else needed // 2 + 1
+        dice = []
+        while len(dice) < needed:
+            draws = needed - len(dice) + spare
+            data = rng.getrandbits(8 * width * draws).to_bytes(width * draws, "little")
+            if width == 1:
+                values = [value & mask for value in data]
+            else:
+                values = [int.from_bytes(data[i:i + width], "little") & mask for i in range(0, len(data), width)]
+            dice.extend(value + 1 for value in values if value < sides)
+        if count == 1:
+            return dice[:n]
+        return [sum(dice[i:i + count]) for i in range(0, needed, count)]
 
 
 def random_choice_index(chances):
@@ -203,11 +390,321 @@ def line_of_sight(matrix, x1, y1, x2, y2):
     This is a matrix created with make_matrix().
     matrix values of 0 or False are not solid, 1 or True are solid.
     """
-    segments = get_line_segments(x1, y1, x2, y2)
-    hits = [matrix[x][y] for x, y in segments]
-    amt = hits.count(True)
     # allow 1 case: if the final destination position is blocking
-    return amt == 0 or (amt == 1 and matrix[x2][y2])
+    for x, y in get_line_segments(x1, y1, x2, y2):
+        if matrix[x][y] and (x != x2 or y != y2):
+            return False
+    return True
+
+
+def line_of_sight_matrix(matrix, sources, targets, max_distance=None):
+    """
+    Checks line of sight between every source point and every target point, as line_of_sight() would.
+    Pairs further apart than max_distance are not traced and count as not in sight.
+    :param matrix: 2D matrix as used by line_of_sight()
+    :param sources: list of (x, y) tuples
+    :param targets: list of (x, y) tuples
+    :param max_distance: maximum distance that can be seen, None for no limit
+    :return: list with a row of True/False values for every source
+    """
+    limit = None if max_distance is None else max_distance * max_distance
+    rows = []
+    for x, y in sources:
+        row = []
+        for u, v in targets:
+            if limit is not None and (x - u) * (x - u) + (y - v) * (y - v) > limit:
+                row.append(False)
+            else:
+                row.append(line_of_sight(matrix, x, y, u, v))
+        rows.append(row)
+    return rows
+
+
+# Octant transformations used by the shadowcasting algorithm
+_OCTANT_MULTIPLIERS = [[1, 0, 0, -1, -1, 0, 0, 1],
+                       [0, 1, -1, 0, 0, -1, 1, 0],
+                       [0, 1, 1, 0, 0, -1, -1, 0],
+                       [1, 0, 0, 1, -1, 0, 0, -1]]
+
+
+def shadowcast(matrix, width, height, x, y, radius):
+    """
+    Returns the set of positions that are visible from (x, y) within the given radius.
+    Uses recursive shadowcasting so only positions within the radius are visited.
+    Solid positions that are hit by the light are visible themselves, this matches line_of_sight().
+
+    Source: http://www.roguebasin.com/index.php?title=FOV_using_recursive_shadowcasting
+
+    :param matrix: 2D matrix as used by line_of_sight(), 0 or False are not solid, 1 or True are solid
+    :param width: width of the matrix
+    :param height: height of the matrix
+    :param x: x coordinate of the origin
+    :param y: y coordinate of the origin
+    :param radius: maximum (Euclidean) distance that can be seen
+    :return: set of (x, y) tuples
+    """
+    visible = {(x, y)}
+    for octant in range(8):
+        _cast_light(matrix, width, height, x, y, 1, 1.0, 0.0, radius,
+                    _OCTANT_MULTIPLIERS[0][octant], _OCTANT_MULTIPLIERS[1][octant],
+                    _OCTANT_MULTIPLIERS[2][octant], _OCTANT_MULTIPLIERS[3][octant], visible)
+    return visible
+
+
+def _cast_light(matrix, width, height, cx, cy, row, start, end, radius, xx, xy, yx, yy, visible):
+    """
+    Private helper for shadowcast(), lights up one octant starting at the given row.
+    Positions outside of the matrix are treated as solid.
+    """
+    if start < end:
+        return
+    radius_squared = radius * radius
+    new_start = start
+    for j in range(row, int(radius) + 1):
+        dx = -j - 1
+        dy = -j
+        blocked = False
+        while dx <= 0:
+            dx += 1
+            # Translate the relative dx, dy coordinates into map coordinates
+            map_x = cx + dx * xx + dy * xy
+            map_y = cy + dx * yx + dy * yy
+            # l_slope and r_slope store the slopes of the left and right extremities of the current position
+            l_slope = (dx - 0.5) / (dy + 0.5)
+            r_slope = (dx + 0.5) / (dy - 0.5)
+            if start < r_slope:
+                continue
+            elif end > l_slope:
+                break
+            in_bounds = 0 <= map_x < width and 0 <= map_y < height
+            if in_bounds:
+                solid = matrix[map_x][map_y]
+                # The light beam touches this position, light it up
+                if dx * dx + dy * dy <= radius_squared:
+                    visible.add((map_x, map_y))
+            else:
+                solid = True
+            if blocked:
+                # We are scanning a row of solid positions
+                if solid:
+                    new_start = r_slope
+                    continue
+                else:
+                    blocked = False
+                    start = new_start
+            elif solid and j < radius:
+                # This is a solid position, start a child scan
+                blocked = True
+                _cast_light(matrix, width, height, cx, cy, j + 1, start, l_slope, radius, xx, xy, yx, yy, visible)
+                new_start = r_slope
+        # Row is scanned, do the next row unless the last position was solid
+        if blocked:
+            break
+
+
+class IndexSet(object):
+    """
+    Set of integers that supports adding, removing and picking a random element in constant time.
+    The elements are kept in a list, a dictionary keeps track of their position in that list.
+    """
+    __slots__ = ["_items", "_positions"]
+
+    def __init__(self, items=()):
+        self._items = []
+        self._positions = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._positions
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, item):
+        """
+        Add an element to the set.
+        """
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        """
+        Remove an element from the set if it is present.
+        The last element takes the place of the removed one.
+        """
+        position = self._positions.pop(item, None)
+        if position is None:
+            return
+        last_item = self._items.pop()
+        if last_item != item:
+            self._items[position] = last_item
+            self._positions[last_item] = position
+
+    def random_choice(self, rng=random):
+        """
+        Returns a randomly selected element or None if the set is empty.
+        :param rng: random generator to use, defaults to the random module
+        """
+        if len(self._items) == 0:
+            return None
+        return self._items[rng.randrange(len(self._items))]
+
+
+class SpatialGrid(object):
+    """
+    Bucketed grid of objects on a map. The objects are kept in square cells keyed by (x // cell_size,
+    y // cell_size), objects near a position are found by only looking at the cells around it.
+    The cells are OrderedDicts so the results do not depend on hashing.
+    """
+    __slots__ = ["_cell_size", "_cells", "_positions"]
+
+    def __init__(self, cell_size):
+        self._cell_size = cell_size
+        self._cells = OrderedDict()
+        self._positions = OrderedDict()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, item):
+        return item in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def add(self, item, x, y):
+        """
+        Add an element at position (x, y), an element that is already in the grid is moved.
+        """
+        cell_size = self._cell_size
+        cell = (x // cell_size, y // cell_size)
+        position = self._positions.get(item)
+        if position is not None:
+            old_cell = (position[0] // cell_size, position[1] // cell_size)
+            if old_cell != cell:
+                self._discard_from_cell(item, old_cell)
+                self._add_to_cell(item, cell)
+        else:
+            self._add_to_cell(item, cell)
+        self._positions[item] = (x, y)
+
+    def discard(self, item):
+        """
+        Remove an element from the grid if it is present.
+        """
+        position = self._positions.pop(item, None)
+        if position is not None:
+            self._discard_from_cell(item, (position[0] // self._cell_size, position[1] // self._cell_size))
+
+    def within_radius(self, x, y, radius):
+        """
+        Returns the elements within a (Euclidean) radius around (x, y).
+        """
+        cell_size = self._cell_size
+        cells = self._cells
+        positions = self._positions
+        radius_squared = radius * radius
+        result = []
+        for cx in range(int((x - radius) // cell_size), int((x + radius) // cell_size) + 1):
+            for cy in range(int((y - radius) // cell_size), int((y + radius) // cell_size) + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    continue
+                for item in cell:
+                    ix, iy = positions[item]
+                    if (ix - x) ** 2 + (iy - y) ** 2 <= radius_squared:
+                        result.append(item)
+        return result
+
+    def within_rect(self, x1, y1, x2, y2):
+        """
+        Returns the elements in the rectangle from (x1, y1) to (x2, y2), borders included.
+        """
+        cell_size = self._cell_size
+        cells = self._cells
+        positions = self._positions
+        result = []
+        for cx in range(x1 // cell_size, x2 // cell_size + 1):
+            for cy in range(y1 // cell_size, y2 // cell_size + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    continue
+                for item in cell:
+                    ix, iy = positions[item]
+                    if x1 <= ix <= x2 and y1 <= iy <= y2:
+                        result.append(item)
+        return result
+
+    def nearest(self, x, y, accept=None, max_distance=None):
+        """
+        Returns the element closest to (x, y), None if there is none.
+        The cells are searched in rings around (x, y) until no closer element can be found.
+        :param accept: optional function that tells which elements qualify
+        :param max_distance: optional maximum distance
+        """
+        if len(self._positions) == 0:
+            return None
+        cell_size = self._cell_size
+        cells = self._cells
+        positions = self._positions
+        cx, cy = x // cell_size, y // cell_size
+        if max_distance is None:
+            last_ring = max(max(abs(kx - cx), abs(ky - cy)) for kx, ky in cells)
+            max_squared = None
+        else:
+            last_ring = int(max_distance) // cell_size + 1
+            max_squared = max_distance * max_distance
+        best = None
+        best_squared = None
+        for ring in range(last_ring + 1):
+            # Elements in this ring are at least (ring - 1) cells away
+            if best is not None and ((ring - 1) * cell_size) ** 2 > best_squared:
+                break
+            for cell_key in _ring_cells(cx, cy, ring):
+                cell = cells.get(cell_key)
+                if cell is None:
+                    continue
+                for item in cell:
+                    ix, iy = positions[item]
+                    squared = (ix - x) ** 2 + (iy - y) ** 2
+                    if max_squared is not None and squared > max_squared:
+                        continue
+                    if best is not None and squared >= best_squared:
+                        continue
+                    if accept is None or accept(item):
+                        best = item
+                        best_squared = squared
+        return best
+
+    def _add_to_cell(self, item, cell):
+        items = self._cells.get(cell)
+        if items is None:
+            items = self._cells[cell] = OrderedDict()
+        items[item] = None
+
+    def _discard_from_cell(self, item, cell):
+        items = self._cells[cell]
+        del items[item]
+        if len(items) == 0:
+            del self._cells[cell]
+
+
+def _ring_cells(cx, cy, ring):
+    """
+    Returns the cells on the square ring at a distance of ring cells around cell (cx, cy).
+    """
+    if ring == 0:
+        return [(cx, cy)]
+    cells = [(x, cy - ring) for x in range(cx - ring, cx + ring + 1)]
+    cells.extend((x, cy + ring) for x in range(cx - ring, cx + ring + 1))
+    cells.extend((cx - ring, y) for y in range(cy - ring + 1, cy + ring))
+    cells.extend((cx + ring, y) for y in range(cy - ring + 1, cy + ring))
+    return cells
 
 
 class GameError(Exception):
@@ -3,11 +3,22 @@ Created on June 21, 2019
 @author: Frostlock
 """
 
-from WarrensGame.CONSTANTS import WORLD, GAME
-from WarrensGame.Levels import TownLevel, DungeonLevel, CaveLevel
+import os
+import random
+import tempfile
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from WarrensGame.CONSTANTS import WORLD, GAME, RNG
+from WarrensGame.Levels import TownLevel, DungeonLevel, CaveLevel, build_level_map
 from WarrensGame.Libraries import *
 import WarrensGame.Utilities as Utilities
+import WarrensGame.SaveGame as SaveGame
+from WarrensGame.Database import Database
+from WarrensGame.Scheduler import Scheduler
 from WarrensGame.Actors import Player
+from WarrensGame.AI import ThinkingPolicy
 # from WarrensGame.Maps import *
 
 
@@ -43,6 +54,21 @@ class World(object):
         """
         return self._levels
 
+    @property
+    def seed(self):
+        """
+        The master seed of the world.
+        The random streams and the seeds of the levels are derived from it.
+        """
+        return self._seed
+
+    @property
+    def random_streams(self):
+        """
+        The random streams of this world, see Utilities.RandomStreams.
+        They are seeded from the master seed of the world.
+        """
+        return self._random_streams
 
     # @property
     # def active_effects(self):
@@ -52,6 +78,27 @@ class World(object):
     #     """
     #     return self._activeEffects
 
+    @property
+    def scheduler(self):
+        """
+        The scheduler that decides which characters and effects act in a tick.
+        """
+        return self._scheduler
+
+    @property
+    def thinking_policy(self):
+        """
+        The level of detail policy of the AI in this world, see AI.ThinkingPolicy.
+        """
+        return self._thinking_policy
+
+    @property
+    def level_manager(self):
+        """
+        The level manager that hibernates levels to keep the number of levels in memory within its budget.
+        """
+        return self._level_manager
+
     @property
     def monster_library(self):
         """
@@ -66,21 +113,32 @@ class World(object):
         """
         return self._itemLibrary
 
-    def __init__(self):
+    def __init__(self, seed=None):
         """
         Constructor to create a new world
+        :param seed: master seed of the world, worlds with the same seed are identical. A random seed is used if None.
         :return : World object
         """
+        # Initialize the random streams
+        if seed is None:
+            seed = random.getrandbits(32)
+        self._seed = seed
+        self._random_streams = Utilities.RandomStreams(seed)
         # Initialize class variables
         self._players = []
         self._levels = []
         self._world_time = 0  # Running total of game time (in milliseconds)
         self._tick_time = 0  # Time spent in the current tick (in milliseconds)
         self._tick_speed = GAME.SPEED  # Speed of game ticks in milliseconds (how fast the game moves)
+        self._scheduler = Scheduler()
+        self._thinking_policy = ThinkingPolicy()
 
         # Initialize libraries
-        self._monsterLibrary = MonsterLibrary()
-        self._itemLibrary = ItemLibrary()
+        self._monsterLibrary = MonsterLibrary(self.random_streams)
+        self._itemLibrary = ItemLibrary(self.random_streams)
+
+        # Levels that are not visited for a while are hibernated
+        self._level_manager = LevelManager(self)
 
         # Clean up
         Utilities.reset_utility_queues()
@@ -91,14 +149,17 @@ class World(object):
     def _generate_world(self):
         """
         Private method that handles the procedural generation of the world.
-        It will generate several levels and the levels will be populated with Actors.
+        It will create several levels and the portals that connect them. Apart from the town the levels are
+        stubs that are generated and populated with Actors when a player enters them, see Level.generate().
         :return: None
         """
         # Generate a town level
         level_name = "Town"
         level_difficulty = 1
         Utilities.message("Creating level: " + level_name + '(difficulty:' + str(level_difficulty) + ')', "GENERATION")
-        town = TownLevel(self, level_difficulty, level_name)
+        town = TownLevel(self, level_difficulty, level_name, self._level_seed())
+        # The town is where players start, the other levels are generated when they are first visited
+        town.generate()
         self._levels.append(town)
         self._currentLevel = town
 
@@ -112,9 +173,79 @@ class World(object):
         # Add some cave levels
         # Caves are connected to town and to some other random level
         for i in range(1, WORLD.CAVE_LEVELS + 1):
-            random_level = random.choice(self.levels)
+            random_level = self.random_streams.stream(RNG.MAP).choice(self.levels)
             self._add_cave_level(2, [town, random_level])
 
+    def generate_levels(self, processes=None):
+        """
+        Generates all the levels that are still stubs instead of waiting for players to visit them.
+        The maps are built in parallel by a pool of processes. Every level has its own seed so the result is
+        identical to generating the levels one by one. The maps are handed back to their levels in this process
+        where the portals are placed and the levels are populated.
+        :param processes: Number of processes to use, defaults to the number of CPUs. 1 generates without a pool.
+        :return: None
+        """
+        stubs = []
+        for level in self.levels:
+            for stub in [level] + level.subLevels:
+                if not stub.generated:
+                    stubs.append(stub)
+        if processes == 1:
+            for level in stubs:
+                level.generate()
+            return
+        with ProcessPoolExecutor(processes) as executor:
+            futures = [executor.submit(build_level_map, level.seed, *level.map_recipe) for level in stubs]
+            for level, future in zip(stubs, futures):
+                level.generate(future.result())
+
+    def _level_seed(self):
+        """
+        Private method that returns the seed for the next level, it is derived from the world seed and the level index.
+        :return: integer seed
+        """
+        return Utilities.derive_seed(self.seed, "level", len(self._levels))
+
+    def level_generated(self, level):
+        """
+        Called by a level when it was generated, the level manager keeps it within its budget.
+        :param level: Level that was generated
+        :return: None
+        """
+        self._level_manager.add(level)
+
+    def pack(self, packer):
+        """
+        Returns the state of the world in plain values, see SaveGame.Packer.
+        :param packer: SaveGame.Packer that packs the levels, actors and effects
+        :return: Dictionary
+        """
+        record = packer.owner_record(self)
+        record["current_level"] = packer.level(self._currentLevel)
+        record["players"] = [packer.actor(player) for player in self.players]
+        record["seed"] = self.seed
+        record["world_time"] = self._world_time
+        record["tick_time"] = self._tick_time
+        return record
+
+    def unpack(self, record, unpacker):
+        """
+        Replaces the state of the world with the result of pack().
+        :param record: Dictionary created by pack()
+        :param unpacker: SaveGame.Unpacker that provides the levels, actors and effects
+        :return: None
+        """
+        self._scheduler = Scheduler(record["scheduler_time"])
+        self._monsterLibrary, self._itemLibrary = unpacker.unpack_libraries(self, record)
+        self._levels = [unpacker.get(index) for index in record["levels"]]
+        self._currentLevel = unpacker.get(record["current_level"])
+        self._players = [unpacker.get(index) for index in record["players"]]
+        self._seed = record["seed"]
+        self._world_time = record["world_time"]
+        self._tick_time = record["tick_time"]
+        self._level_manager.reset()
+        self.random_streams.setstate(record["random_streams"])
+
     def _add_dungeon_level(self, difficulty, connected_levels):
         """
         Private method to add a dungeon level to the world.
@@ -124,17 +255,17 @@ class World(object):
         """
         level_name = 'Dungeon level ' + str(difficulty)
         Utilities.message("Creating level: " + level_name + '(difficulty:' + str(difficulty) + ')', "GENERATION")
-        dungeon_level = DungeonLevel(self, difficulty, level_name)
+        dungeon_level = DungeonLevel(self, difficulty, level_name, self._level_seed())
         self._levels.append(dungeon_level)
         for lvl in connected_levels:
             # Add portal in previous level to current level
             down_portal = Portal('>', 'stairs down', 'You follow the stairs down, looking for more adventure.')
             down_portal.sprite_id = SPRITES.STAIRS_DOWN
-            down_portal.moveToLevel(lvl, lvl.getRandomEmptyTile())
+            lvl.placePortal(down_portal)
             # Add portal in current level to previous level
             up_portal = Portal('<', 'stairs up', 'You follow the stairs up, hoping to find the exit.')
             up_portal.sprite_id = SPRITES.STAIRS_UP
-            up_portal.moveToLevel(dungeon_level, dungeon_level.getRandomEmptyTile())
+            dungeon_level.placePortal(up_portal)
             # Connect the two portals
             down_portal.connectTo(up_portal)
 
@@ -147,7 +278,7 @@ class World(object):
         """
         level_name = 'Cave of the Cannibal'
         Utilities.message("Creating level: " + level_name + '(difficulty:' + str(difficulty) + ')', "GENERATION")
-        cave_level = CaveLevel(self, difficulty, level_name)
+        cave_level = CaveLevel(self, difficulty, level_name, self._level_seed())
         self._levels.append(cave_level)
 
         # For each connected level
@@ -156,10 +287,10 @@ class World(object):
             pit_message = 'You jump into the pit. As you fall deeper and deeper, you realize you didn\'t ' \
                       'think about how to get back out afterward...'
             down_portal = Portal('>', 'Pit', pit_message)
-            down_portal.moveToLevel(lvl, lvl.getRandomEmptyTile())
+            lvl.placePortal(down_portal)
             # create a portal in the new cave that leads back
             up_portal = Portal('<', 'Opening above', 'After great difficulties you manage to get out of the pit.')
-            up_portal.moveToLevel(cave_level, cave_level.getRandomEmptyTile())
+            cave_level.placePortal(up_portal)
             # connect the two portals
             down_portal.connectTo(up_portal)
 
@@ -168,7 +299,7 @@ class World(object):
         Adds a new player to the world.
         :return : Player
         """
-        player = Player()
+        player = Player(self.random_streams.stream(RNG.SPAWN))
         self.players.append(player)
         first_level = self.levels[0]
         player.moveToLevel(first_level, first_level.getRandomEmptyTile())
@@ -225,6 +356,23 @@ class World(object):
                           + 'unknown. Good luck!', "GAME")
         return player
 
+    def save_game(self, file_name):
+        """
+        Saves the state of the world to a file, see SaveGame for the file format.
+        :param file_name: File to save to.
+        :return : None
+        """
+        SaveGame.save_game(self, file_name)
+
+    def load_game(self, file_name):
+        """
+        Loads the state of the world from a file, see SaveGame for the file format.
+        The current levels and players are replaced, nothing is generated.
+        :param file_name: File to load from.
+        :return : None
+        """
+        SaveGame.load_game(self, file_name)
+
     def play(self, added_time):
         """
         This function moves time forward in the world.
@@ -240,11 +388,11 @@ class World(object):
     def tick(self):
         """
         This function triggers an action tick for the world.n action moves time forward in the world.
-        It will be propagated to all underlying game objects.
+        Only the characters and effects that are due act, see Scheduler.
         :return : None
         """
-        for level in self.levels:
-            level.tick()
+        self._scheduler.advance(GAME.TICK)
+        self._level_manager.update()
 
         # # Wait for player to take action
         # if self.player.actionTaken:
@@ -307,3 +455,162 @@ class World(object):
     #         return targets
     #     else:
     #         raise GameError("Unknown effect type")
+
+
+class LevelManager(object):
+    """
+    The LevelManager keeps the number of levels in memory within a budget.
+    When there are too many, the least recently visited levels without players are saved to a database and dropped
+    from memory (hibernated). A hibernated level is loaded again when a player follows a portal to it or when its
+    map is needed, see Level.wake().
+    """
+
+    @property
+    def budget(self):
+        """
+        Maximum number of generated levels in memory, None for no limit.
+        """
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        self._budget = budget
+
+    @property
+    def database(self):
+        """
+        The database that stores the hibernated levels, None until the first level is hibernated.
+        """
+        return self._database
+
+    @property
+    def resident_levels(self):
+        """
+        The generated levels that are in memory.
+        """
+        return list(self._resident)
+
+    @property
+    def hibernated_levels(self):
+        """
+        The levels that are hibernated.
+        """
+        return list(self._hibernated)
+
+    def __init__(self, owner, budget=WORLD.RESIDENT_LEVELS, database=None):
+        """
+        Constructor
+        :param owner: World or Game that owns the levels
+        :param budget: maximum number of generated levels in memory, None for no limit
+        :param database: Database to store the hibernated levels in. If None a database is created in a
+            temporary file in WORLD.HIBERNATION_DIRECTORY when the first level is hibernated, the file is removed
+            when the database is no longer used.
+        """
+        self._owner = owner
+        self._budget = budget
+        self._database = database
+        # The generated levels that are in memory and the ones that are hibernated, in order of arrival
+        self._resident = OrderedDict()
+        self._hibernated = OrderedDict()
+        # Levels are ranked by the update in which a player was last on them
+        self._clock = 0
+        self._last_visit = weakref.WeakKeyDictionary()
+
+    def add(self, level):
+        """
+        Adds a level that was generated, it counts against the budget from now on.
+        """
+        self._resident[level] = None
+
+    def reset(self):
+        """
+        Forgets the levels and adds the generated levels of the owner again, used when the levels of the owner
+        were replaced by loading a saved game.
+        """
+        self._resident = OrderedDict()
+        self._hibernated = OrderedDict()
+        self._last_visit = weakref.WeakKeyDictionary()
+        for level in self._all_levels():
+            if level.hibernated:
+                self._hibernated[level] = None
+            elif level.generated:
+                self._resident[level] = None
+
+    def update(self):
+        """
+        Registers the levels that have players on them and hibernates the least recently visited levels
+        until the budget is met. Levels with players are never hibernated.
+        :return: list of levels that were hibernated
+        """
+        self._clock += 1
+        resident = self._resident
+        for level in resident:
+            if level.player_present:
+                self._last_visit[level] = self._clock
+        if self._budget is None or len(resident) <= self._budget:
+            return []
+        candidates = [level for level in resident if not level.player_present]
+        candidates.sort(key=lambda level: self._last_visit.get(level, 0))
+        hibernated = candidates[:len(resident) - self._budget]
+        for level in hibernated:
+            self.hibernate(level)
+        return hibernated
+
+    def hibernate(self, level):
+        """
+        Saves a level in the database and drops it from memory.
+        """
+        self._get_database().save_level(self._owner, level)
+        level.hibernate(self)
+        self._resident.pop(level, None)
+        self._hibernated[level] = None
+        Utilities.message("Hibernated level: " + level.name, "GENERATION")
+
+    def rehydrate(self, level):
+        """
+        Loads a hibernated level from the database, called by Level.rehydrate().
+        """
+        self._database.load_level(self._owner, level)
+        self._hibernated.pop(level, None)
+        self._resident[level] = None
+        self._last_visit[level] = self._clock
+        Utilities.message("Rehydrated level: " + level.name, "GENERATION")
+
+    def _get_database(self):
+        """
+        Returns the database for the hibernated levels, it is created on first use.
+        """
+        if self._database is None:
+            self._database = _temporary_database()
+        return self._database
+
+    def _all_levels(self):
+        levels = []
+        to_visit = list(self._owner.levels)
+        while len(to_visit) > 0:
+            level = to_visit.pop(0)
+            levels.append(level)
+            to_visit.extend(level.subLevels)
+        return levels
+
+
+def _temporary_database():
+    """
+    Creates a database for hibernated levels in a temporary file, see WORLD.HIBERNATION_DIRECTORY.
+    The file is removed when the database is no longer used.
+    """
+    handle, file_name = tempfile.mkstemp(prefix="warrens_", suffix=".db", dir=WORLD.HIBERNATION_DIRECTORY)
+    os.close(handle)
+    database = Database(file_name)
+    weakref.finalize(database, _remove_database, database.db, file_name)
+    return database
+
+
+def _remove_database(connection, file_name):
+    connection.close()
+    # The write ahead log files are removed as well
+    for suffix in ["", "-wal", "-shm"]:
+        try:
+            os.remove(file_name + suffix)
+        except OSError:
+            pass
@@ -1,10 +1,15 @@
+import os
 import random
+import tempfile
 import unittest
 
-from WarrensGame.CONSTANTS import CONFIG
+from WarrensGame.CONSTANTS import CONFIG, GAME
 from WarrensGame.Game import Game
-from WarrensGame.Actors import Character
-from WarrensGame.Utilities import GameError
+from WarrensGame.Actors import Character, Monster
+from WarrensGame.Libraries import ItemModifier
+from WarrensGame.Scheduler import Scheduler
+from WarrensGame.AI import ThinkingPolicy
+from WarrensGame.Utilities import GameError, compile_dice, roll_hit_die
 
 
 class TestGame(unittest.TestCase):
@@ -21,6 +26,8 @@ class TestGame(unittest.TestCase):
 
         cls.game = Game()
         cls.game.setup_new_game()
+        # Levels are generated on first use, generate a dungeon level to create some monsters and items
+        cls.game.levels[1].generate()
         
     @classmethod
     def tearDownClass(cls):
@@ -146,6 +153,169 @@ class TestGame(unittest.TestCase):
         with self.assertRaises(GameError):
             confuse_item.applyTo(self.game)
 
+    def test_flowField(self):
+        level = self.game.current_level
+        player = self.game.player
+        height = level.map.height
+        flow_field = level.flow_field
+        self.assertEqual(flow_field[player.tile.x * height + player.tile.y], 0)
+        # The flow field is shared until a player moves or the blocked tiles change
+        self.assertIs(level.flow_field, flow_field)
+        tile = level.map.getRandomEmptyTile()
+        distance = flow_field[tile.x * height + tile.y]
+        step_tile = level.flow_step(tile)
+        if distance > 1:
+            self.assertEqual(flow_field[step_tile.x * height + step_tile.y], distance - 1)
+            self.assertLessEqual(abs(step_tile.x - tile.x), 1)
+            self.assertLessEqual(abs(step_tile.y - tile.y), 1)
+        else:
+            self.assertIsNone(step_tile)
+        step_tile = level.map.getRandomEmptyTile()
+        step_tile.blocked = True
+        self.assertIsNot(level.flow_field, flow_field)
+        self.assertEqual(level.flow_field[step_tile.x * height + step_tile.y], -1)
+        step_tile.blocked = False
+        step_tile.blockSight = False
+
+    def test_scheduler(self):
+        """
+        Only the characters and effects that are due act, fast characters act more often.
+        """
+        level = self.game.levels[1]
+        # There is no player on the level, it sleeps
+        self.assertTrue(level.asleep)
+        for monster in level.characters:
+            self.assertNotIn(monster, self.game.scheduler)
+        self.assertNotIn(self.game.player, self.game.scheduler)
+        # Count the actions on a scheduler of our own
+        scheduler = Scheduler()
+        fast_monster = self.game.monster_library.create_monster("kobold")
+        slow_monster = self.game.monster_library.create_monster("kobold")
+        # Think every tick, even without a player around
+        fast_monster.AI.thinking_policy = slow_monster.AI.thinking_policy = ThinkingPolicy(far_interval=1)
+        fast_monster.speed = GAME.NORMAL_SPEED * 2
+        slow_monster.speed = GAME.NORMAL_SPEED // 2
+        scheduler.schedule(fast_monster)
+        scheduler.schedule(slow_monster)
+        self.assertEqual([scheduler.advance(GAME.TICK) for i in range(4)], [2, 3, 2, 3])
+        # Characters that can no longer act are dropped
+        slow_monster.AI = None
+        scheduler.advance(GAME.TICK * 2)
+        self.assertNotIn(slow_monster, scheduler)
+        self.assertIn(fast_monster, scheduler)
+        scheduler.unschedule(fast_monster)
+        self.assertEqual(scheduler.advance(GAME.TICK), 0)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_sleepingLevel(self):
+        """
+        Levels without players sleep and catch up with the time they slept when a player arrives.
+        """
+        game = Game()
+        game.setup_new_game()
+        town = game.current_level
+        dungeon_level = game.levels[1]
+        portal = [portal for portal in town.portals if portal.destinationPortal.level is dungeon_level][0]
+        game.player.followPortal(portal)
+        self.assertTrue(town.asleep)
+        self.assertFalse(dungeon_level.asleep)
+        # Confuse a monster and leave the level, small random levels can be without monsters so one is added
+        monster = game.monster_library.create_monster("kobold")
+        monster.moveToLevel(dungeon_level, dungeon_level.getRandomEmptyTile())
+        confuse_item = game.item_library.create_item("confuse")
+        game.player.addItem(confuse_item)
+        confuse_item.applyTo(monster)
+        effect = confuse_item.effect
+        self.assertIn(effect, game.scheduler)
+        game.player.followPortal(portal.destinationPortal)
+        self.assertTrue(dungeon_level.asleep)
+        self.assertNotIn(monster, game.scheduler)
+        self.assertNotIn(effect, game.scheduler)
+        for i in range(effect.effectDuration + 1):
+            game.player.actionTaken = True
+            self.assertTrue(game.try_to_play_turn())
+        # Nothing happened while the level slept, the confusion ends when the player returns
+        self.assertTrue(monster.state_confused)
+        self.assertIn(effect, dungeon_level.active_effects)
+        game.player.followPortal(portal)
+        self.assertFalse(dungeon_level.asleep)
+        self.assertFalse(monster.state_confused)
+        self.assertNotIn(effect, dungeon_level.active_effects)
+        self.assertEqual(monster in game.scheduler, monster in dungeon_level.awake_characters)
+
+    def test_saveAndLoad(self):
+        game = Game()
+        game.setup_new_game()
+        level = game.levels[1]
+        game.player.followPortal([portal for portal in game.current_level.portals
+                                  if portal.destinationPortal.level is level][0])
+        # Active effects are saved as well
+        a_monster = random.choice([c for c in level.characters if isinstance(c, Monster)])
+        confuse_item = game.item_library.create_item("confuse")
+        game.player.addItem(confuse_item)
+        confuse_item.applyTo(a_monster)
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "game.sav")
+            game.save_game(file_name)
+            loaded_game = Game()
+            loaded_game.load_game(file_name)
+        self.assertIs(loaded_game.current_level, loaded_game.levels[1])
+        self.assertIs(loaded_game.player.level, loaded_game.current_level)
+        self.assertEqual((loaded_game.player.tile.x, loaded_game.player.tile.y),
+                         (game.player.tile.x, game.player.tile.y))
+        loaded_level = loaded_game.current_level
+        self.assertEqual([c.name for c in loaded_level.characters], [c.name for c in level.characters])
+        loaded_monster = loaded_level.characters[level.characters.index(a_monster)]
+        self.assertIs(loaded_monster.state_confused, True)
+        self.assertIn(loaded_monster.AI.sourceEffect, loaded_level.active_effects)
+        self.assertEqual(loaded_monster.AI.confusedTurns, a_monster.AI.confusedTurns)
+        self.assertEqual(len(loaded_game.monster_library.monsters), len(game.monster_library.monsters))
+        # The loaded game can be played
+        loaded_game.player.actionTaken = True
+        self.assertTrue(loaded_game.try_to_play_turn())
+
+    def test_statCache(self):
+        """
+        Cached stats follow equiping, unequiping, leveling up and item modifiers.
+        """
+        item_library = self.game.item_library
+        player = self.game.player
+        damage = player.damage
+        dagger = item_library.create_item("dagger")
+        player.addItem(dagger)
+        player.equipItem(dagger)
+        self.assertEqual(player.damage, damage + 4)
+        # A modifier on an equiped item changes the stats of its owner
+        dagger.add_modifier(ItemModifier(item_library.modifier_index["large"]))
+        self.assertEqual(dagger.damage, 5)
+        self.assertEqual(player.damage, damage + 5)
+        player.unEquipItem(dagger)
+        self.assertEqual(player.damage, damage)
+        player.levelUp()
+        self.assertEqual(player.damage, damage + GAME.PLAYER_LEVEL_DAMAGE)
+        self.assertEqual(player.stats, player._compute_stats())
+
+    def test_dice(self):
+        """
+        Compiled dice roll the same numbers as the hit die strings, every die rolls 1 to its number of sides.
+        """
+        dice = compile_dice("3d6")
+        self.assertIs(compile_dice("3d6"), dice)
+        self.assertEqual((dice.count, dice.sides), (3, 6))
+        rng_1, rng_2 = random.Random(7), random.Random(7)
+        rolls = [dice.roll(rng_1) for i in range(2000)]
+        self.assertEqual(rolls, [roll_hit_die("3d6", rng_2) for i in range(2000)])
+        self.assertEqual((min(rolls), max(rolls)), (3, 18))
+        # Batches are drawn at once, they are repeatable and cover the whole range
+        for hitdie, low, high in [("3d6", 3, 18), ("1d8", 1, 8), ("1d100", 1, 100)]:
+            rolls = compile_dice(hitdie).roll_many(5000, random.Random(3))
+            self.assertEqual(rolls, compile_dice(hitdie).roll_many(5000, random.Random(3)))
+            self.assertEqual(len(rolls), 5000)
+            self.assertEqual((min(rolls), max(rolls)), (low, high))
+        self.assertEqual(compile_dice("1d300").roll_many(0), [])
+        for roll in compile_dice("1d300").roll_many(500, random.Random(3)):
+            self.assertTrue(1 <= roll <= 300)
+
     def test_combat(self):
         player = self.game.player
         a_monster = random.choice(self.game.monster_library.monsters)
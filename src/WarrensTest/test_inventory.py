@@ -3,7 +3,7 @@ import random
 
 from  WarrensGame.CONSTANTS import CONFIG
 from WarrensGame.Inventory import Inventory
-from WarrensGame.Libraries import ItemLibrary
+from WarrensGame.Libraries import ItemLibrary, ItemModifier
 from WarrensGame.Actors import Character
 
 
@@ -87,3 +87,41 @@ class TestInventory(unittest.TestCase):
         self.assertEqual(len(i.items), 0)
         self.assertEqual(i.item_count, 0)
 
+    def test_item_count(self):
+        # Stack sizes that change outside of the inventory are reported to the inventory of the owner
+        i = Character().inventory
+        vial = self.item_library.create_item("healingvial")
+        i.add(vial)
+        i.add(self.item_library.create_item("healingvial"))
+        # Identical stackable items end up on the same stack
+        self.assertIs(i.find(self.item_library.create_item("healingvial")), vial)
+        self.assertEqual(vial.stackSize, 2)
+        for lvl in range(1, 15):
+            i.add(self.item_library.get_random_item(lvl))
+        expected = sum(item.stackSize if item.stackable else 1 for item in i.items)
+        self.assertEqual(i.item_count, expected)
+        # Changing a stack outside of the inventory is counted as well
+        vial.stackSize -= 1
+        self.assertEqual(i.item_count, expected - 1)
+        # Random items can add to the stack as well
+        stack_size = vial.stackSize
+        for n in range(stack_size):
+            i.remove(vial)
+        self.assertNotIn(vial, i)
+        self.assertIsNone(i.find(vial))
+        self.assertEqual(i.item_count, expected - 1 - stack_size)
+
+    def test_modifier_after_adding(self):
+        i = Character().inventory
+        vial = self.item_library.create_item("healingvial")
+        i.add(vial)
+        items = i.items
+        # The item list is kept until the inventory changes
+        self.assertIs(i.items, items)
+        # An item that gets a modifier in the inventory is found by its new modifiers
+        vial.add_modifier(ItemModifier(self.item_library.modifier_index["major"]))
+        self.assertIsNone(i.find(self.item_library.create_item("healingvial")))
+        self.assertIs(i.find(self.item_library.create_item("healingvial", "major")), vial)
+        i.remove(vial)
+        self.assertEqual(i.items, [])
+        self.assertEqual(i.item_count, 0)
@@ -72,6 +72,11 @@ class TestMonsterLibrary(unittest.TestCase):
         for difficulty in range(1, 10):
             for i in range(1, 10):
                 self.mlib.get_random_monster(difficulty)
+        # Monsters can be created in one batch, unique monsters are only created once
+        monsters = self.mlib.get_random_monsters(10, 50)
+        self.assertEqual(len(monsters), 50)
+        unique_keys = [monster.key for monster in self.mlib.unique_monsters]
+        self.assertEqual(len(unique_keys), len(set(unique_keys)))
         # Challenge rating 0 should throw a GameError
         with self.assertRaises(GameError):
             self.mlib.get_random_monster(0)
@@ -163,6 +168,9 @@ class TestItemLibrary(unittest.TestCase):
             for i in range(1, 10):
                 self.ilib.get_random_item(difficulty)
 
+        # Items can be created in one batch
+        self.assertEqual(len(self.ilib.get_random_items(5, 20)), 20)
+
         # Ensure item level 0 can't be created
         with self.assertRaises(GameError):
             self.ilib.get_random_item(0)
@@ -1,8 +1,11 @@
 import unittest
 
-from WarrensGame.CONSTANTS import CONFIG, DUNGEON
-from WarrensGame.Maps import Tile, Map, DungeonMap
+import WarrensGame.CONSTANTS as CONSTANTS
+from WarrensGame.CONSTANTS import CONFIG, DUNGEON, FOV
+from WarrensGame.Maps import Tile, Map, DungeonMap, WALL_TEXTURES, circle_stencil
 from WarrensGame.Utilities import GameError
+import WarrensGame.Utilities as Utilities
+from WarrensGame.Actors import Portal
 
 
 class TestMapGeneration(unittest.TestCase):
@@ -94,6 +97,193 @@ class TestMapGeneration(unittest.TestCase):
         # Check the base map properties
         self.check_base_map_properties(m)
 
+    def test_field_of_view(self):
+        """
+        Test field of view calculation with the available algorithms.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        origin = m.getRandomEmptyTile()
+        for algorithm in [FOV.RAYCASTING, FOV.SHADOWCASTING]:
+            m.fov_algorithm = algorithm
+            m.updateFieldOfView(origin.x, origin.y)
+            # The origin is always visible
+            self.assertIs(origin.inView, True)
+            for tile in m.visible_tiles:
+                # Visible tiles are explored and within range of view
+                self.assertIs(tile.explored, True)
+                distance = Utilities.distance_between_points(origin.x, origin.y, tile.x, tile.y)
+                self.assertLessEqual(distance, m.range_of_view)
+            # The walls surrounding the origin block sight but are visible themselves
+            self.assertTrue(any(tile.blockSight for tile in m.visible_tiles))
+        # Moving the origin hides the tiles that are no longer in view
+        before = set((tile.x, tile.y) for tile in m.visible_tiles)
+        other = m.getRandomEmptyTile()
+        m.updateFieldOfView(other.x, other.y)
+        expected = Utilities.shadowcast(m.solidTileMatrix, m.width, m.height, other.x, other.y, m.range_of_view)
+        self.assertEqual(expected, set((tile.x, tile.y) for tile in m.visible_tiles))
+        # Only the tiles for which visibility flipped are reported as changed
+        self.assertEqual(before ^ expected, set((tile.x, tile.y) for tile in m.fov_changed_tiles))
+        # Nothing changes if the origin and the blocking tiles stay the same
+        m.updateFieldOfView(other.x, other.y)
+        self.assertEqual(len(m.fov_changed_tiles), 0)
+        # Changing a blocking tile triggers a new calculation
+        wall = [tile for tile in m.visible_tiles if tile.blockSight][0]
+        wall.blockSight = False
+        m.updateFieldOfView(other.x, other.y)
+        for tile in m.fov_changed_tiles:
+            self.assertNotEqual((tile.x, tile.y) in expected, tile.inView)
+
+    def test_batched_line_of_sight(self):
+        """
+        The batched line of sight query gives the same answers as line_of_sight() for a single pair.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        sources = [(tile.x, tile.y) for tile in [m.getRandomEmptyTile() for i in range(5)]]
+        targets = [(tile.x, tile.y) for tile in [m.getRandomEmptyTile() for i in range(7)]]
+        in_sight = Utilities.line_of_sight_matrix(m.solidTileMatrix, sources, targets, 10)
+        for i, (x, y) in enumerate(sources):
+            for j, (u, v) in enumerate(targets):
+                expected = (Utilities.distance_between_points(x, y, u, v) <= 10
+                            and Utilities.line_of_sight(m.solidTileMatrix, x, y, u, v))
+                self.assertEqual(in_sight[i][j], expected)
+
+    def test_tile_json(self):
+        """
+        Test the json representation of the tiles which is created from the map layers.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        tile = m.getRandomTile()
+        tile.blocked = True
+        tile.color = DUNGEON.COLOR_WALL
+        # The json of the map contains the json of every tile
+        tile_json = m.json["tiles"][tile.x][tile.y]
+        self.assertIs(tile_json, tile.json)
+        self.assertEqual(tile_json["x"], tile.x)
+        self.assertEqual(tile_json["y"], tile.y)
+        self.assertIs(tile_json["blocked"], True)
+        self.assertIs(tile_json["blockSight"], True)
+        self.assertEqual(tile_json["color"], DUNGEON.COLOR_WALL)
+        # Changes after the json was created are reflected in the json
+        tile.blocked = False
+        tile.blockSight = False
+        tile.texture_id = None
+        tile.color = DUNGEON.COLOR_FLOOR
+        self.assertIs(tile_json["blocked"], False)
+        self.assertIs(tile.blocked, False)
+        self.assertIsNone(tile_json["texture_id"])
+        self.assertEqual(tile_json["color"], DUNGEON.COLOR_FLOOR)
+        self.assertEqual(tile.color, DUNGEON.COLOR_FLOOR)
+
+    def test_texture_hash(self):
+        """
+        Test the texture hashes that are used to assign wall textures.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        self.assertEqual(len(WALL_TEXTURES), 512)
+        for x, y in [(0, 0), (m.width - 1, m.height - 1), (m.width // 2, m.height // 2)]:
+            # Build the hash from the 3x3 neighbourhood, positions outside of the map block sight
+            h = 0
+            for dy in [-1, 0, 1]:
+                for dx in [-1, 0, 1]:
+                    bit = 1
+                    if 0 <= x + dx < m.width and 0 <= y + dy < m.height:
+                        bit = int(m.tiles[x + dx][y + dy].blockSight)
+                    h = (h << 1) | bit
+            tile = m.tiles[x][y]
+            self.assertEqual(tile.texture_hash, h)
+            if tile.blockSight:
+                self.assertEqual(tile.texture_id, WALL_TEXTURES[h])
+            else:
+                self.assertIsNotNone(tile.texture_id)
+
+    def test_circle_tiles(self):
+        """
+        Test the circle tiles which are taken from cached circle stencils.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        # Stencils are cached
+        self.assertIs(circle_stencil(5, True), circle_stencil(5, True))
+        self.assertEqual(circle_stencil(0, True), [(0, 0)])
+        center = m.getRandomEmptyTile()
+        for radius in [1, 3, 7]:
+            circle = m.getCircleTiles(center.x, center.y, radius, full_circle=True)
+            # Center comes first, no duplicates, everything within the radius
+            self.assertIs(circle[0], center)
+            self.assertEqual(len(circle), len(set(circle)))
+            for tile in circle:
+                self.assertLessEqual(abs(tile.x - center.x), radius)
+                self.assertLessEqual(abs(tile.y - center.y), radius)
+            # The edge is part of the full circle
+            edge = m.getCircleTiles(center.x, center.y, radius)
+            self.assertTrue(set(edge) <= set(circle))
+            # Blocked tiles can be excluded
+            open_circle = m.getCircleTiles(center.x, center.y, radius, full_circle=True, exclude_blocked_tiles=True)
+            self.assertEqual(open_circle, [t for t in circle if not t.blocked])
+        # Circles are clipped to the map
+        corner = m.getCircleTiles(0, 0, 3, full_circle=True)
+        self.assertIs(corner[0], m.tiles[0][0])
+        self.assertEqual(len(corner), len([dx for dx, dy in circle_stencil(3, True) if dx >= 0 and dy >= 0]))
+
+    def test_find_path(self):
+        """
+        Test path finding on a map.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        start = m.getRandomEmptyTile()
+        goal = m.getRandomEmptyTile()
+        path = m.find_path(start, goal)
+        # Dungeon rooms are connected so there is always a path
+        self.assertIsNotNone(path)
+        self.assertEqual(m.find_path(start, start), [])
+        if start is not goal:
+            self.assertIs(path[-1], goal)
+        previous = start
+        for tile in path:
+            # Every step moves to a neighbouring tile that is not blocked
+            self.assertIs(tile.blocked, False)
+            self.assertEqual(max(abs(tile.x - previous.x), abs(tile.y - previous.y)), 1)
+            previous = tile
+        # A path can't be shorter than the number of steps in the longest direction
+        self.assertGreaterEqual(len(path), max(abs(goal.x - start.x), abs(goal.y - start.y)))
+        # Paths are cached until tiles become blocked
+        self.assertEqual(m.find_path(start, goal), path)
+        if len(path) > 1:
+            path[0].blocked = True
+            new_path = m.find_path(start, goal)
+            if new_path is not None:
+                self.assertNotIn(path[0], new_path)
+        # Blocked goals can't be reached
+        self.assertIsNone(m.find_path(start, m.tiles[0][0]))
+
+    def test_random_empty_tile(self):
+        """
+        Test the index of empty tiles.
+        """
+        m = DungeonMap(CONSTANTS.MAP_WIDTH, CONSTANTS.MAP_HEIGHT)
+        room = m.rooms[0]
+        # Fill the first room
+        tile = room.getRandomEmptyTile()
+        while tile is not None:
+            self.assertIs(tile.empty, True)
+            self.assertIs(tile.blocked, False)
+            tile.addActor(Portal('>', 'portal', 'test'))
+            tile = room.getRandomEmptyTile()
+        # Fill the other rooms
+        tile = m.getRandomEmptyTile()
+        while tile is not None:
+            self.assertIs(tile.empty, True)
+            tile.addActor(Portal('>', 'portal', 'test'))
+            tile = m.getRandomEmptyTile()
+        for room in m.rooms:
+            self.assertIsNone(room.getRandomEmptyTile())
+        # Freeing up a tile makes it available again
+        center = m.tiles[room.center[0]][room.center[1]]
+        center.removeActor(center.actors[0])
+        self.assertIs(m.getRandomEmptyTile(), center)
+        self.assertIs(room.getRandomEmptyTile(), center)
+        center.blocked = True
+        self.assertIsNone(m.getRandomEmptyTile())
+
     def test_generate_room_sized_dungeon(self):
         """
         Test to generate a dungeon map with size equal to max dungeon room size.
@@ -1,12 +1,20 @@
+import gc
+import json
+import os
 import random
+import tempfile
 import unittest
+import weakref
 
-from WarrensGame.CONSTANTS import WORLD, CONFIG
+from WarrensGame.CONSTANTS import WORLD, CONFIG, GAME
 from WarrensGame.World import World
 from WarrensGame.Levels import TownLevel, DungeonLevel, CaveLevel
 from WarrensGame.Libraries import MonsterLibrary, ItemLibrary
-from WarrensGame.Actors import Player
+from WarrensGame.Actors import Player, Monster
 from WarrensGame.Utilities import GameError
+import WarrensGame.SaveGame as SaveGame
+from WarrensGame.Database import Database
+from WarrensGame.AI import ThinkingPolicy
 
 
 class TestWorld(unittest.TestCase):
@@ -74,12 +82,423 @@ class TestWorld(unittest.TestCase):
         self.assertIsInstance(player_2, Player)
         self.assertEqual(len(self.world.players), 2)
 
+    def test_lazy_level_generation(self):
+        """
+        Levels are generated when a player enters them for the first time.
+        :return: None
+        """
+        world = World()
+        town = world.levels[0]
+        self.assertIs(town.generated, True)
+        for level in world.levels[1:] + town.subLevels:
+            self.assertIs(level.generated, False)
+        # Follow the stairs down
+        player = world.new_player()
+        dungeon_level = world.levels[1]
+        portal = [p for p in town.portals if p.destinationPortal.level is dungeon_level][0]
+        player.followPortal(portal)
+        self.assertIs(dungeon_level.generated, True)
+        self.assertIs(player.level, dungeon_level)
+        self.assertIs(player.tile, portal.destinationPortal.tile)
+        self.assertIsNotNone(player.tile)
+        # Generation only depends on the seed of the level
+        level_1 = DungeonLevel(world, 3, "Seeded level", dungeon_level.seed)
+        level_2 = DungeonLevel(world, 3, "Seeded level", dungeon_level.seed)
+        for x, y in level_1.map.each_map_position:
+            self.assertEqual(level_1.map.tiles[x][y].blocked, level_2.map.tiles[x][y].blocked)
+            self.assertEqual(level_1.map.tiles[x][y].blocked, dungeon_level.map.tiles[x][y].blocked)
+
+    def test_world_seed(self):
+        """
+        Worlds created with the same seed are identical.
+        :return: None
+        """
+        world_1 = World(seed=1234)
+        world_2 = World(seed=1234)
+        self.assertEqual(world_1.seed, 1234)
+        self.assertEqual([level.seed for level in world_1.levels], [level.seed for level in world_2.levels])
+        for level_1, level_2 in zip(world_1.levels, world_2.levels):
+            for x, y in level_1.map.each_map_position:
+                self.assertEqual(level_1.map.tiles[x][y].blocked, level_2.map.tiles[x][y].blocked)
+            self.assertEqual(sorted(c.name for c in level_1.characters), sorted(c.name for c in level_2.characters))
+        # Level seeds depend on the world seed
+        world_3 = World(seed=4321)
+        self.assertNotEqual([level.seed for level in world_1.levels], [level.seed for level in world_3.levels])
+
+    def test_independent_worlds(self):
+        """
+        Every world owns its random streams, creating or playing another world doesn't change them.
+        :return: None
+        """
+        world_1 = World(seed=5)
+        state = world_1.random_streams.getstate()
+        world_2 = World(seed=5)
+        World(seed=6).generate_levels(processes=1)
+        self.assertEqual(world_1.random_streams.getstate(), state)
+        self.assertEqual(world_2.random_streams.getstate(), state)
+        # Generate the levels of both worlds interleaved
+        for level_1, level_2 in zip(world_1.levels, world_2.levels):
+            for l_1, l_2 in zip([level_1] + level_1.subLevels, [level_2] + level_2.subLevels):
+                l_1.generate()
+                l_2.generate()
+                for x, y in l_1.map.each_map_position:
+                    self.assertEqual(l_1.map.tiles[x][y].blocked, l_2.map.tiles[x][y].blocked)
+                    self.assertEqual(sorted(actor.name for actor in l_1.map.tiles[x][y].actors),
+                                     sorted(actor.name for actor in l_2.map.tiles[x][y].actors))
+        self.assertEqual(world_1.random_streams.getstate(), world_2.random_streams.getstate())
+
+    def test_parallel_level_generation(self):
+        """
+        Generating levels in parallel gives the same result as generating them one by one.
+        :return: None
+        """
+        def describe(world):
+            description = []
+            for level in world.levels:
+                for l in [level] + level.subLevels:
+                    description.append([(x, y, l.map.tiles[x][y].blocked, l.map.tiles[x][y].material,
+                                         sorted(actor.name for actor in l.map.tiles[x][y].actors))
+                                        for x, y in l.map.each_map_position])
+            return description
+
+        serial_world = World(seed=42)
+        serial_world.generate_levels(processes=1)
+        parallel_world = World(seed=42)
+        parallel_world.generate_levels(processes=2)
+        for level in parallel_world.levels:
+            self.assertIs(level.generated, True)
+        self.assertEqual(describe(serial_world), describe(parallel_world))
+
     def test_save_world(self):
-        pass
+        """
+        Saved worlds are compact, the tile layers are packed.
+        :return: None
+        """
+        world = World(seed=7)
+        world.new_player()
+        world.generate_levels(processes=1)
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "world.sav")
+            world.save_game(file_name)
+            with open(file_name, "rb") as save_file:
+                data = save_file.read()
+        self.assertTrue(data.startswith(SaveGame.MAGIC))
+        json_size = sum(len(json.dumps(level.json, default=str)) for level in world.levels)
+        self.assertLess(len(data), json_size / 10)
+        # Other data is refused
+        with self.assertRaises(GameError):
+            SaveGame.unpack_game(world, b"not a saved game")
 
     def test_load_world(self):
-        pass
+        """
+        A loaded world is identical to the saved one, nothing is generated again.
+        :return: None
+        """
+        def describe(world):
+            description = []
+            for level in world.levels:
+                for l in [level] + level.subLevels:
+                    description.append((l.name, l.generated))
+                    if l.generated:
+                        description.append([(x, y, l.map.tiles[x][y].blocked, l.map.tiles[x][y].material,
+                                             l.map.tiles[x][y].color, [actor.json for actor in l.map.tiles[x][y].actors])
+                                            for x, y in l.map.each_map_position])
+            return description
 
+        world = World(seed=99)
+        player = world.new_player()
+        world.levels[1].generate()
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "world.sav")
+            world.save_game(file_name)
+            loaded_world = World(seed=1)
+            loaded_world.load_game(file_name)
+        self.assertEqual(loaded_world.seed, 99)
+        self.assertEqual(describe(world), describe(loaded_world))
+        loaded_player = loaded_world.players[0]
+        self.assertEqual(loaded_player.name, player.name)
+        self.assertEqual([item.name for item in loaded_player.inventory.items],
+                         [item.name for item in player.inventory.items])
+        self.assertIs(loaded_player.level, loaded_world.levels[0])
+        self.assertIn(loaded_player, loaded_player.tile.actors)
+        # Portals are connected to the loaded levels
+        for portal in loaded_world.levels[0].portals:
+            self.assertIs(portal.destinationPortal.destinationPortal, portal)
+            if portal.destinationPortal.level in loaded_world.levels:
+                self.assertIn(portal.destinationPortal, portal.destinationPortal.level.portals)
+        # Stubs are still generated on first use and the loaded world keeps running
+        loaded_world.levels[2].generate()
+        for i in range(5):
+            loaded_world.tick()
+
+    def test_database(self):
+        """
+        Worlds can be stored in a database, only the rows that changed are written again.
+        :return: None
+        """
+        world = World(seed=11)
+        player = world.new_player()
+        dungeon_level = world.levels[1]
+        dungeon_level.generate()
+        with tempfile.TemporaryDirectory() as directory:
+            database = Database(os.path.join(directory, "world.db"))
+            self.assertGreater(database.save(world), 0)
+            self.assertEqual(database.save(world), 0)
+            # A level that is asleep is only packed again when something happened on it
+            packed_levels = []
+            pack_level = dungeon_level.pack
+
+            def counting_pack(packer):
+                packed_levels.append(dungeon_level)
+                return pack_level(packer)
+            dungeon_level.pack = counting_pack
+            self.assertTrue(dungeon_level.asleep)
+            self.assertEqual(database.save(world), 0)
+            self.assertEqual(packed_levels, [])
+            sleeping_monster = [c for c in dungeon_level.characters if c is not player][0]
+            sleeping_monster.moveToTile([tile for column in dungeon_level.map.tiles for tile in column
+                                         if tile.empty and not tile.blocked][0])
+            self.assertEqual(database.save(world), 1)
+            self.assertEqual(packed_levels, [dungeon_level])
+            del dungeon_level.pack
+            # Moving the player only changes the row of the town level
+            town_map = world.levels[0].map
+            player.moveToTile([tile for tile in town_map.explored_tiles if tile.empty and not tile.blocked][0])
+            self.assertEqual(database.save(world), 1)
+            # A level can be loaded on its own, the objects in memory are filled in again
+            monster = [c for c in dungeon_level.characters if c is not player][0]
+            tile = monster.tile
+            monster.moveToTile(dungeon_level.getRandomEmptyTile())
+            database.load_level(world, dungeon_level)
+            self.assertIn(monster, dungeon_level.characters)
+            self.assertEqual((monster.tile.x, monster.tile.y), (tile.x, tile.y))
+            self.assertIn(monster, dungeon_level.map.tiles[tile.x][tile.y].actors)
+            database.close()
+            # Load everything in another world
+            database = Database(os.path.join(directory, "world.db"))
+            loaded_world = World(seed=1)
+            database.load(loaded_world)
+            self.assertEqual(database.save(loaded_world), 0)
+            database.close()
+        loaded_player = loaded_world.players[0]
+        self.assertEqual((loaded_player.tile.x, loaded_player.tile.y), (player.tile.x, player.tile.y))
+        self.assertEqual([level.generated for level in loaded_world.levels], [level.generated for level in world.levels])
+        for x, y in dungeon_level.map.each_map_position:
+            self.assertEqual(loaded_world.levels[1].map.tiles[x][y].blocked, dungeon_level.map.tiles[x][y].blocked)
+
+    def test_awake_monsters(self):
+        """
+        Only the monsters near a player are awake and scheduled.
+        :return: None
+        """
+        world = World(seed=3)
+        player = world.new_player()
+        town = world.levels[0]
+        dungeon_level = world.levels[1]
+        portal = [portal for portal in town.portals if portal.destinationPortal.level is dungeon_level][0]
+        player.followPortal(portal)
+        monster = [c for c in dungeon_level.characters if isinstance(c, Monster)][0]
+        free_tiles = [tile for column in dungeon_level.map.tiles for tile in column if tile.empty and not tile.blocked]
+        radius = GAME.WAKE_RADIUS
+
+        def distance(tile, other_tile):
+            return ((tile.x - other_tile.x) ** 2 + (tile.y - other_tile.y) ** 2) ** 0.5
+        player.moveToTile([tile for tile in free_tiles if distance(tile, monster.tile) > radius][0])
+        self.assertNotIn(monster, dungeon_level.awake_characters)
+        self.assertNotIn(monster, world.scheduler)
+        player.moveToTile([tile for tile in free_tiles if distance(tile, monster.tile) <= radius][0])
+        self.assertIn(monster, dungeon_level.awake_characters)
+        self.assertIn(monster, world.scheduler)
+        for character in dungeon_level.awake_characters:
+            self.assertLessEqual(distance(character.tile, player.tile), radius)
+        # The monster falls asleep when it moves away
+        monster.moveToTile([tile for tile in free_tiles if distance(tile, player.tile) > radius][0])
+        self.assertNotIn(monster, dungeon_level.awake_characters)
+        self.assertNotIn(monster, world.scheduler)
+
+    def test_level_registries(self):
+        """
+        The actors of a level are registered once, per type and in the order in which they arrived.
+        :return: None
+        """
+        world = World(seed=3)
+        player = world.new_player()
+        town = world.levels[0]
+        dungeon_level = world.levels[1]
+        portal = [portal for portal in town.portals if portal.destinationPortal.level is dungeon_level][0]
+        player.followPortal(portal)
+        self.assertEqual(dungeon_level.players, [player])
+        self.assertEqual(dungeon_level.characters[-1], player)
+        self.assertEqual(dungeon_level.monsters, [c for c in dungeon_level.characters if isinstance(c, Monster)])
+        self.assertNotIn(player, town.characters)
+        self.assertIs(town.player_present, False)
+        # Setting the same level again keeps the actor where it is
+        player.level = dungeon_level
+        self.assertEqual(dungeon_level.characters.count(player), 1)
+        self.assertEqual(dungeon_level.characters[-1], player)
+        monster = dungeon_level.monsters[0]
+        monster.removeFromLevel()
+        self.assertNotIn(monster, dungeon_level.monsters)
+        self.assertNotIn(monster, dungeon_level.characters)
+        item = dungeon_level.items[0]
+        player.pickUpItem(item)
+        self.assertNotIn(item, dungeon_level.items)
+
+    def test_actor_index(self):
+        """
+        The actor index of a level answers the same as looking at every tile, also after actors moved.
+        :return: None
+        """
+        world = World(seed=3)
+        player = world.new_player()
+        town = world.levels[0]
+        dungeon_level = world.levels[1]
+        portal = [portal for portal in town.portals if portal.destinationPortal.level is dungeon_level][0]
+        player.followPortal(portal)
+        for i in range(20):
+            player.moveToTile(dungeon_level.getRandomEmptyTile())
+            world.tick()
+        tiles = [tile for column in dungeon_level.map.tiles for tile in column]
+        x, y = player.tile.x, player.tile.y
+        in_radius = [actor for tile in tiles for actor in tile.actors if (tile.x - x) ** 2 + (tile.y - y) ** 2 <= 100]
+        self.assertEqual(set(dungeon_level.actors_within_radius(x, y, 10)), set(in_radius))
+        in_rect = [actor for tile in tiles for actor in tile.actors if 5 <= tile.x <= 30 and 10 <= tile.y <= 20]
+        self.assertEqual(set(dungeon_level.actors_in_rect(5, 10, 30, 20)), set(in_rect))
+        monsters = [actor for tile in tiles for actor in tile.actors if isinstance(actor, Monster)]
+        nearest = dungeon_level.nearest_actor(x, y, Monster)
+        distances = [(monster.tile.x - x) ** 2 + (monster.tile.y - y) ** 2 for monster in monsters]
+        self.assertEqual((nearest.tile.x - x) ** 2 + (nearest.tile.y - y) ** 2, min(distances))
+        self.assertIsNone(dungeon_level.nearest_actor(x, y, Monster, max_distance=min(distances) ** 0.5 - 0.5))
+        # Actors that leave the level are no longer found
+        player.followPortal(portal.destinationPortal)
+        self.assertNotIn(player, dungeon_level.actors_within_radius(x, y, 1))
+
+    def test_thinking_policy(self):
+        """
+        Monsters far from a player think less often, the skipped decisions are counted.
+        :return: None
+        """
+        world = World(seed=3)
+        player = world.new_player()
+        town = world.levels[0]
+        dungeon_level = world.levels[1]
+        portal = [portal for portal in town.portals if portal.destinationPortal.level is dungeon_level][0]
+        player.followPortal(portal)
+        monster = [c for c in dungeon_level.characters if isinstance(c, Monster)][0]
+        free_tiles = [tile for column in dungeon_level.map.tiles for tile in column if tile.empty and not tile.blocked]
+        policy = ThinkingPolicy(near_distance=1.5, sight_distance=8, sight_interval=2, far_interval=5)
+
+        def tile_at(minimum, maximum):
+            return [tile for tile in free_tiles
+                    if minimum < ((tile.x - monster.tile.x) ** 2 + (tile.y - monster.tile.y) ** 2) ** 0.5 <= maximum][0]
+        player.moveToTile(tile_at(0, 1.5))
+        self.assertEqual(policy.interval(monster), 1)
+        player.moveToTile(tile_at(1.5, 8))
+        self.assertEqual(policy.interval(monster), 2)
+        player.moveToTile(tile_at(8, GAME.WAKE_RADIUS))
+        self.assertEqual(policy.interval(monster), 5)
+        # Out of sight the monster decides every 5 ticks
+        player.moveToTile(tile_at(GAME.WAKE_RADIUS, 1000))
+        monster.AI.thinking_policy = policy
+        player.moveToTile(tile_at(8, GAME.WAKE_RADIUS))
+        for i in range(10):
+            world.tick()
+        self.assertEqual((policy.decisions, policy.skipped), (2, 8))
+        # Coming closer moves the next decision forward, moving away again doesn't postpone it
+        player.moveToTile(tile_at(1.5, 8))
+        world.tick()
+        player.moveToTile(tile_at(8, GAME.WAKE_RADIUS))
+        world.tick()
+        self.assertEqual((policy.decisions, policy.skipped), (3, 9))
+        # Every world has its own policy
+        monster.AI.thinking_policy = None
+        self.assertIs(monster.AI.thinking_policy, world.thinking_policy)
+        self.assertIsNot(World(seed=3).thinking_policy, world.thinking_policy)
+
+    def test_level_hibernation(self):
+        """
+        Levels over the budget of the level manager are hibernated and rehydrated when a portal to them is followed.
+        :return: None
+        """
+        world = World(seed=5)
+        player = world.new_player()
+        town = world.levels[0]
+        dungeon_level = world.levels[1]
+        dungeon_level.generate()
+        monsters = list(dungeon_level.characters)
+        positions = [(monster.tile.x, monster.tile.y) for monster in monsters]
+        world.level_manager.budget = 1
+        world.tick()
+        # The town has the player and stays, the houses and the dungeon level are dropped
+        self.assertFalse(town.hibernated)
+        self.assertTrue(dungeon_level.hibernated)
+        self.assertEqual(world.level_manager.resident_levels, [town])
+        self.assertEqual(len(dungeon_level.characters), 0)
+        self.assertIsNone(dungeon_level._map)
+        self.assertTrue(all(monster.tile is None for monster in monsters))
+        # Following the portal brings the level back
+        portal = [portal for portal in town.portals if portal.destinationPortal.level is dungeon_level][0]
+        player.followPortal(portal)
+        self.assertFalse(dungeon_level.hibernated)
+        self.assertEqual(dungeon_level.characters[:len(monsters)], monsters)
+        self.assertEqual([(monster.tile.x, monster.tile.y) for monster in monsters], positions)
+        self.assertIs(player.tile, portal.destinationPortal.tile)
+        # Now the town is the least recently visited level without players
+        world.tick()
+        self.assertTrue(town.hibernated)
+        self.assertFalse(dungeon_level.hibernated)
+        # Saving a world with hibernated levels stores them as well
+        loaded_world = World(seed=1)
+        SaveGame.unpack_game(loaded_world, SaveGame.pack_game(world))
+        self.assertEqual(len(loaded_world.levels[0].portals), len(town.portals))
+        self.assertFalse(town.hibernated)
+
+    def test_hibernation_releases_actors(self):
+        """
+        The monsters of a hibernated level are dropped from memory, the libraries only keep weak references.
+        :return: None
+        """
+        world = World(seed=5)
+        world.new_player()
+        dungeon_level = world.levels[1]
+        dungeon_level.generate()
+        monster_count = len(dungeon_level.monsters)
+        # Unique monsters stay known to the library, they can't be created again
+        monster = weakref.ref([monster for monster in dungeon_level.monsters
+                               if monster not in world.monster_library.unique_monsters][0])
+        world.level_manager.budget = 1
+        world.tick()
+        gc.collect()
+        # The hibernated levels are stored in a file
+        self.assertTrue(os.path.exists(world.level_manager.database.file_name))
+        self.assertIn(dungeon_level, world.level_manager.hibernated_levels)
+        self.assertIsNone(monster())
+        # Rehydrated monsters are known to the library again
+        dungeon_level.rehydrate()
+        self.assertEqual(len(dungeon_level.monsters), monster_count)
+        self.assertIn(dungeon_level, world.level_manager.resident_levels)
+        for monster in dungeon_level.monsters:
+            self.assertIn(monster, world.monster_library.monsters)
+
+    def test_hibernation_database_on_demand(self):
+        """
+        The database for hibernated levels is only created when a level is hibernated.
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            hibernation_directory = WORLD.HIBERNATION_DIRECTORY
+            WORLD.HIBERNATION_DIRECTORY = directory
+            try:
+                world = World(seed=3)
+                world.new_player()
+                world.level_manager.budget = None
+                world.levels[1].generate()
+                for i in range(5):
+                    world.tick()
+                self.assertIsNone(world.level_manager.database)
+                self.assertEqual(os.listdir(directory), [])
+            finally:
+                WORLD.HIBERNATION_DIRECTORY = hibernation_directory
 
     # def test_healingEffect(self):
     #     # Note that we recreate the healing item every time because it is potentially used up.